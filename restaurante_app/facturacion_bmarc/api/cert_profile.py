@@ -0,0 +1,137 @@
+"""
+Perfil de la firma electronica por compania (ruta resuelta en disco, vencimiento, RUC del
+certificado), guardado en redis para que las validaciones del flujo de emision no lean
+Company ni el disco en cada factura.
+Se invalida al cambiar la firma (company_set_signature, analyze_company_firma con
+save_to_company=1 o al guardar Company), otra vez despues del commit, y vence a los
+CERT_PROFILE_TTL segundos por si un archivo desaparece del disco sin pasar por esos caminos.
+"""
+import hashlib
+import hmac
+import os
+from functools import partial
+
+import frappe
+from frappe.utils import get_datetime, get_site_path, now_datetime
+from frappe.utils.password import get_encryption_key
+
+CERT_PROFILE_CACHE_KEY = "restaurante_app:cert_profile"
+CERT_ANALYSIS_CACHE_KEY = "restaurante_app:cert_analysis"
+CERT_PROFILE_TTL = 600
+
+
+def resolve_fs_path(path: str) -> str:
+    """
+    Convierte cualquier variante a ruta ABSOLUTA real en disco:
+      - '/files/xxx.p12'              -> <sites>/<site>/public/files/xxx.p12
+      - '/private/files/xxx.p12'      -> <sites>/<site>/private/files/xxx.p12
+      - './algo/xxx.p12' o 'xxx.p12'  -> absoluta desde el cwd -> realpath
+      - ya absoluta                   -> se normaliza con realpath
+    """
+    if not path:
+        return path
+
+    if path.startswith("/files/"):
+        candidate = get_site_path("public", path.lstrip("/"))   # sites/<site>/public/files/...
+    elif path.startswith("/private/files/"):
+        candidate = get_site_path(path.lstrip("/"))             # sites/<site>/private/files/...
+    else:
+        candidate = path                                        # puede ser relativa o absoluta
+
+    # Normaliza a absoluta y resuelve ./, .., symlinks
+    return os.path.realpath(os.path.abspath(candidate))
+
+
+def _load_cert_profile(company_name: str) -> dict:
+    row = frappe.db.get_value(
+        "Company", company_name, ["urlfirma", "clave", "cert_not_after"], as_dict=True
+    ) or frappe._dict()
+    path = resolve_fs_path(row.urlfirma) if row.urlfirma else None
+    # La clave no se guarda en cache: solo si existe.
+    return {
+        "has_signature": bool(row.urlfirma and row.clave),
+        "file_url": row.urlfirma,
+        "path": path,
+        "path_exists": bool(path and os.path.exists(path)),
+        "not_after": row.cert_not_after,
+        "cert_ruc": None,
+    }
+
+
+def _profile_key(company_name: str) -> str:
+    # Una llave por compania (no un hash) para que cada perfil tenga su propio vencimiento.
+    return f"{CERT_PROFILE_CACHE_KEY}:{company_name}"
+
+
+def get_cert_profile(company_name: str) -> dict:
+    if not company_name:
+        return {}
+    cache = frappe.cache()
+    profile = cache.get_value(_profile_key(company_name))
+    if profile is None:
+        profile = _load_cert_profile(company_name)
+        cache.set_value(_profile_key(company_name), profile, expires_in_sec=CERT_PROFILE_TTL)
+    return profile or {}
+
+
+def _clear_profile(company_name: str | None):
+    cache = frappe.cache()
+    if company_name:
+        cache.delete_value(_profile_key(company_name))
+    else:
+        cache.delete_keys(f"{CERT_PROFILE_CACHE_KEY}:")
+
+
+def clear_cert_profile(company_name: str | None = None):
+    """
+    Invalida ya y de nuevo al confirmar: una lectura concurrente que recargue el perfil
+    desde la fila aun sin confirmar (p.ej. has_signature=False) no queda en cache.
+    """
+    cache = frappe.cache()
+    _clear_profile(company_name)
+    if company_name:
+        cache.hdel(CERT_ANALYSIS_CACHE_KEY, company_name)
+    else:
+        cache.delete_value(CERT_ANALYSIS_CACHE_KEY)
+    frappe.db.after_commit.add(partial(_clear_profile, company_name))
+
+
+def _store_profile_from_analysis(company_name: str, info: dict):
+    profile = _load_cert_profile(company_name)
+    profile["cert_ruc"] = info.get("subject_id") or None
+    profile["not_after"] = info.get("not_after") or profile["not_after"]
+    frappe.cache().set_value(_profile_key(company_name), profile, expires_in_sec=CERT_PROFILE_TTL)
+
+
+def set_cert_profile_from_analysis(company_name: str, info: dict):
+    """Guarda, tras el commit, el perfil con los datos ya extraidos del .p12 (RUC y vencimiento)."""
+    frappe.db.after_commit.add(partial(_store_profile_from_analysis, company_name, dict(info)))
+
+
+def certificate_is_valid(company_name: str) -> bool:
+    profile = get_cert_profile(company_name)
+    if not (profile.get("has_signature") and profile.get("not_after")):
+        return False
+    return now_datetime() <= get_datetime(profile["not_after"])
+
+
+def _analysis_digest(file_url: str, password: str | None) -> str:
+    # HMAC con la llave del sitio: en redis no queda nada derivable de la clave sin ella.
+    message = f"{file_url}\0{password or ''}".encode()
+    return hmac.new(get_encryption_key().encode(), message, hashlib.sha256).hexdigest()
+
+
+def get_cached_analysis(company_name: str, file_url: str, password: str | None) -> dict | None:
+    """Resultado de analyze_company_firma para el mismo archivo y clave, si ya se calculo."""
+    cached = frappe.cache().hget(CERT_ANALYSIS_CACHE_KEY, company_name)
+    if not cached or cached.get("digest") != _analysis_digest(file_url, password):
+        return None
+    return dict(cached["info"])
+
+
+def cache_analysis(company_name: str, file_url: str, password: str | None, info: dict):
+    frappe.cache().hset(
+        CERT_ANALYSIS_CACHE_KEY,
+        company_name,
+        {"digest": _analysis_digest(file_url, password), "info": dict(info)},
+    )
@@ -0,0 +1,72 @@
+"""
+Cliente HTTP compartido para el microservicio de facturacion / SRI.
+
+Una sola requests.Session por proceso (pool de conexiones + keep-alive), asi cada
+emision o consulta de estado reutiliza la conexion TCP/TLS en vez de abrir una nueva.
+
+site_config (opcionales):
+  einvoice_http_pool_size        conexiones por host en el pool (default 10)
+  einvoice_http_connect_timeout  segundos para conectar (default 5)
+"""
+from __future__ import annotations
+
+import os
+import threading
+from typing import Any, Optional, Tuple, Union
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def _conf_number(key: str, default, cast=int):
+    value = (frappe.conf or {}).get(key)
+    try:
+        return cast(value) if value not in (None, "") else default
+    except (TypeError, ValueError):
+        return default
+
+
+def _build_session() -> requests.Session:
+    pool_size = _conf_number("einvoice_http_pool_size", DEFAULT_POOL_SIZE)
+    # Sin reintentos automaticos: un POST de emision no es idempotente.
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_http_session() -> requests.Session:
+    """Session del proceso; se recrea tras un fork (workers RQ) para no compartir sockets."""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def http_timeout(read_timeout: Union[int, float, Tuple, None]) -> Tuple[float, float]:
+    """(connect, read): conectar falla rapido aunque la respuesta pueda tardar."""
+    if isinstance(read_timeout, tuple):
+        return read_timeout
+    connect = _conf_number("einvoice_http_connect_timeout", DEFAULT_CONNECT_TIMEOUT, cast=float)
+    return (connect, float(read_timeout or 60))
+
+
+def http_post(url: str, *, timeout: Union[int, float, Tuple, None] = 60, **kwargs: Any) -> requests.Response:
+    return get_http_session().post(url, timeout=http_timeout(timeout), **kwargs)
+
+
+def http_get(url: str, *, timeout: Union[int, float, Tuple, None] = 45, **kwargs: Any) -> requests.Response:
+    return get_http_session().get(url, timeout=http_timeout(timeout), **kwargs)
@@ -3,12 +3,15 @@ from __future__ import annotations
 import os
 import json
 import hashlib
-import requests
 import frappe
+from frappe.utils.caching import request_cache
 
 from typing import Any, Dict, Optional, Tuple
 from requests.exceptions import HTTPError, Timeout, ConnectionError
 
+from restaurante_app.facturacion_bmarc.api.cert_profile import clear_cert_profile, get_cert_profile, resolve_fs_path
+from restaurante_app.facturacion_bmarc.api.http_client import http_get, http_post
+
 # Utils nuevos (los que me dijiste que moviste a la carpeta nueva)
 from restaurante_app.facturacion_bmarc.api.utils import (
     to_decimal, money, obtener_tax_value, map_codigo_porcentaje,
@@ -38,7 +41,7 @@ def _post_api(path: str, payload: Dict[str, Any], timeout: int = 90) -> Dict[str
     headers = {"Content-Type": "application/json"}
 
     try:
-        resp = requests.post(api_url, json=payload, headers=headers, timeout=timeout)
+        resp = http_post(api_url, json=payload, headers=headers, timeout=timeout)
 
         # 400 explícito: parsear y mostrar message / issues
         if resp.status_code == 400:
@@ -84,60 +87,59 @@ def _post_api(path: str, payload: Dict[str, Any], timeout: int = 90) -> Dict[str
 # Data mappers (Sales Invoice -> payload canónico)
 # ======================================================
 
+# Campos que usan los payloads: se leen en una sola consulta por documento.
+COMPANY_SNAPSHOT_FIELDS = [
+    "name", "businessname", "ruc", "address", "ambiente",
+    "establishmentcode", "emissionpoint", "obligado_a_llevar_contabilidad",
+    "urlfirma", "clave", "cert_not_after",
+    "invoiceseq_prod", "invoiceseq_pruebas", "ncseq_prod", "ncseq_pruebas",
+]
+CUSTOMER_SNAPSHOT_FIELDS = ["nombre", "num_identificacion", "tipo_identificacion", "direccion", "correo"]
+
+
+@request_cache
 def _get_company(company_name: str):
-    return frappe.get_doc("Company", company_name)
+    """
+    Snapshot (frappe._dict) de Company para armar payloads; memorizado por request/job.
+    No modificarlo: lo comparten todas las llamadas del mismo request.
+    """
+    company = frappe.db.get_value("Company", company_name, COMPANY_SNAPSHOT_FIELDS, as_dict=True)
+    if not company:
+        frappe.throw(f"No existe la compañía {company_name}")
+    return company
+
+@request_cache
+def _get_customer_snapshot(customer_name: str):
+    return frappe.db.get_value("Cliente", customer_name, CUSTOMER_SNAPSHOT_FIELDS, as_dict=True) or frappe._dict()
 
 def _get_customer_fields(customer_name: str) -> Tuple[str, str, str]:
     """
     Devuelve (idType, id, name) para el comprador a partir del DocType Cliente.
     Fallbacks inteligentes si faltan datos.
     """
-    # Ajusta estos nombres de campos si en tu "Cliente" se llaman distinto
-    nombre = frappe.db.get_value("Cliente", customer_name, "nombre") or customer_name
-    ident = frappe.db.get_value("Cliente", customer_name, "num_identificacion") or "9999999999999"
-    tipo  = frappe.db.get_value("Cliente", customer_name, "tipo_identificacion") or "06"  # pasaporte por defecto
+    customer = _get_customer_snapshot(customer_name)
+    nombre = customer.nombre or customer_name
+    ident = customer.num_identificacion or "9999999999999"
+    tipo  = customer.tipo_identificacion or "06"  # pasaporte por defecto
 
     # Normaliza: idType debe ser 2 chars (SRI)
     id_type = str(tipo)[:2] if len(str(tipo)) >= 2 else "06"
     return (id_type, ident, nombre)
 
 def _get_customer_address_email(customer_name: str) -> Tuple[Optional[str], Optional[str]]:
-    addr = frappe.db.get_value("Cliente", customer_name, "direccion")
-    email = frappe.db.get_value("Cliente", customer_name, "correo")
-    return (addr, email)
+    customer = _get_customer_snapshot(customer_name)
+    return (customer.direccion, customer.correo)
 
 import os
 import frappe
-from frappe.utils import get_site_path
 from typing import Dict
 
-def _resolve_fs_path(path: str) -> str:
-    """
-    Convierte cualquier variante a ruta ABSOLUTA real en disco:
-      - '/files/xxx.p12'              -> <sites>/<site>/public/files/xxx.p12
-      - '/private/files/xxx.p12'      -> <sites>/<site>/private/files/xxx.p12
-      - './algo/xxx.p12' o 'xxx.p12'  -> absoluta desde el cwd -> realpath
-      - ya absoluta                   -> se normaliza con realpath
-    """
-    if not path:
-        return path
-
-    if path.startswith("/files/"):
-        candidate = get_site_path("public", path.lstrip("/"))   # sites/<site>/public/files/...
-    elif path.startswith("/private/files/"):
-        candidate = get_site_path(path.lstrip("/"))             # sites/<site>/private/files/...
-    else:
-        candidate = path                                        # puede ser relativa o absoluta
-
-    # Normaliza a absoluta y resuelve ./, .., symlinks
-    candidate = os.path.realpath(os.path.abspath(candidate))
-    return candidate
-
 def _get_certificate(company) -> Dict[str, str]:
     """
     Devuelve lo que espera tu micro/validador:
       {"p12_base64": "<RUTA ABSOLUTA EN DISCO>", "password": "<clave>"}
     (sí, el nombre p12_base64 es engañoso, pero usamos lo que pide el API)
+    La ruta sale del perfil cacheado de la firma (ver cert_profile).
     """
     p12_src = getattr(company, "urlfirma", None) or os.environ.get("OPEN_FACTURA_CERT_PATH")
     p12_pwd = getattr(company, "clave", None)    or os.environ.get("OPEN_FACTURA_CERT_PASSWORD")
@@ -145,16 +147,17 @@ def _get_certificate(company) -> Dict[str, str]:
     if not p12_src or not p12_pwd:
         frappe.throw("No puede facturar, no tiene registrada la firma electronica")
 
-    abs_path = _resolve_fs_path(p12_src)
-
-    # Garantiza absoluta
-    if not os.path.isabs(abs_path):
-        abs_path = os.path.abspath(abs_path)
-        abs_path = os.path.realpath(abs_path)
+    profile = get_cert_profile(company.name) if getattr(company, "urlfirma", None) else {}
+    if profile.get("path_exists") and profile.get("file_url") == p12_src:
+        return {"p12_base64": profile["path"], "password": p12_pwd}
 
+    abs_path = resolve_fs_path(p12_src)
     if not os.path.exists(abs_path):
         frappe.throw(f"No se encontró el certificado en: {abs_path}")
 
+    # El perfil estaba desactualizado (archivo nuevo o recien copiado): se recalcula la proxima vez.
+    if profile:
+        clear_cert_profile(company.name)
     return {"p12_base64": abs_path, "password": p12_pwd}
 
 
@@ -162,7 +165,7 @@ def _idempotency_key(infoTributaria: Dict[str, Any], infoFactura: Dict[str, Any]
     s = f"{infoTributaria['ruc']}-{infoTributaria['estab']}-{infoTributaria['ptoEmi']}-{infoTributaria['secuencial']}-{infoFactura['fechaEmision']}"
     return hashlib.md5(s.encode("utf-8")).hexdigest()
 
-def _group_totals_by_tax(items_rows) -> Tuple[Dict[int, Dict[str, Any]], str]:
+def _group_totals_by_tax(items_rows, company: Optional[str] = None) -> Tuple[Dict[int, Dict[str, Any]], str]:
     """
     Agrupa por tarifa de IVA (int) -> {base, valor, codigoPorcentaje, tarifa}
     Retorna (mapa, totalSinImpuestos_str)
@@ -178,7 +181,7 @@ def _group_totals_by_tax(items_rows) -> Tuple[Dict[int, Dict[str, Any]], str]:
         if disc > 100: disc = 100.0
 
         base = qty * rate * (1 - disc/100.0)
-        pct  = float(obtener_tax_value(row))  # Decimal->float ok
+        pct  = float(obtener_tax_value(row, company))  # Decimal->float ok
         iva  = base * (pct/100.0)
         total_sin += base
 
@@ -210,7 +213,7 @@ def _build_invoice_payload(inv, company) -> Dict[str, Any]:
     idType, ident, buyer_name = _get_customer_fields(inv.customer)
     buyer_addr, buyer_email   = _get_customer_address_email(inv.customer)
 
-    totals_map, total_sin = _group_totals_by_tax(getattr(inv, "items", []) or [])
+    totals_map, total_sin = _group_totals_by_tax(getattr(inv, "items", []) or [], inv.company_id)
     total_desc = "0.00"
     total_con = [
         {
@@ -241,7 +244,7 @@ def _build_invoice_payload(inv, company) -> Dict[str, Any]:
         "ptoEmi": ptoEmi,
         "secuencial": secuencial,
         "dirMatriz": getattr(company, "address", '') or "Ecuador",
-        "contribuyenteRimpe": getattr(company, "contribuyente_especial", '')
+        "contribuyenteRimpe": company.get("contribuyente_especial") or ''
     }
 
     infoFactura = {
@@ -269,7 +272,7 @@ def _build_invoice_payload(inv, company) -> Dict[str, Any]:
         if disc < 0: disc = 0.0
         if disc > 100: disc = 100.0
         base = qty * rate * (1 - disc/100.0)
-        pct  = int(round(float(obtener_tax_value(row))))
+        pct  = int(round(float(obtener_tax_value(row, inv.company_id))))
         detalles.append({
             "codigoPrincipal": getattr(row, "item_code", "ADHOC"),
             "descripcion": getattr(row, "item_name", None) or getattr(row, "description", None) or getattr(row, "item_code", "Ítem"),
@@ -352,7 +355,7 @@ def _build_credit_note_payload(inv, company, motivo_global: str = "ANULACION") -
     fechaSustento = f"{dd2}/{mm2}/{yy2}"
 
     # Totales
-    totals_map, total_sin = _group_totals_by_tax(getattr(inv, "items", []) or [])
+    totals_map, total_sin = _group_totals_by_tax(getattr(inv, "items", []) or [], inv.company_id)
     iva_total = sum(x["valor"] for x in totals_map.values())
     importe_total = float(f"{(float(total_sin) + iva_total):.2f}")
 
@@ -405,7 +408,7 @@ def _build_credit_note_payload(inv, company, motivo_global: str = "ANULACION") -
         if disc < 0: disc = 0.0
         if disc > 100: disc = 100.0
         base = qty * rate * (1 - disc/100.0)
-        pct  = int(round(float(obtener_tax_value(row))))
+        pct  = int(round(float(obtener_tax_value(row, inv.company_id))))
         detalles.append({
             "codigoPrincipal": getattr(row, "item_code", "ADHOC"),
             "descripcion": getattr(row, "item_name", None) or getattr(row, "description", None) or getattr(row, "item_code", "Ítem"),
@@ -494,7 +497,7 @@ def sri_estado(access_key: str, env: Optional[str] = None) -> Dict[str, Any]:
     url = f"{base}/api/v1/invoices/{access_key}/status?env={env_q}"
 
     try:
-        r = requests.get(url, timeout=45)
+        r = http_get(url, timeout=45)
         r.raise_for_status()
         return r.json()
     except Timeout as e:
@@ -7,6 +7,12 @@ import pytz
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import random
 from typing import Optional, Tuple, Dict
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from functools import partial
+from restaurante_app.restaurante_bmarc.api.tax_catalog import get_tax_rate
 from restaurante_app.restaurante_bmarc.api.sendFactura import enviar_factura_sales_invoice,enviar_factura_nota_credito 
 import base64
 from frappe.utils.file_manager import save_file
@@ -74,9 +80,9 @@ def fmt_pct(pct) -> str:
     return str(int(to_decimal(pct)))
 
 
-def obtener_tax_value(item_row) -> Decimal:
+def obtener_tax_value(item_row, company: Optional[str] = None) -> Decimal:
     """
-    Prefiere item_row.tax_rate; sino, busca en DocType 'taxes' (campo 'value').
+    Prefiere item_row.tax_rate; sino, usa el catálogo cacheado de 'taxes' (campo 'value').
     Soporta row object y dict.
     """
     if getattr(item_row, "tax_rate", None) is not None:
@@ -88,8 +94,7 @@ def obtener_tax_value(item_row) -> Decimal:
         tax_name = item_row.get("tax")
     if not tax_name:
         return Decimal("0")
-    val = frappe.get_value("taxes", tax_name, "value")
-    return to_decimal(val, Decimal("0"))
+    return to_decimal(get_tax_rate(tax_name, company), Decimal("0"))
 
 
 # =========================
@@ -194,41 +199,155 @@ def obtener_env(company) -> str:
 # =========================
 # Secuenciales (seguros)
 # =========================
+# Contador propio por (compania, estab, ptoemi, ambiente, tipo) en `tabSecuencia SRI`.
+# Cada proceso reserva un bloque de numeros con un UPDATE atomico y los entrega desde
+# memoria, asi las emisiones no se serializan sobre la fila de Company.
+# La reserva va por una conexion propia: confirmarla no confirma la transaccion de la
+# request (p.ej. una factura a medio crear).
+# `epoch` sube en cada reset; un bloque de otra epoca se descarta antes de usarse.
+# Los campos de secuencia de Company solo siembran la fila; editarlos la reinicia (Company.on_update).
+# site_config: sri_sequence_block_size (default 1 = numeracion en orden y sin huecos; con bloques
+# mayores cada worker numera desde su bloque y lo que no use al reiniciarse queda como hueco).
+
+SEQUENCE_DOCTYPE = "Secuencia SRI"
+SEQUENCE_SEED_FIELDS = {
+    "invoice": ("invoiceseq_prod", "invoiceseq_pruebas"),
+    "nc": ("ncseq_prod", "ncseq_pruebas"),
+}
+SEQUENCE_DOCTYPES = {"invoice": "Sales Invoice", "nc": "Credit Note"}
+DEFAULT_SEQUENCE_BLOCK_SIZE = 1
+SEQUENCE_EPOCH_CACHE_KEY = "sri_sequence_epoch"
+
+# {name: [pid, siguiente, fin_exclusivo, epoch]} bloques reservados por este proceso
+_sequence_blocks: Dict[str, list] = {}
+_sequence_lock = threading.Lock()
+
+
+def _sequence_block_size() -> int:
+    return max(cint(frappe.conf.get("sri_sequence_block_size") or DEFAULT_SEQUENCE_BLOCK_SIZE), 1)
+
+
+def _sequence_context(company, tipo: str, estab=None, ptoemi=None) -> Dict[str, str]:
+    if isinstance(company, str):
+        company = frappe.get_cached_doc("Company", company)
+    estab = str(estab or getattr(company, "establishmentcode", None) or "001").zfill(3)
+    ptoemi = str(ptoemi or getattr(company, "emissionpoint", None) or "001").zfill(3)
+    ambiente = obtener_ambiente(company)
+    tipo = "nc" if tipo == "nc" else "invoice"
+    field_prod, field_test = SEQUENCE_SEED_FIELDS[tipo]
+    return {
+        "name": hashlib.sha1(f"{company.name}|{estab}|{ptoemi}|{ambiente}|{tipo}".encode()).hexdigest(),
+        "company": company.name,
+        "estab": estab,
+        "ptoemi": ptoemi,
+        "ambiente": ambiente,
+        "tipo": tipo,
+        # Contador anterior de Company: punto de partida de la secuencia nueva
+        "seed": int(getattr(company, field_prod if ambiente == "2" else field_test, None) or 1),
+    }
 
-def _reserve_seq_atomic(company_name: str, field_prod: str, field_test: str) -> int:
+
+@contextmanager
+def _sequence_db():
+    """Conexion aparte para reservar/resetear secuencias sin tocar la transaccion en curso."""
+    from frappe.database import get_db
+
+    db = get_db(
+        socket=frappe.conf.db_socket,
+        host=frappe.conf.db_host,
+        port=frappe.conf.db_port,
+        user=frappe.conf.db_user or frappe.conf.db_name,
+        password=frappe.conf.db_password,
+        cur_db_name=frappe.conf.db_name,
+    )
+    try:
+        yield db
+        db.sql("commit")
+    except Exception:
+        db.sql("rollback")
+        raise
+    finally:
+        db.close()
+
+
+def _ensure_sequence_row(ctx: Dict[str, str], db=None):
+    db = db or frappe.db
+    now = frappe.utils.now_datetime()
+    db.sql(
+        f"""
+        INSERT IGNORE INTO `tab{SEQUENCE_DOCTYPE}`
+            (name, creation, modified, owner, modified_by, docstatus, idx,
+             company_id, estab, ptoemi, ambiente, document_type, start_value, next_value)
+        VALUES (%s, %s, %s, %s, %s, 0, 0, %s, %s, %s, %s, %s, %s, %s)
+        """,
+        (
+            ctx["name"], now, now, frappe.session.user, frappe.session.user,
+            ctx["company"], ctx["estab"], ctx["ptoemi"], ctx["ambiente"], ctx["tipo"],
+            ctx["seed"], ctx["seed"],
+        ),
+    )
+
+
+def _allocate_sequence_block(ctx: Dict[str, str], size: int) -> Tuple[int, int, int]:
     """
-    Reserva (SELECT ... FOR UPDATE) el siguiente secuencial según ambiente.
-    Retorna el valor ANTERIOR (el que se usa) y deja incrementado en BD.
+    Reserva [inicio, fin) con un solo UPDATE (LAST_INSERT_ID devuelve el valor nuevo).
+    Se confirma de inmediato en su propia conexion: el bloque ya entregado no vuelve
+    atras con un rollback y la transaccion del llamador queda intacta.
     """
-    company = frappe.get_doc("Company", company_name)
-    is_prod = (obtener_ambiente(company) == "2")
-
-    if is_prod:
-        row = frappe.db.sql(
-            f"SELECT `{field_prod}` AS val FROM `tabCompany` WHERE name=%s FOR UPDATE",
-            company_name, as_dict=True
-        )[0]
-        actual = int(row.get("val") or 1)
-        siguiente = actual + 1
-        frappe.db.sql(
-            f"UPDATE `tabCompany` SET `{field_prod}`=%s WHERE name=%s",
-            (siguiente, company_name)
-        )
-    else:
-        row = frappe.db.sql(
-            f"SELECT `{field_test}` AS val FROM `tabCompany` WHERE name=%s FOR UPDATE",
-            company_name, as_dict=True
-        )[0]
-        actual = int(row.get("val") or 1)
-        siguiente = actual + 1
-        frappe.db.sql(
-            f"UPDATE `tabCompany` SET `{field_test}`=%s WHERE name=%s",
-            (siguiente, company_name)
+    with _sequence_db() as db:
+        _ensure_sequence_row(ctx, db)
+        db.sql(
+            f"""
+            UPDATE `tab{SEQUENCE_DOCTYPE}`
+            SET next_value = LAST_INSERT_ID(next_value + %s), modified = %s
+            WHERE name = %s
+            """,
+            (size, frappe.utils.now_datetime(), ctx["name"]),
         )
+        end = int(db.sql("SELECT LAST_INSERT_ID()")[0][0])
+        # La fila sigue bloqueada por el UPDATE: epoch corresponde a este bloque.
+        epoch = cint(db.sql(f"SELECT epoch FROM `tab{SEQUENCE_DOCTYPE}` WHERE name = %s", ctx["name"])[0][0])
+    return end - size, end, epoch
+
+
+def _read_sequence_epoch(name: str) -> int:
+    # Conexion aparte: la snapshot de la transaccion en curso podria ser anterior al reset.
+    with _sequence_db() as db:
+        row = db.sql(f"SELECT epoch FROM `tab{SEQUENCE_DOCTYPE}` WHERE name = %s", name)
+    return cint(row[0][0]) if row else 0
+
+
+def _current_sequence_epoch(name: str) -> int:
+    """Epoch vigente; se lee de redis y solo se consulta la BD si no esta en cache."""
+    return cint(
+        frappe.cache().hget(SEQUENCE_EPOCH_CACHE_KEY, name, generator=lambda: _read_sequence_epoch(name))
+    )
+
+
+def reserve_sequence(company, tipo: str = "invoice", estab=None, ptoemi=None) -> int:
+    """Siguiente secuencial para el punto de emision; solo toca la BD al agotar el bloque."""
+    ctx = _sequence_context(company, tipo, estab, ptoemi)
+    pid = os.getpid()
+    with _sequence_lock:
+        block = _sequence_blocks.get(ctx["name"])
+        # Tras un fork (workers RQ) el bloque del padre no se reutiliza; tras un
+        # reset (en cualquier proceso) tampoco el de la epoca anterior.
+        if (
+            not block
+            or block[0] != pid
+            or block[1] >= block[2]
+            or block[3] != _current_sequence_epoch(ctx["name"])
+        ):
+            start, end, epoch = _allocate_sequence_block(ctx, _sequence_block_size())
+            block = _sequence_blocks[ctx["name"]] = [pid, start, end, epoch]
+        value = block[1]
+        block[1] += 1
+    return value
 
-    frappe.db.commit()
-    frappe.clear_document_cache("Company", company_name)
-    return actual
+
+def _reserve_seq_atomic(company_name: str, field_prod: str, field_test: str) -> int:
+    tipo = "nc" if field_prod == SEQUENCE_SEED_FIELDS["nc"][0] else "invoice"
+    return reserve_sequence(company_name, tipo)
 
 def obtener_y_actualizar_secuencial(company_name: str) -> str:
     actual = _reserve_seq_atomic(company_name, "invoiceseq_prod", "invoiceseq_pruebas")
@@ -246,21 +365,96 @@ def reservar_secuencial_nc(company_name: str) -> str:
     return obtener_y_actualizar_secuencial_nota_credito(company_name)
 
 def peek_secuencial(company_name: str) -> dict:
-    company = frappe.get_doc("Company", company_name)
-    is_prod = (obtener_ambiente(company) == "2")
-    if is_prod:
-        val = frappe.db.get_value("Company", company_name, "invoiceseq_prod") or 1
-    else:
-        val = frappe.db.get_value("Company", company_name, "invoiceseq_pruebas") or 1
-    return {"ambiente": "PRODUCCION" if is_prod else "PRUEBAS", "proximo": int(val)}
-
-def reset_secuencial(company_name: str, nuevo_valor: int):
-    company = frappe.get_doc("Company", company_name)
-    is_prod = (obtener_ambiente(company) == "2")
-    if is_prod:
-        frappe.db.set_value("Company", company_name, "invoiceseq_prod", int(nuevo_valor))
-    else:
-        frappe.db.set_value("Company", company_name, "invoiceseq_pruebas", int(nuevo_valor))
+    ctx = _sequence_context(company_name, "invoice")
+    val = frappe.db.get_value(SEQUENCE_DOCTYPE, ctx["name"], "next_value") or ctx["seed"]
+    return {"ambiente": "PRODUCCION" if ctx["ambiente"] == "2" else "PRUEBAS", "proximo": int(val)}
+
+def reset_secuencial(company_name: str, nuevo_valor: int, tipo: str = "invoice"):
+    ctx = _sequence_context(company_name, tipo)
+    field_prod, field_test = SEQUENCE_SEED_FIELDS[ctx["tipo"]]
+    frappe.db.set_value("Company", company_name, field_prod if ctx["ambiente"] == "2" else field_test, int(nuevo_valor))
+    _reset_sequence_row(ctx, int(nuevo_valor))
+
+
+def sync_sequences_from_company(company):
+    """
+    Company.on_update: un secuencial editado (formulario, registro) reinicia su Secuencia SRI
+    tras el commit, sube `epoch` y los bloques en memoria de todos los procesos se descartan.
+    """
+    for tipo, (field_prod, field_test) in SEQUENCE_SEED_FIELDS.items():
+        ctx = _sequence_context(company, tipo)
+        field = field_prod if ctx["ambiente"] == "2" else field_test
+        if cint(company.get(field)) > 0 and company.has_value_changed(field):
+            frappe.db.after_commit.add(partial(_reset_sequence_row, ctx, cint(company.get(field))))
+
+
+def _reset_sequence_row(ctx: Dict[str, str], nuevo_valor: int):
+    with _sequence_db() as db:
+        _ensure_sequence_row(ctx, db)
+        db.sql(
+            f"""
+            UPDATE `tab{SEQUENCE_DOCTYPE}`
+            SET next_value = %s, epoch = epoch + 1, modified = %s
+            WHERE name = %s
+            """,
+            (nuevo_valor, frappe.utils.now_datetime(), ctx["name"]),
+        )
+        epoch = cint(db.sql(f"SELECT epoch FROM `tab{SEQUENCE_DOCTYPE}` WHERE name = %s", ctx["name"])[0][0])
+    # Los demas procesos ven la epoca nueva en su siguiente reserve_sequence.
+    frappe.cache().hset(SEQUENCE_EPOCH_CACHE_KEY, ctx["name"], epoch)
+    _sequence_blocks.pop(ctx["name"], None)
+
+
+def audit_sequence_gaps(company_name: str, tipo: str = "invoice", estab=None, ptoemi=None, max_ranges: int = 200) -> dict:
+    """
+    Numeros reservados en la secuencia que no aparecen en ningun documento emitido.
+    Incluye los bloques que un proceso vivo aun no termina de usar.
+    Uso: bench execute restaurante_app.facturacion_bmarc.api.utils.audit_sequence_gaps --args "['<company>']"
+    """
+    ctx = _sequence_context(company_name, tipo, estab, ptoemi)
+    row = frappe.db.get_value(SEQUENCE_DOCTYPE, ctx["name"], ["start_value", "next_value"], as_dict=True)
+    if not row:
+        return {"start": None, "next": None, "issued": 0, "missing": 0, "ranges": []}
+
+    start, end = int(row.start_value or 1), int(row.next_value or 1)
+    used = {
+        int(n)
+        for (n,) in frappe.db.sql(
+            f"""
+            SELECT CAST(secuencial AS UNSIGNED)
+            FROM `tab{SEQUENCE_DOCTYPES[ctx['tipo']]}`
+            WHERE company_id = %(company)s
+              AND estab = %(estab)s
+              AND ptoemi = %(ptoemi)s
+              AND environment = %(environment)s
+              AND CAST(secuencial AS UNSIGNED) >= %(start)s
+              AND CAST(secuencial AS UNSIGNED) < %(end)s
+            """,
+            {
+                "company": ctx["company"],
+                "estab": ctx["estab"],
+                "ptoemi": ctx["ptoemi"],
+                "environment": "Producción" if ctx["ambiente"] == "2" else "Pruebas",
+                "start": start,
+                "end": end,
+            },
+        )
+    }
+
+    ranges, missing = [], 0
+    gap_start = None
+    for n in range(start, end + 1):
+        if n < end and n not in used:
+            if gap_start is None:
+                gap_start = n
+            continue
+        if gap_start is not None:
+            missing += n - gap_start
+            if len(ranges) < max_ranges:
+                ranges.append([gap_start, n - 1])
+            gap_start = None
+
+    return {"start": start, "next": end, "issued": len(used), "missing": missing, "ranges": ranges}
 
 
 # =========================
@@ -281,10 +475,7 @@ def resolve_serie_y_secuencial(company, inv=None, tipo: str = None) -> Tuple[str
     # secuencial
     sec = getattr(inv, "secuencial", None)
     if not sec:
-        if tipo == "nc":
-            sec = reservar_secuencial_nc(company.name)
-        else:
-            sec = reservar_secuencial_invoice(company.name)
+        sec = reserve_sequence(company, "nc" if tipo == "nc" else "invoice", estab, ptoemi)
 
     serie6 = f"{str(estab).zfill(3)}{str(ptoemi).zfill(3)}"
     return str(estab).zfill(3), str(ptoemi).zfill(3), str(sec).zfill(9), serie6
@@ -341,8 +532,9 @@ def persist_after_emit(inv, api_result: dict, type_document: str):
 
     frappe.log_error("api_result", api_result)
 
+    # Con `modified` al día, get_order_changes ve la autorización del SRI.
     try:
-        inv.db_set(vals, update_modified=False)
+        inv.db_set(vals)
     finally:
         frappe.db.commit()
 
@@ -5,6 +5,13 @@ from frappe.utils import flt
 
 # Ajusta este import a tu helper real
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
+from restaurante_app.restaurante_bmarc.api.pagination import (
+    cached_count,
+    decode_cursor,
+    is_cursor_mode,
+    keyset_filters,
+    next_cursor_from_rows,
+)
 def _safe_customer_info(customer_name: str):
     if not customer_name:
         return {}
@@ -33,7 +40,7 @@ def _safe_customer_info(customer_name: str):
     }
 
 @frappe.whitelist()
-def get_all_credit_notes(limit=10, offset=0):
+def get_all_credit_notes(limit=10, offset=0, cursor=None, use_cursor=0):
     if not frappe.has_permission("Credit Note", "read"):
         frappe.throw(_("No tienes permiso para ver facturas"))
 
@@ -54,14 +61,26 @@ def get_all_credit_notes(limit=10, offset=0):
         # owner suele existir en Credit Note
         filters["owner"] = frappe.session.user
 
-    total_invoices = frappe.db.count("Credit Note", filters=filters)
+    cursor_mode = is_cursor_mode(use_cursor, cursor)
+    or_filters = []
+    order_by = "creation desc"
+    if cursor_mode:
+        # Paginación keyset por (creation, name): total cacheado y sin OFFSET
+        total_invoices = cached_count("Credit Note", filters, lambda: frappe.db.count("Credit Note", filters=filters))
+        keyset, or_filters = keyset_filters("Credit Note", decode_cursor(cursor))
+        filters = [["Credit Note", k, "=", v] for k, v in filters.items()] + keyset
+        offset = 0
+        order_by = "creation desc, name desc"
+    else:
+        total_invoices = frappe.db.count("Credit Note", filters=filters)
 
     inv_rows = frappe.get_all(
         "Credit Note",
         filters=filters,
+        or_filters=or_filters,
         limit=limit,
         start=offset,
-        order_by="creation desc",
+        order_by=order_by,
         fields=[
             "name", "creation", "posting_date",
             "customer", "company_id",
@@ -137,13 +156,16 @@ def get_all_credit_notes(limit=10, offset=0):
             "items": inv_items_by_inv.get(inv.get("name"), []),
         })
 
-    return {
+    response = {
         "data": data,
         "total": total_invoices,
         "limit": limit,
         "offset": offset,
         "filters": {"company_id": company, "scope": "all" if is_manager else "mine"},
     }
+    if cursor_mode:
+        response["next_cursor"] = next_cursor_from_rows(inv_rows, limit)
+    return response
 
 def _build_sri_number(estab: str = None, ptoemi: str = None, secuencial: str = None):
     parts = [p for p in [(estab or "").strip(), (ptoemi or "").strip(), (secuencial or "").strip()] if p]
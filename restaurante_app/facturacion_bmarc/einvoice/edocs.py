@@ -1,9 +1,9 @@
 import os
 import json
-import requests
 import frappe
 from typing import Any, Dict, Optional
 from requests.exceptions import HTTPError, Timeout, ConnectionError
+from restaurante_app.facturacion_bmarc.api.http_client import http_get, http_post
 from restaurante_app.facturacion_bmarc.api.utils import persist_after_emit
  
 # =========================
@@ -32,7 +32,7 @@ def _post_api(path: str, payload: Dict[str, Any], timeout: int = 90) -> Dict[str
     headers = {"Content-Type": "application/json"}
 
     try:
-        resp = requests.post(api_url, json=payload, headers=headers, timeout=timeout)
+        resp = http_post(api_url, json=payload, headers=headers, timeout=timeout)
 
         # 400 explícito: parsear y mostrar message / issues
         if resp.status_code == 400:
@@ -171,7 +171,7 @@ def sri_estado(access_key: str, env: Optional[str] = None) -> Dict[str, Any]:
     url = f"{base}/api/v1/invoices/{access_key}/status?env={env_q}"
 
     try:
-        r = requests.get(url, timeout=45)
+        r = http_get(url, timeout=45)
         r.raise_for_status()
         return r.json()
     except Timeout as e:
@@ -215,7 +215,7 @@ def sri_estado_and_update_data(invoice_name: Optional[str] = None,type: str = No
 
     
     try:
-        r = requests.get(url, timeout=45)
+        r = http_get(url, timeout=45)
         r.raise_for_status()
         resp = r.json()
         frappe.log_error(resp.get("status"), "status")
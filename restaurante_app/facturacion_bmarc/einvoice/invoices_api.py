@@ -5,6 +5,13 @@ from frappe.utils import flt
 
 # Ajusta este import a tu helper real
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
+from restaurante_app.restaurante_bmarc.api.pagination import (
+    cached_count,
+    decode_cursor,
+    is_cursor_mode,
+    keyset_filters,
+    next_cursor_from_rows,
+)
 def _safe_customer_info(customer_name: str):
     if not customer_name:
         return {}
@@ -32,8 +39,17 @@ def _safe_customer_info(customer_name: str):
         "direccion": row.get("direccion") or "",
     }
 
+def _invoice_list_query(filters: dict, cursor_mode: bool = False, cursor_key=None):
+    """(filters, or_filters, order_by) del listado; db_indexes arma el EXPLAIN con lo mismo."""
+    if not cursor_mode:
+        return filters, [], "creation desc"
+    keyset, or_filters = keyset_filters("Sales Invoice", cursor_key)
+    filters = [["Sales Invoice", k, "=", v] for k, v in filters.items()] + keyset
+    return filters, or_filters, "creation desc, name desc"
+
+
 @frappe.whitelist()
-def get_all_invoices(limit=10, offset=0):
+def get_all_invoices(limit=10, offset=0, cursor=None, use_cursor=0):
     if not frappe.has_permission("Sales Invoice", "read"):
         frappe.throw(_("No tienes permiso para ver facturas"))
 
@@ -54,14 +70,23 @@ def get_all_invoices(limit=10, offset=0):
         # owner suele existir en Sales Invoice
         filters["owner"] = frappe.session.user
 
-    total_invoices = frappe.db.count("Sales Invoice", filters=filters)
+    cursor_mode = is_cursor_mode(use_cursor, cursor)
+    if cursor_mode:
+        # Paginación keyset por (creation, name): total cacheado y sin OFFSET
+        total_invoices = cached_count("Sales Invoice", filters, lambda: frappe.db.count("Sales Invoice", filters=filters))
+        filters, or_filters, order_by = _invoice_list_query(filters, True, decode_cursor(cursor))
+        offset = 0
+    else:
+        total_invoices = frappe.db.count("Sales Invoice", filters=filters)
+        filters, or_filters, order_by = _invoice_list_query(filters)
 
     inv_rows = frappe.get_all(
         "Sales Invoice",
         filters=filters,
+        or_filters=or_filters,
         limit=limit,
         start=offset,
-        order_by="creation desc",
+        order_by=order_by,
         fields=[
             "name", "creation", "posting_date",
             "customer", "company_id",
@@ -130,13 +155,16 @@ def get_all_invoices(limit=10, offset=0):
             "items": inv_items_by_inv.get(inv.get("name"), []),
         })
 
-    return {
+    response = {
         "data": data,
         "total": total_invoices,
         "limit": limit,
         "offset": offset,
         "filters": {"company_id": company, "scope": "all" if is_manager else "mine"},
     }
+    if cursor_mode:
+        response["next_cursor"] = next_cursor_from_rows(inv_rows, limit)
+    return response
 
 
 
@@ -0,0 +1,154 @@
+"""
+Barrido programado del estado SRI de facturas y notas de credito pendientes.
+
+Reemplaza el job por documento (enqueue_status_update): un solo job del scheduler
+toma los documentos EN PROCESO/BORRADOR con clave de acceso cuya proxima consulta
+ya vencio, los consulta en paralelo acotado y guarda los resultados en bloque.
+Cada documento espera cada vez mas entre consultas (backoff exponencial).
+Usa sus propios campos (sri_check_attempts / sri_check_error): attempts y
+last_error_message siguen siendo el historial de la emision.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+
+from restaurante_app.facturacion_bmarc.api.http_client import get_http_session, http_timeout
+from restaurante_app.facturacion_bmarc.api.utils import persist_after_emit
+from restaurante_app.facturacion_bmarc.einvoice.edocs import _get_api_base
+from restaurante_app.inventarios_bmarc.api.stock import bulk_update_by_name
+
+STATUS_DOCTYPES = {"Sales Invoice": "factura", "Credit Note": "nota_credito"}
+PENDING_STATUSES = ("EN PROCESO", "BORRADOR")
+SWEEP_BATCH_SIZE = 100
+SWEEP_CONCURRENCY = 5
+SWEEP_READ_TIMEOUT = 20
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+SWEEP_LOCK_KEY = "restaurante_app:sri_status_sweep"
+SWEEP_LOCK_TTL = 600
+SWEEP_JOB_ID = "sri-status-sweep"
+
+
+def _backoff_seconds(attempts: int) -> int:
+    return min(BACKOFF_BASE_SECONDS * (2 ** max(attempts - 1, 0)), BACKOFF_MAX_SECONDS)
+
+
+def schedule_status_check(invoice_name: str, type_document: str = "factura"):
+    """
+    Deja el documento en la cola del barrido (en vez de encolar un job por factura) y pide
+    un barrido inmediato: la primera consulta ocurre apenas se confirma la emision, como
+    hacia el job por documento. Los reintentos siguen el backoff (cron cada minuto).
+    """
+    doctype = "Sales Invoice" if type_document == "factura" else "Credit Note"
+    frappe.db.set_value(
+        doctype,
+        invoice_name,
+        {"sri_check_attempts": 0, "sri_check_error": None, "sri_next_check": now_datetime()},
+        update_modified=False,
+    )
+    # Un solo job en cola aunque se emitan varias facturas seguidas.
+    frappe.enqueue(
+        "restaurante_app.facturacion_bmarc.einvoice.status_sweeper.sweep_sri_status",
+        queue="short",
+        job_id=SWEEP_JOB_ID,
+        deduplicate=True,
+        enqueue_after_commit=True,
+    )
+
+
+def _due_documents(limit: int) -> List[Dict[str, Any]]:
+    now = now_datetime()
+    due: List[Dict[str, Any]] = []
+    for doctype, type_document in STATUS_DOCTYPES.items():
+        remaining = limit - len(due)
+        if remaining <= 0:
+            break
+        rows = frappe.db.sql(
+            f"""
+            SELECT name, access_key, environment, sri_check_attempts
+            FROM `tab{doctype}`
+            WHERE status IN %(statuses)s
+              AND access_key REGEXP '^[0-9]{{49}}$'
+              AND (sri_next_check IS NULL OR sri_next_check <= %(now)s)
+            ORDER BY sri_next_check
+            LIMIT {int(remaining)}
+            """,
+            {"statuses": PENDING_STATUSES, "now": now},
+            as_dict=True,
+        )
+        for row in rows:
+            row["doctype"] = doctype
+            row["type_document"] = type_document
+        due.extend(rows)
+    return due
+
+
+def _fetch_status(session, base: str, timeout, doc: Dict[str, Any]) -> Tuple[Optional[Dict], Optional[str]]:
+    # Corre en un hilo: solo HTTP, nada de frappe.db / frappe.local.
+    env_q = "prod" if doc["environment"] == "Producción" else "test"
+    url = f"{base}/api/v1/invoices/{doc['access_key']}/status?env={env_q}"
+    try:
+        resp = session.get(url, timeout=timeout)
+        resp.raise_for_status()
+        return resp.json(), None
+    except Exception as e:
+        return None, str(e)[:500]
+
+
+def sweep_sri_status(limit: int = SWEEP_BATCH_SIZE):
+    """
+    Job del scheduler (cron cada minuto) y de schedule_status_check.
+    Un candado en redis evita dos barridos simultaneos.
+    Uso manual: bench execute restaurante_app.facturacion_bmarc.einvoice.status_sweeper.sweep_sri_status
+    """
+    cache = frappe.cache()
+    lock_key = cache.make_key(SWEEP_LOCK_KEY)
+    if not cache.set(lock_key, 1, nx=True, ex=SWEEP_LOCK_TTL):
+        return
+    try:
+        _sweep(limit)
+    finally:
+        cache.delete(lock_key)
+
+
+def _sweep(limit: int):
+    docs = _due_documents(limit)
+    if not docs:
+        return
+
+    # Session y timeouts se resuelven aqui: los hilos no tienen contexto de frappe.
+    session = get_http_session()
+    timeout = http_timeout(SWEEP_READ_TIMEOUT)
+    base = _get_api_base()
+    with ThreadPoolExecutor(max_workers=SWEEP_CONCURRENCY) as pool:
+        results = list(pool.map(lambda doc: _fetch_status(session, base, timeout, doc), docs))
+
+    now = now_datetime()
+    updates: Dict[str, Dict[str, Dict[str, Any]]] = {}
+    resolved: List[Tuple[Dict[str, Any], Dict]] = []
+    for doc, (result, error) in zip(docs, results):
+        attempts = cint(doc.sri_check_attempts) + 1
+        values = {"sri_check_attempts": attempts}
+        status = str((result or {}).get("status") or "").upper()
+        if result is not None and status and status != "PROCESSING":
+            values["sri_next_check"] = None
+            resolved.append((doc, result))
+        else:
+            values["sri_next_check"] = add_to_date(now, seconds=_backoff_seconds(attempts))
+            if error:
+                values["sri_check_error"] = error
+        updates.setdefault(doc["doctype"], {})[doc.name] = values
+
+    for doctype, values_by_name in updates.items():
+        bulk_update_by_name(doctype, values_by_name)
+    frappe.db.commit()
+
+    # Solo los que cambiaron de estado pasan por persist_after_emit (XML, correo).
+    for doc, result in resolved:
+        try:
+            persist_after_emit(frappe.get_doc(doc["doctype"], doc.name), result, doc["type_document"])
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), f"Barrido SRI: no se pudo guardar {doc['doctype']} {doc.name}")
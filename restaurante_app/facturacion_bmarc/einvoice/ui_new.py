@@ -3,7 +3,7 @@ import random
 from decimal import Decimal, ROUND_HALF_UP
 from typing import Optional
 
-from restaurante_app.facturacion_bmarc.api.utils import persist_after_emit,_is_consumidor_final
+from restaurante_app.facturacion_bmarc.api.utils import persist_after_emit,_is_consumidor_final,peek_secuencial
 import frappe
 from frappe import _
 
@@ -15,6 +15,7 @@ from restaurante_app.facturacion_bmarc.api.open_factura_client import (
     
 )
 from restaurante_app.facturacion_bmarc.einvoice.edocs import sri_estado_and_update_data
+from restaurante_app.facturacion_bmarc.einvoice.status_sweeper import schedule_status_check
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
 from restaurante_app.facturacion_bmarc.einvoice.utils import puede_facturar
 
@@ -147,12 +148,8 @@ def _build_canonical_invoice_payload(inv) -> dict:
     # Secuencial: usa el guardado si existe, si no lo generas aquí (9 dígitos).
     secuencial = getattr(inv, "secuencial", None)
     if not secuencial:
-        # Aquí puedes llamar a tu función real que reserva/incrementa.
-        # Por simplicidad, voy a tomar un número de la secuencia de Company si la tienes,
-        # o un fallback "000000001".
-        current_seq = frappe.db.get_value("Company", company.name,
-                                          "invoiceseq_prod" if company.ambiente=="PRODUCCION" else "invoiceseq_pruebas") or 1
-        secuencial = str(int(current_seq)).zfill(9)
+        # Próximo número de la Secuencia SRI (los campos de Company solo la siembran).
+        secuencial = str(peek_secuencial(company.name)["proximo"]).zfill(9)
         # No incrementamos aquí para evitar duplicar; incrementa cuando confirmes envío.
 
     detalles, totalConImpuestos, totalSinImpuestos, totalDescuento, importeTotal = _calc_totales_y_detalles(inv)
@@ -323,7 +320,7 @@ def _append_invoice_payments(inv, payments):
 
 
 def _mark_sales_invoice_cancelled(invoice_name: str):
-    frappe.db.set_value("Sales Invoice", invoice_name, "status", "ANULADA", update_modified=False)
+    frappe.db.set_value("Sales Invoice", invoice_name, "status", "ANULADA")
     frappe.db.commit()
     frappe.clear_document_cache("Sales Invoice", invoice_name)
 
@@ -340,11 +337,11 @@ def _sync_status_or_enqueue(invoice_name: str, type_document: str, api_result: d
             frappe.get_traceback(),
             f"Error consultando estado SRI para {type_document} {invoice_name}",
         )
-        enqueue_status_update(invoice_name, type_document)
+        schedule_status_check(invoice_name, type_document)
         return api_result
 
     if str(sri_result.get("status") or "").upper() != EInvoiceStatus.AUTHORIZED.value:
-        enqueue_status_update(invoice_name, type_document)
+        schedule_status_check(invoice_name, type_document)
     return sri_result
 
 # ---------------- NEW: endpoints para el front ----------------
@@ -595,16 +592,4 @@ def build_response(invoice_name, result_dict):
         "access_key": result_dict.get("accessKey"),
         "messages": _normalize_messages(result_dict.get("messages")),
         "authorization": result_dict.get("authorization"),
-    }
-
-
-def enqueue_status_update(invoice_name, type_document: str = "factura"):
-    frappe.enqueue(
-        "restaurante_app.facturacion_bmarc.einvoice.edocs.sri_estado_and_update_data",
-        queue="long",
-        job_name=f"einvoice-status-{type_document}-{invoice_name}",
-        enqueue_after_commit=True,
-        timeout=300,
-        invoice_name=invoice_name,
-        type=type_document,
-    )
+    }
@@ -4,7 +4,8 @@ from frappe import _
 from datetime import datetime
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 import random
-from frappe.utils import now_datetime,get_datetime
+from restaurante_app.facturacion_bmarc.api.cert_profile import certificate_is_valid, get_cert_profile
+from restaurante_app.restaurante_bmarc.api.tax_catalog import get_tax_rate
 
 def to_decimal(value, default=Decimal("0")) -> Decimal:
     if value is None: return default
@@ -30,14 +31,13 @@ def map_codigo_porcentaje_v230(pct) -> str:
 def fmt_pct(pct) -> str:
     return str(int(to_decimal(pct)))
 
-def obtener_tax_value(item_row) -> Decimal:
-    """Prefiere tax_rate del ítem de la factura; si no, consulta el DocType 'taxes'."""
+def obtener_tax_value(item_row, company=None) -> Decimal:
+    """Prefiere tax_rate del ítem de la factura; si no, usa el catálogo cacheado de 'taxes'."""
     if getattr(item_row, "tax_rate", None) is not None:
         return to_decimal(item_row.tax_rate, Decimal("0"))
-    tax_name = getattr(item_row, "tax", None) or item_row.get("tax") if isinstance(item_row, dict) else None
+    tax_name = item_row.get("tax") if isinstance(item_row, dict) else getattr(item_row, "tax", None)
     if not tax_name: return Decimal("0")
-    val = frappe.get_value("taxes", tax_name, "value")
-    return to_decimal(val, Decimal("0"))
+    return to_decimal(get_tax_rate(tax_name, company), Decimal("0"))
 
 def calcular_digito_verificador(cadena_48):
     base_maxima, multiplicador, total = 7, 2, 0
@@ -65,25 +65,12 @@ def obtener_ambiente(company) -> str:
     """Devuelve '1' (pruebas) o '2' (producción) para SRI."""
     return "2" if (getattr(company, "ambiente", "") == "PRODUCCION") else "1"
 def puede_facturar(companyID) -> bool:
-    company = frappe.get_doc("Company", companyID)
-    return bool(company.urlfirma and company.clave)
+    # Perfil de firma cacheado: no carga Company en cada emision
+    return bool(get_cert_profile(companyID).get("has_signature"))
 
 
 def validar_fecha_firma(companyID) -> bool:
-    company = frappe.get_doc("Company", companyID)
-
-    # Validar datos básicos
-    if not (company.urlfirma and company.clave and company.cert_not_after):
-        return False
-
-    # Convertir string a datetime
-    fecha_expiracion = get_datetime(company.cert_not_after)
-
-    # Comparar contra fecha actual
-    if now_datetime() > fecha_expiracion:
-        return False
-
-    return True
+    return certificate_is_valid(companyID)
 
 def obtener_y_actualizar_secuencial(company_name: str) -> str:
     """
@@ -58,7 +58,7 @@ def generar_xml_factura_desde_invoice(invoice_name: str) -> str:
         if disc < 0: disc = Decimal("0")
         if disc > 100: disc = Decimal("100")
         line_base = (qty * rate * (Decimal("1") - disc/Decimal("100"))).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        pct = obtener_tax_value(row)
+        pct = obtener_tax_value(row, inv.company_id)
         pct_int = int(pct)
         iva_val = (line_base * pct / Decimal("100")).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
@@ -116,7 +116,7 @@ def generar_xml_factura_desde_invoice(invoice_name: str) -> str:
         if disc < 0: disc = Decimal("0")
         if disc > 100: disc = Decimal("100")
         line_base = (qty * rate * (Decimal("1") - disc/Decimal("100")))
-        pct = obtener_tax_value(row)
+        pct = obtener_tax_value(row, inv.company_id)
         pct_int = int(pct)
         iva_val = (line_base * pct / Decimal("100"))
 
@@ -145,6 +145,13 @@ app_license = "mit"
 # 	}
 # }
 
+doc_events = {
+	"User Permission": {
+		"on_update": "restaurante_app.restaurante_bmarc.api.realtime.clear_company_users_cache",
+		"on_trash": "restaurante_app.restaurante_bmarc.api.realtime.clear_company_users_cache",
+	},
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -166,6 +173,21 @@ app_license = "mit"
 # 	],
 # }
 
+scheduler_events = {
+	"all": [
+		"restaurante_app.inventarios_bmarc.api.stock.process_inventory_outbox",
+	],
+	"cron": {
+		# Cada minuto: "all" corre cada ~4 minutos y anularia el backoff corto del barrido SRI.
+		"* * * * *": [
+			"restaurante_app.facturacion_bmarc.einvoice.status_sweeper.sweep_sri_status",
+		],
+	},
+	"daily": [
+		"restaurante_app.inventarios_bmarc.api.stock_snapshot.snapshot_daily_stock",
+	],
+}
+
 # Testing
 # -------
 
@@ -0,0 +1,113 @@
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+RECIPE_DOCTYPE = "Receta"
+RECIPE_ITEM_DOCTYPE = "Detalle Receta"
+FLAT_BOM_CACHE_KEY = "restaurante_app:flat_bom"
+
+
+def _load_recipes(company_id: str) -> dict[str, dict[str, float]]:
+    """{producto: {ingrediente: cantidad}} de las recetas activas de la compania (una consulta)."""
+    if not frappe.db.table_exists(RECIPE_DOCTYPE):
+        return {}
+
+    rows = frappe.db.sql(
+        f"""
+        SELECT r.product, d.ingredient, d.qty
+        FROM `tab{RECIPE_DOCTYPE}` r
+        JOIN `tab{RECIPE_ITEM_DOCTYPE}` d
+          ON d.parent = r.name AND d.parenttype = %(parenttype)s
+        WHERE r.company_id = %(company_id)s
+          AND COALESCE(r.is_active, 0) = 1
+        """,
+        {"company_id": company_id, "parenttype": RECIPE_DOCTYPE},
+        as_dict=True,
+    )
+    recipes: dict[str, dict[str, float]] = {}
+    for row in rows:
+        recipe = recipes.setdefault(row.product, {})
+        recipe[row.ingredient] = flt(recipe.get(row.ingredient, 0)) + flt(row.qty)
+    return recipes
+
+
+def _flatten_recipes(recipes: dict[str, dict[str, float]]) -> dict[str, dict[str, float]]:
+    """Expande recetas anidadas hasta ingredientes hoja: {producto: {hoja: cantidad por unidad}}."""
+    flat: dict[str, dict[str, float]] = {}
+
+    def expand(product: str, path: frozenset) -> dict[str, float]:
+        if product in flat:
+            return flat[product]
+        out: dict[str, float] = {}
+        for ingredient, qty in recipes[product].items():
+            # Un ciclo (no deberia existir, ver assert_no_recipe_cycle) se trata como hoja.
+            if ingredient in recipes and ingredient not in path:
+                for leaf, leaf_qty in expand(ingredient, path | {ingredient}).items():
+                    out[leaf] = flt(out.get(leaf, 0)) + qty * leaf_qty
+            else:
+                out[ingredient] = flt(out.get(ingredient, 0)) + qty
+        flat[product] = out
+        return out
+
+    for product in recipes:
+        expand(product, frozenset([product]))
+    return flat
+
+
+def get_flat_bom(company_id: str) -> dict[str, dict[str, float]]:
+    """BOM aplanado de la compania, precalculado en cache (se invalida al guardar una Receta)."""
+    if not company_id:
+        return {}
+    return frappe.cache().hget(
+        FLAT_BOM_CACHE_KEY,
+        company_id,
+        generator=lambda: _flatten_recipes(_load_recipes(company_id)),
+    ) or {}
+
+
+def clear_flat_bom_cache(company_id: str | None = None):
+    if company_id:
+        frappe.cache().hdel(FLAT_BOM_CACHE_KEY, company_id)
+    else:
+        frappe.cache().delete_value(FLAT_BOM_CACHE_KEY)
+
+
+def expand_bom_quantities(qty_map: dict[str, float], company_id: str | None) -> dict[str, float]:
+    """
+    Reemplaza cada producto con receta por sus ingredientes hoja.
+    Costo O(lineas x ingredientes): solo lee el BOM aplanado, sin consultas recursivas.
+    """
+    if not qty_map or not company_id:
+        return qty_map
+    flat = get_flat_bom(company_id)
+    if not flat:
+        return qty_map
+
+    expanded: dict[str, float] = {}
+    for product, qty in qty_map.items():
+        recipe = flat.get(product)
+        if not recipe:
+            expanded[product] = flt(expanded.get(product, 0)) + flt(qty)
+            continue
+        for ingredient, per_unit in recipe.items():
+            expanded[ingredient] = flt(expanded.get(ingredient, 0)) + flt(qty) * flt(per_unit)
+    return expanded
+
+
+def assert_no_recipe_cycle(company_id: str, product: str, ingredients: list[str]):
+    recipes = _load_recipes(company_id)
+    recipes[product] = {ingredient: 1 for ingredient in ingredients}
+
+    stack = [(ingredient, (product, ingredient)) for ingredient in ingredients]
+    visited = set()
+    while stack:
+        current, path = stack.pop()
+        if current == product:
+            frappe.throw(
+                _("La receta genera un ciclo: {0}").format(" -> ".join(path))
+            )
+        if current in visited:
+            continue
+        visited.add(current)
+        for ingredient in recipes.get(current, {}):
+            stack.append((ingredient, path + (ingredient,)))
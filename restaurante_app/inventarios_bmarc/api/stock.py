@@ -1,7 +1,10 @@
-﻿import frappe
+﻿import json
+
+import frappe
 from frappe import _
-from frappe.utils import cint, flt
+from frappe.utils import cint, flt, get_datetime, getdate
 
+from restaurante_app.inventarios_bmarc.api.bom import expand_bom_quantities
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
 
 POSITIVE_MOVEMENT_TYPES = {"Entrada", "Reversa Venta", "Devolucion"}
@@ -17,6 +20,9 @@ ALLOWED_MOVEMENT_TYPES = {
 }
 INVENTORY_MOVEMENT_DOCTYPE = "Movimiento de Inventario"
 INVENTORY_MOVEMENT_ITEM_DOCTYPE = "Detalle Movimiento Inventario"
+INVENTORY_OUTBOX_DOCTYPE = "Movimiento Inventario Pendiente"
+INVENTORY_OUTBOX_BATCH = 50
+INVENTORY_OUTBOX_MAX_ATTEMPTS = 5
 
 
 def inventory_doctypes_ready() -> bool:
@@ -65,9 +71,13 @@ def quantity_map_from_rows(rows, product_key: str = "product", qty_key: str = "q
     return _clean_qty_map(qty_map)
 
 
-def build_stock_delta(previous_rows=None, current_rows=None) -> dict[str, float]:
-    previous_qty = quantity_map_from_rows(previous_rows or [])
-    current_qty = quantity_map_from_rows(current_rows or [])
+def build_stock_delta(previous_rows=None, current_rows=None, company_id: str | None = None) -> dict[str, float]:
+    """
+    Diferencia de stock (anterior - actual) por producto.
+    Con company_id, los productos con receta se descuentan como sus ingredientes (BOM aplanado).
+    """
+    previous_qty = expand_bom_quantities(quantity_map_from_rows(previous_rows or []), company_id)
+    current_qty = expand_bom_quantities(quantity_map_from_rows(current_rows or []), company_id)
     product_names = set(previous_qty) | set(current_qty)
     return _clean_qty_map(
         {
@@ -77,6 +87,80 @@ def build_stock_delta(previous_rows=None, current_rows=None) -> dict[str, float]
     )
 
 
+def recorded_stock_quantities(reference_doctype: str, reference_name: str) -> dict[str, float] | None:
+    """
+    Lo que un documento ya movió en el stock, por producto (negativo = descontado):
+    lineas del kardex mas las reservas del outbox que aun no tienen Movimiento.
+    None si el documento no tiene ningun registro (p. ej. una orden anterior al kardex).
+    """
+    if not reference_name or not inventory_doctypes_ready():
+        return None
+
+    rows = frappe.db.sql(
+        f"""
+        SELECT d.product, SUM(d.quantity) AS quantity
+        FROM `tab{INVENTORY_MOVEMENT_DOCTYPE}` m
+        JOIN `tab{INVENTORY_MOVEMENT_ITEM_DOCTYPE}` d
+          ON d.parent = m.name AND d.parenttype = %(parenttype)s
+        WHERE m.reference_doctype = %(reference_doctype)s
+          AND m.reference_name = %(reference_name)s
+        GROUP BY d.product
+        """,
+        {
+            "parenttype": INVENTORY_MOVEMENT_DOCTYPE,
+            "reference_doctype": reference_doctype,
+            "reference_name": reference_name,
+        },
+        as_dict=True,
+    )
+    recorded: dict[str, float] | None = None
+    if rows:
+        recorded = {row.product: flt(row.quantity) for row in rows}
+
+    if frappe.db.table_exists(INVENTORY_OUTBOX_DOCTYPE):
+        pending = frappe.get_all(
+            INVENTORY_OUTBOX_DOCTYPE,
+            filters={
+                "reference_doctype": reference_doctype,
+                "reference_name": reference_name,
+                "status": ["!=", "Procesado"],
+            },
+            pluck="payload",
+        )
+        for payload in pending:
+            recorded = recorded if recorded is not None else {}
+            for item in json.loads(payload or "{}").get("items") or []:
+                recorded[item["product"]] = flt(recorded.get(item["product"], 0)) + flt(item.get("quantity"))
+    return recorded
+
+
+def build_recorded_stock_delta(
+    reference_doctype: str,
+    reference_name: str,
+    current_rows=None,
+    company_id: str | None = None,
+    previous_rows=None,
+) -> dict[str, float]:
+    """
+    Igual que build_stock_delta, pero lo "anterior" es lo que el documento realmente descontó
+    (recorded_stock_quantities) y no sus filas previas expandidas con la receta vigente:
+    si una Receta cambió despues de la orden, editarla o eliminarla devuelve los ingredientes
+    que se descontaron en su momento. Sin registros se usa build_stock_delta(previous_rows, ...).
+    """
+    recorded = recorded_stock_quantities(reference_doctype, reference_name)
+    if recorded is None:
+        return build_stock_delta(previous_rows, current_rows, company_id)
+
+    current_qty = expand_bom_quantities(quantity_map_from_rows(current_rows or []), company_id)
+    product_names = set(recorded) | set(current_qty)
+    return _clean_qty_map(
+        {
+            product: -flt(recorded.get(product, 0)) - flt(current_qty.get(product, 0))
+            for product in product_names
+        }
+    )
+
+
 def infer_movement_type_from_delta(qty_map: dict[str, float], default_type: str = "Ajuste") -> str:
     values = list(_clean_qty_map(qty_map).values())
     if not values:
@@ -88,10 +172,12 @@ def infer_movement_type_from_delta(qty_map: dict[str, float], default_type: str
     return default_type
 
 
-def _fetch_products_for_update(company_id: str, product_names: list[str]) -> dict[str, dict]:
+def _fetch_products(company_id: str, product_names: list[str]) -> dict[str, dict]:
+    """Datos de inventario de los productos, sin bloquear filas."""
     if not product_names:
         return {}
 
+    product_names = sorted(set(product_names))
     placeholders = ", ".join(["%s"] * len(product_names))
     rows = frappe.db.sql(
         f"""
@@ -108,7 +194,6 @@ def _fetch_products_for_update(company_id: str, product_names: list[str]) -> dic
         FROM `tabProducto`
         WHERE company_id = %s
           AND name IN ({placeholders})
-        FOR UPDATE
         """,
         [company_id, *product_names],
         as_dict=True,
@@ -116,38 +201,42 @@ def _fetch_products_for_update(company_id: str, product_names: list[str]) -> dic
     return {row.name: row for row in rows}
 
 
-def _ensure_products_belong_to_company(company_id: str, product_names: list[str], locked_products: dict[str, dict]):
-    missing = [product for product in product_names if product not in locked_products]
+def _ensure_products_belong_to_company(company_id: str, product_names: list[str], products: dict[str, dict]):
+    missing = [product for product in product_names if product not in products]
     if missing:
         frappe.throw(
             _("Los productos {0} no existen o no pertenecen a la compania activa.").format(", ".join(missing))
         )
 
 
+def _insufficient_stock_error(product_row, stock_before, delta):
+    frappe.throw(
+        _("Stock insuficiente para {0}. Disponible: {1}, requerido: {2}.").format(
+            product_row.nombre or product_row.name,
+            stock_before,
+            abs(delta),
+        )
+    )
+
+
 def validate_stock_delta(company_id: str, qty_map: dict[str, float] | None) -> list[dict]:
     cleaned = _clean_qty_map(qty_map)
     if not cleaned:
         return []
 
-    locked_products = _fetch_products_for_update(company_id, list(cleaned))
-    _ensure_products_belong_to_company(company_id, list(cleaned), locked_products)
+    products = _fetch_products(company_id, list(cleaned))
+    _ensure_products_belong_to_company(company_id, list(cleaned), products)
 
     validations: list[dict] = []
     for product, delta in cleaned.items():
-        product_row = locked_products[product]
+        product_row = products[product]
         if not cint(product_row.controlar_inventario):
             continue
 
         stock_before = flt(product_row.stock_actual)
         stock_after = flt(stock_before + delta)
         if stock_after < 0 and not cint(product_row.permitir_stock_negativo):
-            frappe.throw(
-                _("Stock insuficiente para {0}. Disponible: {1}, requerido: {2}.").format(
-                    product_row.nombre or product,
-                    stock_before,
-                    abs(delta),
-                )
-            )
+            _insufficient_stock_error(product_row, stock_before, delta)
 
         validations.append(
             {
@@ -163,25 +252,136 @@ def validate_stock_delta(company_id: str, qty_map: dict[str, float] | None) -> l
     return validations
 
 
+def check_stock_delta(company_id: str, qty_map: dict[str, float] | None) -> list[dict]:
+    """
+    Validación anticipada sin bloquear filas (para fallar rápido al guardar la orden).
+    La verificación definitiva es el UPDATE condicional de apply_stock_delta.
+    """
+    return validate_stock_delta(company_id, qty_map)
+
+
+def bulk_update_by_name(doctype: str, values_by_name: dict[str, dict], common: dict | None = None):
+    """
+    Actualiza varias filas con un solo UPDATE ... SET col = CASE name WHEN ... END.
+    values_by_name: {name: {columna: valor}}; common: columnas con el mismo valor para todas.
+    """
+    if not values_by_name:
+        return
+
+    names = list(values_by_name)
+    columns = sorted({column for values in values_by_name.values() for column in values})
+    assignments, params = [], []
+    for column in columns:
+        cases = []
+        for name in names:
+            if column in values_by_name[name]:
+                cases.append("WHEN %s THEN %s")
+                params += [name, values_by_name[name][column]]
+        assignments.append(f"`{column}` = CASE `name` {' '.join(cases)} ELSE `{column}` END")
+    for column, value in (common or {}).items():
+        assignments.append(f"`{column}` = %s")
+        params.append(value)
+
+    placeholders = ", ".join(["%s"] * len(names))
+    frappe.db.sql(
+        f"""
+        UPDATE `tab{doctype}`
+        SET {", ".join(assignments)}
+        WHERE `name` IN ({placeholders})
+        """,
+        [*params, *names],
+    )
+
+
+def _update_product_stock(company_id: str, product: str, delta: float, require_stock: bool, now) -> bool:
+    """
+    UPDATE condicional de un producto; False si no alcanza el stock.
+    is_out_of_stock va antes que stock_actual: se calcula con el valor previo en cualquier modo de asignación.
+    """
+    condition = "AND COALESCE(stock_actual, 0) >= %(required)s" if require_stock else ""
+    frappe.db.sql(
+        f"""
+        UPDATE `tabProducto`
+        SET is_out_of_stock = IF(COALESCE(stock_actual, 0) + %(delta)s <= 0, 1, 0),
+            stock_actual = COALESCE(stock_actual, 0) + %(delta)s,
+            ultima_actualizacion_stock = %(now)s
+        WHERE name = %(product)s
+          AND company_id = %(company_id)s
+          {condition}
+        """,
+        {"product": product, "company_id": company_id, "delta": delta, "required": -delta, "now": now},
+    )
+    return cint(frappe.db.sql("SELECT ROW_COUNT()")[0][0]) == 1
+
+
 def apply_stock_delta(company_id: str, qty_map: dict[str, float] | None) -> list[dict]:
-    validations = validate_stock_delta(company_id, qty_map)
-    if not validations:
+    """
+    Aplica el delta con un UPDATE condicional por producto (stock_actual >= requerido), sin
+    SELECT ... FOR UPDATE previo. Las filas quedan bloqueadas solo desde su UPDATE hasta el
+    commit, así que los llamadores lo dejan como último paso de la transacción.
+    """
+    cleaned = _clean_qty_map(qty_map)
+    if not cleaned:
         return []
 
-    now_value = frappe.utils.now_datetime()
-    for row in validations:
-        frappe.db.set_value(
-            "Producto",
-            row["product"],
-            {
-                "stock_actual": row["stock_after"],
-                "is_out_of_stock": 1 if row["stock_after"] <= 0 else 0,
-                "ultima_actualizacion_stock": now_value,
-            },
-            update_modified=False,
+    products = _fetch_products(company_id, list(cleaned))
+    _ensure_products_belong_to_company(company_id, list(cleaned), products)
+
+    # Orden fijo por name: dos transacciones con productos en común bloquean
+    # en la misma secuencia y no se cruzan (deadlock).
+    tracked = [product for product in sorted(cleaned) if cint(products[product].controlar_inventario)]
+    if not tracked:
+        return []
+
+    now = frappe.utils.now_datetime()
+    for product in tracked:
+        delta = cleaned[product]
+        require_stock = delta < 0 and not cint(products[product].permitir_stock_negativo)
+        if not _update_product_stock(company_id, product, delta, require_stock, now):
+            available = flt(frappe.db.get_value("Producto", product, "stock_actual"))
+            _insufficient_stock_error(products[product], available, delta)
+
+    # Lectura de las filas ya actualizadas por esta transacción (ven su propio UPDATE).
+    stock_after = dict(
+        frappe.db.sql(
+            "SELECT name, COALESCE(stock_actual, 0) FROM `tabProducto` WHERE name IN %(names)s",
+            {"names": tuple(tracked)},
         )
+    )
+    return [
+        {
+            "product": product,
+            "product_name": products[product].nombre,
+            "delta": cleaned[product],
+            "stock_before": flt(flt(stock_after[product]) - cleaned[product]),
+            "stock_after": flt(stock_after[product]),
+            "unidad_inventario": products[product].unidad_inventario,
+        }
+        for product in tracked
+    ]
 
-    return validations
+
+def apply_movement_stock(movement) -> list[dict]:
+    """Aplica al stock las filas de un Movimiento de Inventario y guarda stock_before/after en cada fila."""
+    applied_rows = apply_stock_delta(
+        movement.company_id,
+        quantity_map_from_rows(movement.items or [], qty_key="quantity"),
+    )
+    applied_by_product = {row["product"]: row for row in applied_rows}
+
+    bulk_update_by_name(
+        INVENTORY_MOVEMENT_ITEM_DOCTYPE,
+        {
+            row.name: {
+                "stock_before": applied_by_product[row.product]["stock_before"],
+                "stock_after": applied_by_product[row.product]["stock_after"],
+            }
+            for row in movement.items or []
+            if row.product in applied_by_product
+        },
+    )
+    movement.db_set("is_applied", 1, update_modified=False)
+    return applied_rows
 
 
 def create_inventory_movement_entry(
@@ -222,10 +422,159 @@ def create_inventory_movement_entry(
             ],
         }
     )
+    # El stock se descuenta después de escribir el kardex: los UPDATE de Producto son lo último.
+    movement.flags.defer_stock_apply = True
     movement.insert(ignore_permissions=ignore_permissions)
+    apply_movement_stock(movement)
     return movement
 
 
+# ---------- Kardex asíncrono (Company.inventario_async) ----------
+def inventory_async_enabled(company_id: str | None) -> bool:
+    if not company_id:
+        return False
+    return bool(cint(frappe.get_cached_value("Company", company_id, "inventario_async")))
+
+
+def reserve_stock_and_queue_movement(
+    *,
+    company_id: str,
+    qty_map: dict[str, float] | None,
+    movement_type: str | None = None,
+    reference_doctype: str | None = None,
+    reference_name: str | None = None,
+    notes: str | None = None,
+):
+    """
+    Aplica el delta de stock en la transacción actual (mismo UPDATE condicional que apply_stock_delta)
+    y deja el Movimiento de Inventario pendiente en una cola persistente.
+    La fila de la cola se confirma junto con la orden, así que el kardex no se pierde aunque
+    el job falle: process_inventory_outbox la reintenta desde el scheduler.
+    """
+    cleaned = _clean_qty_map(qty_map)
+    if not cleaned:
+        return None
+
+    movement_type = movement_type or infer_movement_type_from_delta(cleaned)
+    if movement_type not in ALLOWED_MOVEMENT_TYPES:
+        frappe.throw(_("Tipo de movimiento de inventario invalido: {0}").format(movement_type))
+
+    ensure_inventory_doctypes_ready()
+
+    posting_datetime = frappe.utils.now_datetime()
+    entry = frappe.get_doc(
+        {
+            "doctype": INVENTORY_OUTBOX_DOCTYPE,
+            "company_id": company_id,
+            "movement_type": movement_type,
+            # Hora de la reserva: el Movimiento creado después conserva esta fecha en el kardex.
+            "posting_datetime": posting_datetime,
+            "reference_doctype": reference_doctype,
+            "reference_name": reference_name,
+            "notes": notes,
+            "status": "Pendiente",
+        }
+    )
+    entry.insert(ignore_permissions=True)
+
+    # Descuento al final; el payload con stock_before/after se completa sobre la fila ya insertada.
+    applied_by_product = {row["product"]: row for row in apply_stock_delta(company_id, cleaned)}
+    items = []
+    for product, quantity in cleaned.items():
+        applied = applied_by_product.get(product) or {}
+        items.append(
+            {
+                "product": product,
+                "quantity": quantity,
+                "stock_before": applied.get("stock_before"),
+                "stock_after": applied.get("stock_after"),
+            }
+        )
+    entry.db_set(
+        "payload",
+        json.dumps({"posting_date": str(getdate(posting_datetime)), "items": items}),
+        update_modified=False,
+    )
+
+    frappe.enqueue(
+        "restaurante_app.inventarios_bmarc.api.stock.process_inventory_outbox",
+        queue="short",
+        job_id="inventory-outbox",
+        deduplicate=True,
+        enqueue_after_commit=True,
+    )
+    return entry
+
+
+def _deliver_outbox_entry(name: str):
+    entry = frappe.get_doc(INVENTORY_OUTBOX_DOCTYPE, name)
+    data = json.loads(entry.payload or "{}")
+
+    posting_datetime = get_datetime(entry.posting_datetime or entry.creation)
+
+    frappe.db.savepoint("inventory_outbox_entry")
+    try:
+        movement = frappe.get_doc(
+            {
+                "doctype": INVENTORY_MOVEMENT_DOCTYPE,
+                "company_id": entry.company_id,
+                "movement_type": entry.movement_type,
+                "posting_date": getdate(posting_datetime),
+                "posting_datetime": posting_datetime,
+                "reference_doctype": entry.reference_doctype,
+                "reference_name": entry.reference_name,
+                "notes": entry.notes,
+                # El stock ya se descontó al reservar: after_insert no lo vuelve a aplicar.
+                "is_applied": 1,
+                "items": data.get("items") or [],
+            }
+        )
+        movement.insert(ignore_permissions=True)
+        entry.db_set({"status": "Procesado", "movement": movement.name, "error": None}, update_modified=False)
+    except Exception:
+        frappe.db.rollback(save_point="inventory_outbox_entry")
+        frappe.clear_messages()
+        attempts = cint(entry.attempts) + 1
+        entry.db_set(
+            {
+                "attempts": attempts,
+                "status": "Error" if attempts >= INVENTORY_OUTBOX_MAX_ATTEMPTS else "Pendiente",
+                "error": frappe.get_traceback(),
+            },
+            update_modified=False,
+        )
+
+
+def process_inventory_outbox(limit: int = INVENTORY_OUTBOX_BATCH):
+    """Escribe los Movimientos de Inventario pendientes (job encolado y scheduler "all")."""
+    if not frappe.db.table_exists(INVENTORY_OUTBOX_DOCTYPE):
+        return
+
+    while True:
+        # SKIP LOCKED: varios workers pueden vaciar la cola sin tomar la misma fila.
+        names = frappe.db.sql(
+            f"""
+            SELECT name
+            FROM `tab{INVENTORY_OUTBOX_DOCTYPE}`
+            WHERE status = 'Pendiente'
+            ORDER BY creation
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+            """,
+            (cint(limit),),
+            pluck=True,
+        )
+        if not names:
+            break
+
+        for name in names:
+            _deliver_outbox_entry(name)
+        frappe.db.commit()
+
+        if len(names) < cint(limit):
+            break
+
+
 def _normalize_manual_quantity(movement_type: str, raw_quantity) -> float:
     quantity = flt(raw_quantity)
     if not quantity:
@@ -348,6 +697,9 @@ def get_inventory_movements(limit=50, offset=0, product=None, movement_type=None
             "message": _("El modulo de inventario aun no esta sincronizado. Ejecute bench migrate y recargue el sitio."),
         }
 
+    if product:
+        return {"data": _get_product_ledger(company_id, product, movement_type, limit, offset)}
+
     filters = {
         "company_id": company_id,
     }
@@ -366,9 +718,10 @@ def get_inventory_movements(limit=50, offset=0, product=None, movement_type=None
             "total_items",
             "total_quantity",
             "notes",
+            "posting_datetime",
             "creation",
         ],
-        order_by="creation desc",
+        order_by="posting_datetime desc, name desc",
         limit_start=int(offset or 0),
         limit_page_length=int(limit or 50),
     )
@@ -377,16 +730,12 @@ def get_inventory_movements(limit=50, offset=0, product=None, movement_type=None
         return {"data": []}
 
     names = [row.name for row in movement_names]
-    item_filters = {
-        "parent": ["in", names],
-        "parenttype": INVENTORY_MOVEMENT_DOCTYPE,
-    }
-    if product:
-        item_filters["product"] = product
-
     item_rows = frappe.get_all(
         INVENTORY_MOVEMENT_ITEM_DOCTYPE,
-        filters=item_filters,
+        filters={
+            "parent": ["in", names],
+            "parenttype": INVENTORY_MOVEMENT_DOCTYPE,
+        },
         fields=["parent", "product", "quantity", "stock_before", "stock_after"],
         order_by="idx asc",
     )
@@ -395,14 +744,62 @@ def get_inventory_movements(limit=50, offset=0, product=None, movement_type=None
     for row in item_rows:
         items_by_parent.setdefault(row.parent, []).append(row)
 
-    data = []
     for movement in movement_names:
-        items = items_by_parent.get(movement.name, [])
-        if product and not items:
-            continue
-        movement["items"] = items
-        data.append(movement)
+        movement["items"] = items_by_parent.get(movement.name, [])
 
-    return {"data": data}
+    return {"data": movement_names}
 
 
+def _get_product_ledger(company_id: str, product: str, movement_type=None, limit=50, offset=0) -> list[dict]:
+    """
+    Kardex de un producto: pagina sobre las lineas de detalle (indice company_id, product, posting_datetime)
+    en vez de sobre las cabeceras, asi cada pagina trae `limit` movimientos del producto.
+    """
+    conditions = ["d.company_id = %(company_id)s", "d.product = %(product)s", "d.parenttype = %(parenttype)s"]
+    params = {"company_id": company_id, "product": product, "parenttype": INVENTORY_MOVEMENT_DOCTYPE}
+    if movement_type:
+        conditions.append("m.movement_type = %(movement_type)s")
+        params["movement_type"] = movement_type
+
+    rows = frappe.db.sql(
+        f"""
+        SELECT
+            m.name,
+            m.posting_date,
+            m.movement_type,
+            m.reference_doctype,
+            m.reference_name,
+            m.total_items,
+            m.total_quantity,
+            m.notes,
+            m.posting_datetime,
+            m.creation,
+            d.product,
+            d.quantity,
+            d.stock_before,
+            d.stock_after
+        FROM `tab{INVENTORY_MOVEMENT_ITEM_DOCTYPE}` d
+        JOIN `tab{INVENTORY_MOVEMENT_DOCTYPE}` m ON m.name = d.parent
+        WHERE {" AND ".join(conditions)}
+        ORDER BY d.posting_datetime DESC, d.parent DESC, d.idx DESC
+        LIMIT {int(limit or 50)} OFFSET {int(offset or 0)}
+        """,
+        params,
+        as_dict=True,
+    )
+
+    # Misma forma que el listado general: la cabecera con su linea del producto.
+    data = []
+    for row in rows:
+        line = {
+            "parent": row.name,
+            "product": row.pop("product"),
+            "quantity": row.pop("quantity"),
+            "stock_before": row.pop("stock_before"),
+            "stock_after": row.pop("stock_after"),
+        }
+        row["items"] = [line]
+        data.append(row)
+    return data
+
+
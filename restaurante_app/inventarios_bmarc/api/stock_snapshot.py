@@ -0,0 +1,224 @@
+import hashlib
+import json
+
+import frappe
+from frappe.utils import add_days, flt, get_datetime, getdate, now_datetime, today
+
+from restaurante_app.inventarios_bmarc.api.stock import (
+    INVENTORY_MOVEMENT_DOCTYPE,
+    INVENTORY_MOVEMENT_ITEM_DOCTYPE,
+    INVENTORY_OUTBOX_DOCTYPE,
+)
+from restaurante_app.restaurante_bmarc.api.user import get_user_company
+
+STOCK_SNAPSHOT_DOCTYPE = "Saldo Diario Inventario"
+STOCK_SNAPSHOT_INSERT_CHUNK = 1000
+
+
+def snapshot_daily_stock(fecha=None, company: str | None = None):
+    """
+    Guarda el saldo al cierre de `fecha` (por defecto ayer) de cada producto con inventario.
+    Saldo al cierre = stock_actual - movimientos posteriores al dia (por posting_datetime, la hora
+    de la reserva) - reservas del outbox posteriores aun sin Movimiento (ya estan en stock_actual).
+    Producto, kardex y outbox se leen en una sola snapshot consistente: una reserva que el outbox
+    procesa a mitad de la lectura se cuenta una sola vez. Confirma la transaccion en curso.
+    Uso (scheduler diario) o: bench execute restaurante_app.inventarios_bmarc.api.stock_snapshot.snapshot_daily_stock
+    """
+    fecha = getdate(fecha) if fecha else getdate(add_days(today(), -1))
+    next_day = get_datetime(add_days(fecha, 1))
+    conditions = ["COALESCE(controlar_inventario, 0) = 1", "company_id IS NOT NULL"]
+    params = {"next_day": next_day, "parenttype": INVENTORY_MOVEMENT_DOCTYPE}
+    if company:
+        conditions.append("company_id = %(company)s")
+        params["company"] = company
+
+    frappe.db.commit()
+    frappe.db.sql("START TRANSACTION WITH CONSISTENT SNAPSHOT")
+
+    products = frappe.db.sql(
+        f"""
+        SELECT company_id, name, COALESCE(stock_actual, 0)
+        FROM `tabProducto`
+        WHERE {" AND ".join(conditions)}
+        """,
+        params,
+    )
+    after_close = {
+        (company_id, product): flt(qty)
+        for company_id, product, qty in frappe.db.sql(
+            f"""
+            SELECT d.company_id, d.product, SUM(d.quantity)
+            FROM `tab{INVENTORY_MOVEMENT_ITEM_DOCTYPE}` d
+            WHERE d.parenttype = %(parenttype)s
+              AND d.posting_datetime >= %(next_day)s
+              {"AND d.company_id = %(company)s" if company else ""}
+            GROUP BY d.company_id, d.product
+            """,
+            params,
+        )
+    }
+    for key, qty in _pending_outbox_sums(company, from_dt=next_day).items():
+        after_close[key] = flt(after_close.get(key, 0)) + qty
+
+    now, user = now_datetime(), frappe.session.user
+    rows = [
+        (
+            hashlib.sha1(f"{company_id}|{fecha}|{product}".encode()).hexdigest(),
+            now, now, user, user, 0, 0,
+            company_id, fecha, product,
+            flt(stock) - after_close.get((company_id, product), 0),
+        )
+        for company_id, product, stock in products
+    ]
+    for start in range(0, len(rows), STOCK_SNAPSHOT_INSERT_CHUNK):
+        chunk = rows[start:start + STOCK_SNAPSHOT_INSERT_CHUNK]
+        frappe.db.sql(
+            f"""
+            INSERT INTO `tab{STOCK_SNAPSHOT_DOCTYPE}`
+                (name, creation, modified, owner, modified_by, docstatus, idx,
+                 company_id, fecha, product, stock)
+            VALUES {", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(chunk))}
+            ON DUPLICATE KEY UPDATE
+                stock = VALUES(stock),
+                modified = VALUES(modified)
+            """,
+            [value for row in chunk for value in row],
+        )
+    frappe.db.commit()
+
+
+def _pending_outbox_sums(company_id: str | None = None, from_dt=None, to_dt=None, after_dt=None) -> dict[tuple, float]:
+    """
+    {(company_id, product): cantidad} de las reservas del outbox que aun no son Movimiento
+    (Pendiente o Error), por su posting_datetime. Ya descontadas de stock_actual pero no en el kardex.
+    """
+    if not frappe.db.table_exists(INVENTORY_OUTBOX_DOCTYPE):
+        return {}
+    filters = [["status", "!=", "Procesado"]]
+    if company_id:
+        filters.append(["company_id", "=", company_id])
+    if from_dt:
+        filters.append(["posting_datetime", ">=", from_dt])
+    if to_dt:
+        filters.append(["posting_datetime", "<=", to_dt])
+    if after_dt:
+        filters.append(["posting_datetime", ">", after_dt])
+
+    sums: dict[tuple, float] = {}
+    for entry in frappe.get_all(INVENTORY_OUTBOX_DOCTYPE, filters=filters, fields=["company_id", "payload"]):
+        for item in json.loads(entry.payload or "{}").get("items") or []:
+            key = (entry.company_id, item["product"])
+            sums[key] = flt(sums.get(key, 0)) + flt(item.get("quantity"))
+    return sums
+
+
+def _ledger_sums(
+    company_id: str, from_dt=None, to_dt=None, after_dt=None, products: list[str] | None = None
+) -> dict[str, float]:
+    """
+    SUM(quantity) por producto en [from_dt, to_dt] (o > after_dt) segun posting_datetime:
+    lineas del kardex mas reservas del outbox que aun no tienen Movimiento.
+    """
+    conditions = ["d.company_id = %(company_id)s", "d.parenttype = %(parenttype)s"]
+    params = {"company_id": company_id, "parenttype": INVENTORY_MOVEMENT_DOCTYPE}
+    if from_dt:
+        conditions.append("d.posting_datetime >= %(from_dt)s")
+        params["from_dt"] = from_dt
+    if to_dt:
+        conditions.append("d.posting_datetime <= %(to_dt)s")
+        params["to_dt"] = to_dt
+    if after_dt:
+        conditions.append("d.posting_datetime > %(after_dt)s")
+        params["after_dt"] = after_dt
+    if products is not None:
+        if not products:
+            return {}
+        conditions.append("d.product IN %(products)s")
+        params["products"] = tuple(products)
+
+    rows = frappe.db.sql(
+        f"""
+        SELECT d.product, SUM(d.quantity)
+        FROM `tab{INVENTORY_MOVEMENT_ITEM_DOCTYPE}` d
+        WHERE {" AND ".join(conditions)}
+        GROUP BY d.product
+        """,
+        params,
+    )
+    sums = {product: flt(qty) for product, qty in rows}
+    pending = _pending_outbox_sums(company_id, from_dt=from_dt, to_dt=to_dt, after_dt=after_dt)
+    for (_company, product), qty in pending.items():
+        if products is None or product in products:
+            sums[product] = flt(sums.get(product, 0)) + qty
+    return sums
+
+
+@frappe.whitelist()
+def get_stock_at(at=None, product=None):
+    """
+    Stock de cada producto con inventario a la fecha/hora `at`:
+    ultimo saldo diario anterior + movimientos desde ese cierre hasta `at`.
+    """
+    company_id = get_user_company()
+    at = get_datetime(at) if at else now_datetime()
+
+    product_filters = {"company_id": company_id, "controlar_inventario": 1}
+    if product:
+        product_filters["name"] = product
+    products = frappe.get_all(
+        "Producto",
+        filters=product_filters,
+        fields=["name", "nombre", "unidad_inventario", "stock_actual"],
+        order_by="nombre asc",
+    )
+    if not products:
+        return {"at": at, "snapshot_date": None, "data": []}
+
+    # El saldo de `fecha` vale al inicio del dia siguiente, asi que sirve si fecha < dia de `at`.
+    snapshot_date = frappe.db.sql(
+        f"""
+        SELECT MAX(fecha) FROM `tab{STOCK_SNAPSHOT_DOCTYPE}`
+        WHERE company_id = %(company_id)s AND fecha < %(day)s
+        """,
+        {"company_id": company_id, "day": getdate(at)},
+    )[0][0]
+
+    snapshot: dict[str, float] = {}
+    after_snapshot: dict[str, float] = {}
+    if snapshot_date:
+        snapshot_filters = {"company_id": company_id, "fecha": snapshot_date}
+        if product:
+            snapshot_filters["product"] = product
+        snapshot = {
+            row.product: flt(row.stock)
+            for row in frappe.get_all(
+                STOCK_SNAPSHOT_DOCTYPE, filters=snapshot_filters, fields=["product", "stock"]
+            )
+        }
+        after_snapshot = _ledger_sums(
+            company_id,
+            from_dt=get_datetime(add_days(snapshot_date, 1)),
+            to_dt=at,
+            products=[product] if product else None,
+        )
+
+    # Productos sin saldo (creados despues del cierre o sin snapshots): desde el stock actual hacia atras.
+    missing = [row.name for row in products if row.name not in snapshot]
+    after_at = _ledger_sums(company_id, after_dt=at, products=missing) if missing else {}
+
+    data = []
+    for row in products:
+        if row.name in snapshot:
+            stock = snapshot[row.name] + after_snapshot.get(row.name, 0)
+        else:
+            stock = flt(row.stock_actual) - after_at.get(row.name, 0)
+        data.append(
+            {
+                "product": row.name,
+                "product_name": row.nombre,
+                "unidad_inventario": row.unidad_inventario,
+                "stock": flt(stock),
+            }
+        )
+
+    return {"at": at, "snapshot_date": snapshot_date, "data": data}
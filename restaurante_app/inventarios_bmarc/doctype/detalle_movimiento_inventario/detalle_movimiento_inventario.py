@@ -1,8 +1,16 @@
 ﻿# Copyright (c) 2026, none and contributors
 # For license information, please see license.txt
 
+import frappe
 from frappe.model.document import Document
 
 
 class DetalleMovimientoInventario(Document):
     pass
+
+
+def on_doctype_update():
+    # Kardex por producto: get_inventory_movements(product=...) pagina sobre este indice.
+    frappe.db.add_index(
+        "Detalle Movimiento Inventario", ["company_id", "product", "posting_datetime"], "company_product_posting_idx"
+    )
@@ -4,9 +4,13 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
-from frappe.utils import cint, flt
+from frappe.utils import cint, flt, now_datetime
 
-from restaurante_app.inventarios_bmarc.api.stock import apply_stock_delta, quantity_map_from_rows
+from restaurante_app.inventarios_bmarc.api.stock import (
+    apply_movement_stock,
+    apply_stock_delta,
+    quantity_map_from_rows,
+)
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
 
 
@@ -18,6 +22,9 @@ class MovimientodeInventario(Document):
     def validate(self):
         if not self.company_id:
             self.company_id = get_user_company()
+        # posting_datetime ordena el kardex; el outbox trae la hora de la reserva.
+        if not self.posting_datetime:
+            self.posting_datetime = now_datetime()
 
         if not self.items:
             frappe.throw(_("Debe agregar al menos un producto al movimiento de inventario."))
@@ -35,6 +42,8 @@ class MovimientodeInventario(Document):
             row.quantity = flt(row.quantity)
             if not row.quantity:
                 frappe.throw(_("La cantidad de cada fila debe ser distinta de cero."))
+            row.company_id = self.company_id
+            row.posting_datetime = self.posting_datetime
             total_items += 1
             total_quantity += abs(flt(row.quantity))
 
@@ -42,30 +51,11 @@ class MovimientodeInventario(Document):
         self.total_quantity = total_quantity
 
     def after_insert(self):
-        if cint(self.is_applied):
+        # defer_stock_apply: create_inventory_movement_entry aplica el stock al terminar el insert.
+        if cint(self.is_applied) or self.flags.defer_stock_apply:
             return
 
-        applied_rows = apply_stock_delta(
-            self.company_id,
-            quantity_map_from_rows(self.items or [], qty_key="quantity"),
-        )
-        applied_by_product = {row["product"]: row for row in applied_rows}
-
-        for row in self.items or []:
-            applied = applied_by_product.get(row.product)
-            if not applied:
-                continue
-            frappe.db.set_value(
-                row.doctype,
-                row.name,
-                {
-                    "stock_before": applied["stock_before"],
-                    "stock_after": applied["stock_after"],
-                },
-                update_modified=False,
-            )
-
-        self.db_set("is_applied", 1, update_modified=False)
+        apply_movement_stock(self)
 
     def on_trash(self):
         if not cint(self.is_applied):
@@ -78,3 +68,8 @@ class MovimientodeInventario(Document):
 # Alias para mantener legibilidad interna.
 MovimientoDeInventario = MovimientodeInventario
 
+
+def on_doctype_update():
+    # get_inventory_movements ordena por posting_datetime dentro de la compañía.
+    frappe.db.add_index("Movimiento de Inventario", ["company_id", "posting_datetime"], "company_posting_idx")
+
@@ -0,0 +1,15 @@
+# Copyright (c) 2026, none and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class MovimientoInventarioPendiente(Document):
+    pass
+
+
+def on_doctype_update():
+    frappe.db.add_index("Movimiento Inventario Pendiente", ["status", "creation"])
+    # Reservas pendientes de un documento (stock.recorded_stock_quantities).
+    frappe.db.add_index("Movimiento Inventario Pendiente", ["reference_doctype", "reference_name"], "reference_idx")
@@ -0,0 +1,46 @@
+# Copyright (c) 2026, none and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import flt
+
+from restaurante_app.inventarios_bmarc.api.bom import assert_no_recipe_cycle, clear_flat_bom_cache
+from restaurante_app.restaurante_bmarc.api.user import get_user_company
+
+
+class Receta(Document):
+    def validate(self):
+        if not self.company_id:
+            self.company_id = frappe.db.get_value("Producto", self.product, "company_id") or get_user_company()
+
+        seen = set()
+        for row in self.items or []:
+            if row.ingredient == self.product:
+                frappe.throw(_("Un producto no puede ser ingrediente de su propia receta."))
+            if row.ingredient in seen:
+                frappe.throw(_("El ingrediente {0} está repetido en la receta.").format(row.ingredient_name or row.ingredient))
+            if flt(row.qty) <= 0:
+                frappe.throw(_("La cantidad de cada ingrediente debe ser mayor a 0."))
+            seen.add(row.ingredient)
+
+        foreign = set(seen) - set(
+            frappe.get_all(
+                "Producto",
+                filters={"company_id": self.company_id, "name": ["in", list(seen)]},
+                pluck="name",
+            )
+        ) if seen else set()
+        if foreign:
+            frappe.throw(
+                _("Los ingredientes {0} no pertenecen a la compania de la receta.").format(", ".join(sorted(foreign)))
+            )
+
+        assert_no_recipe_cycle(self.company_id, self.product, [row.ingredient for row in self.items or []])
+
+    def on_update(self):
+        clear_flat_bom_cache(self.company_id)
+
+    def on_trash(self):
+        clear_flat_bom_cache(self.company_id)
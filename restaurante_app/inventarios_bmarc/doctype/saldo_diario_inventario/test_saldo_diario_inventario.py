@@ -0,0 +1,81 @@
+# Copyright (c) 2026, none and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_days, flt, get_datetime, now_datetime, today
+
+from restaurante_app.inventarios_bmarc.api.stock import (
+	create_inventory_movement_entry,
+	reserve_stock_and_queue_movement,
+)
+from restaurante_app.inventarios_bmarc.api.stock_snapshot import get_stock_at, snapshot_daily_stock
+
+
+class TestSaldoDiarioInventario(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.company = frappe.get_doc(
+			{"doctype": "Company", "businessname": "_Test Saldo Diario", "ruc": "0999999998001"}
+		).insert(ignore_permissions=True, ignore_mandatory=True).name
+		frappe.defaults.set_user_default("Company", cls.company, user="Administrator")
+
+	@classmethod
+	def tearDownClass(cls):
+		# snapshot_daily_stock confirma su transacción: se limpia a mano.
+		movements = frappe.get_all("Movimiento de Inventario", filters={"company_id": cls.company}, pluck="name")
+		if movements:
+			frappe.db.delete("Detalle Movimiento Inventario", {"parent": ["in", movements]})
+			frappe.db.delete("Movimiento de Inventario", {"name": ["in", movements]})
+		for doctype in ("Movimiento Inventario Pendiente", "Saldo Diario Inventario", "Producto"):
+			frappe.db.delete(doctype, {"company_id": cls.company})
+		frappe.db.delete("Company", {"name": cls.company})
+		frappe.defaults.clear_user_default("Company", user="Administrator")
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def _new_product(self, stock):
+		return frappe.get_doc(
+			{
+				"doctype": "Producto",
+				"company_id": self.company,
+				"nombre": f"_Test Producto Saldo {frappe.generate_hash(length=6)}",
+				"precio": 1,
+				"controlar_inventario": 1,
+				"stock_actual": stock,
+			}
+		).insert(ignore_permissions=True).name
+
+	def _stock_at(self, at, product):
+		rows = get_stock_at(at=at, product=product)["data"]
+		return flt(rows[0]["stock"])
+
+	def test_snapshot_counts_ledger_and_pending_outbox_after_close(self):
+		yesterday = add_days(today(), -1)
+		product = self._new_product(10)
+
+		# Reserva del outbox fechada antes del cierre: ya forma parte del saldo de ayer.
+		before_close = reserve_stock_and_queue_movement(company_id=self.company, qty_map={product: -1})
+		before_close.db_set("posting_datetime", get_datetime(f"{yesterday} 12:00:00"), update_modified=False)
+		# Después del cierre: un Movimiento ya escrito y una reserva aún pendiente.
+		create_inventory_movement_entry(company_id=self.company, qty_map={product: -2}, movement_type="Ajuste")
+		reserve_stock_and_queue_movement(company_id=self.company, qty_map={product: -3})
+		self.assertEqual(flt(frappe.db.get_value("Producto", product, "stock_actual")), 4)
+
+		snapshot_daily_stock(yesterday, company=self.company)
+		saldo = frappe.db.get_value(
+			"Saldo Diario Inventario", {"company_id": self.company, "fecha": yesterday, "product": product}, "stock"
+		)
+		self.assertEqual(flt(saldo), 9)
+		self.assertEqual(self._stock_at(now_datetime(), product), 4)
+
+		# Producto sin saldo diario: se reconstruye desde stock_actual hacia atrás.
+		unsnapshotted = self._new_product(6)
+		before_sale = now_datetime()
+		reserve_stock_and_queue_movement(company_id=self.company, qty_map={unsnapshotted: -1})
+		self.assertFalse(
+			frappe.db.exists("Saldo Diario Inventario", {"company_id": self.company, "product": unsnapshotted})
+		)
+		self.assertEqual(self._stock_at(before_sale, unsnapshotted), 6)
+		self.assertEqual(self._stock_at(now_datetime(), unsnapshotted), 5)
@@ -0,0 +1,19 @@
+from restaurante_app.restaurante_bmarc.api.db_indexes import ensure_indexes
+
+# Lista fija de este patch (no depende de cambios posteriores en db_indexes).
+INDEXES = [
+    ("orders", ["company_id", "creation"], "company_creation_idx"),
+    ("orders", ["company_id", "owner", "creation"], "company_owner_creation_idx"),
+    ("Items", ["parent", "product"], "parent_product_idx"),
+    ("Sales Invoice", ["order", "docstatus"], "order_docstatus_idx"),
+    ("Sales Invoice", ["company_id", "creation"], "company_creation_idx"),
+    ("Producto", ["company_id", "codigo"], "company_codigo_idx"),
+    ("Cliente", ["company_id", "num_identificacion"], "company_identificacion_idx"),
+    ("Movimiento de Inventario", ["company_id", "creation"], "company_creation_idx"),
+    ("Movimiento de Inventario", ["reference_doctype", "reference_name"], "reference_idx"),
+    ("Detalle Movimiento Inventario", ["parent", "product"], "parent_product_idx"),
+]
+
+
+def execute():
+    ensure_indexes(INDEXES)
@@ -0,0 +1,10 @@
+from restaurante_app.restaurante_bmarc.api.db_indexes import ensure_indexes
+
+INDEXES = [
+    ("Sales Invoice", ["status", "sri_next_check"], "status_next_check_idx"),
+    ("Credit Note", ["status", "sri_next_check"], "status_next_check_idx"),
+]
+
+
+def execute():
+    ensure_indexes(INDEXES)
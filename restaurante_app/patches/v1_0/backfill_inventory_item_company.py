@@ -0,0 +1,21 @@
+import frappe
+
+from restaurante_app.restaurante_bmarc.api.db_indexes import ensure_indexes
+
+INDEXES = [
+    ("Detalle Movimiento Inventario", ["company_id", "product", "creation"], "company_product_creation_idx"),
+]
+
+
+def execute():
+    # company_id en las lineas del kardex para el indice (company_id, product, creation)
+    frappe.db.sql(
+        """
+        UPDATE `tabDetalle Movimiento Inventario` d
+        JOIN `tabMovimiento de Inventario` m ON m.name = d.parent
+        SET d.company_id = m.company_id
+        WHERE d.parenttype = 'Movimiento de Inventario'
+          AND d.company_id IS NULL
+        """
+    )
+    ensure_indexes(INDEXES)
@@ -0,0 +1,38 @@
+import frappe
+
+from restaurante_app.restaurante_bmarc.api.db_indexes import ensure_indexes
+
+INDEXES = [
+    ("Movimiento de Inventario", ["company_id", "posting_datetime"], "company_posting_idx"),
+    ("Detalle Movimiento Inventario", ["company_id", "product", "posting_datetime"], "company_product_posting_idx"),
+]
+
+
+def execute():
+    # Movimientos ya escritos: la mejor aproximacion disponible es su creation
+    # (para los del outbox, la creation de la reserva si sigue enlazada).
+    frappe.db.sql(
+        """
+        UPDATE `tabMovimiento Inventario Pendiente`
+        SET posting_datetime = creation
+        WHERE posting_datetime IS NULL
+        """
+    )
+    frappe.db.sql(
+        """
+        UPDATE `tabMovimiento de Inventario` m
+        LEFT JOIN `tabMovimiento Inventario Pendiente` p ON p.movement = m.name
+        SET m.posting_datetime = COALESCE(p.posting_datetime, m.creation)
+        WHERE m.posting_datetime IS NULL
+        """
+    )
+    frappe.db.sql(
+        """
+        UPDATE `tabDetalle Movimiento Inventario` d
+        JOIN `tabMovimiento de Inventario` m ON m.name = d.parent
+        SET d.posting_datetime = m.posting_datetime
+        WHERE d.parenttype = 'Movimiento de Inventario'
+          AND d.posting_datetime IS NULL
+        """
+    )
+    ensure_indexes(INDEXES)
@@ -0,0 +1,6 @@
+from restaurante_app.restaurante_bmarc.api.sales_rollup import rebuild_sales_rollup
+
+
+def execute():
+    # Rellena qty/net_amount/tax_amount/order_count del resumen por producto
+    rebuild_sales_rollup()
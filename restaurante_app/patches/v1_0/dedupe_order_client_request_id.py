@@ -0,0 +1,30 @@
+import frappe
+
+
+def execute():
+    # Antes del sync: on_doctype_update de orders crea el índice único
+    # (company_id, client_request_id) y fallaría con claves vacías o repetidas.
+    if not frappe.db.has_column("orders", "client_request_id"):
+        return
+    frappe.db.sql(
+        """
+        UPDATE `taborders`
+        SET client_request_id = NULL
+        WHERE client_request_id = ''
+        """
+    )
+    # Reintentos que alcanzaron a duplicarse: la clave se queda en la orden más antigua.
+    frappe.db.sql(
+        """
+        UPDATE `taborders` o
+        JOIN (
+            SELECT company_id, client_request_id, MIN(creation) AS first_creation
+            FROM `taborders`
+            WHERE client_request_id IS NOT NULL
+            GROUP BY company_id, client_request_id
+            HAVING COUNT(*) > 1
+        ) d ON d.company_id = o.company_id AND d.client_request_id = o.client_request_id
+        SET o.client_request_id = NULL
+        WHERE o.creation > d.first_creation
+        """
+    )
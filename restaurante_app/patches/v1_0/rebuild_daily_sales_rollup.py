@@ -0,0 +1,5 @@
+from restaurante_app.restaurante_bmarc.api.sales_rollup import rebuild_sales_rollup
+
+
+def execute():
+    rebuild_sales_rollup()
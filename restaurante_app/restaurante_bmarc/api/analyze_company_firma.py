@@ -7,6 +7,12 @@ from datetime import datetime, timezone
 from cryptography import x509
 from cryptography.hazmat.primitives.serialization import pkcs12
 from cryptography.x509.oid import NameOID, ExtensionOID
+from restaurante_app.facturacion_bmarc.api.cert_profile import (
+    cache_analysis,
+    clear_cert_profile,
+    get_cached_analysis,
+    set_cert_profile_from_analysis,
+)
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
 
 def _fmt_dt(dt: datetime) -> str:
@@ -129,30 +135,8 @@ def _get_company_doc(company: str | None, company_ruc: str | None):
     # por sesión
     return frappe.get_doc("Company", get_user_company())
 
-@frappe.whitelist()
-def analyze_company_firma(
-    password: str,
-    company: str = None,
-    company_ruc: str = None,
-    file_url: str = None,
-    save_to_company: int = 0,
-):
-    """
-    Valida la contraseña del .p12 de la Company y extrae metadatos del certificado.
-    - password: clave del .p12
-    - company / company_ruc: para ubicar la empresa
-    - file_url: opcional, prioriza archivo recién subido
-    - save_to_company: si =1 intenta guardar campos en Company
-    """
-    frappe.only_for(("System Manager", "Gerente", "Cajero"))
-
-    comp = _get_company_doc(company, company_ruc)
-
-    # IMPORTANTE: priorizar file_url entrante (nuevo), luego el guardado en Company
-    resolved_file_url = (file_url or comp.get("urlfirma") or "").strip()
-    if not resolved_file_url:
-        frappe.throw(_("La empresa {0} no tiene 'urlfirma' configurado.").format(comp.name))
-
+def _analyze_p12(resolved_file_url: str, password: str) -> dict:
+    """Abre el .p12 con la clave y devuelve los metadatos del certificado."""
     # Lee bytes del archivo
     _fname, file_content = get_file(resolved_file_url)
     if not file_content:
@@ -197,6 +181,38 @@ def analyze_company_firma(
         ),
     }
 
+    return info
+
+@frappe.whitelist()
+def analyze_company_firma(
+    password: str,
+    company: str = None,
+    company_ruc: str = None,
+    file_url: str = None,
+    save_to_company: int = 0,
+):
+    """
+    Valida la contraseña del .p12 de la Company y extrae metadatos del certificado.
+    - password: clave del .p12
+    - company / company_ruc: para ubicar la empresa
+    - file_url: opcional, prioriza archivo recién subido
+    - save_to_company: si =1 intenta guardar campos en Company
+    """
+    frappe.only_for(("System Manager", "Gerente", "Cajero"))
+
+    comp = _get_company_doc(company, company_ruc)
+
+    # IMPORTANTE: priorizar file_url entrante (nuevo), luego el guardado en Company
+    resolved_file_url = (file_url or comp.get("urlfirma") or "").strip()
+    if not resolved_file_url:
+        frappe.throw(_("La empresa {0} no tiene 'urlfirma' configurado.").format(comp.name))
+
+    # El parseo del .p12 se reutiliza mientras no cambien el archivo ni la clave
+    info = get_cached_analysis(comp.name, resolved_file_url, password)
+    if info is None:
+        info = _analyze_p12(resolved_file_url, password)
+        cache_analysis(comp.name, resolved_file_url, password, info)
+
     # Validación opcional contra RUC de la empresa
     comp_ruc = (comp.get("ruc") or "").strip()
     if comp_ruc and info["subject_id"] and comp_ruc != info["subject_id"]:
@@ -232,6 +248,11 @@ def analyze_company_firma(
             comp.update(updates)
             comp.save(ignore_permissions=True)
 
+        # Firma nueva: el perfil queda listo con lo recien analizado
+        clear_cert_profile(comp.name)
+        cache_analysis(comp.name, resolved_file_url, password, info)
+        set_cert_profile_from_analysis(comp.name, info)
+
     return {
         "ok": True,
         "company": comp.name,
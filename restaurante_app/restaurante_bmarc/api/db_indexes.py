@@ -0,0 +1,138 @@
+import frappe
+from frappe.utils import now_datetime
+
+from restaurante_app.restaurante_bmarc.api.pagination import keyset_sql_condition
+
+
+def ensure_indexes(indexes: list[tuple[str, list[str], str]]):
+    """
+    Crea los indices (doctype, columnas, nombre) que falten; idempotente.
+    Cada patch pasa su propia lista fija: cambiar una lista no altera patches ya aplicados.
+    """
+    for doctype, columns, index_name in indexes:
+        if not frappe.db.table_exists(doctype):
+            continue
+        if not all(frappe.db.has_column(doctype, column) for column in columns):
+            continue
+        frappe.db.add_index(doctype, columns, index_name)
+
+
+def _sample_cursor():
+    # Cursor cualquiera: solo importa la forma de la condicion keyset.
+    return now_datetime(), "~"
+
+
+def _hot_queries(company: str) -> list[tuple[str, str, dict, dict]]:
+    """
+    (descripcion, consulta, params, {tabla/alias: indice esperado}).
+    Los listados se arman con los mismos builders que los endpoints (filtros, joins y keyset).
+    """
+    from restaurante_app.facturacion_bmarc.einvoice.invoices_api import _invoice_list_query
+    from restaurante_app.restaurante_bmarc.doctype.orders.orders import _order_list_conditions, _order_list_sql
+
+    queries = []
+    for label, scope_user, order_index in (
+        ("get_all_orders", None, "company_creation_idx"),
+        ("get_all_orders (cajero)", frappe.session.user, "company_owner_creation_idx"),
+    ):
+        conditions, params = _order_list_conditions(company, scope_user=scope_user)
+        keyset, keyset_params = keyset_sql_condition(_sample_cursor(), alias="o")
+        queries.append((
+            f"{label} (cursor)",
+            _order_list_sql(conditions + [keyset], "o.creation desc, o.name desc", limit=20),
+            {**params, **keyset_params},
+            {"o": order_index, "x": "order_docstatus_idx"},
+        ))
+        queries.append((
+            label,
+            _order_list_sql(conditions, "o.creation desc", limit=20),
+            params,
+            {"o": order_index, "x": "order_docstatus_idx"},
+        ))
+
+    # get_all arma la consulta real con run=0 (valores ya interpolados).
+    for label, cursor_mode, cursor_key in (
+        ("get_all_invoices", False, None),
+        ("get_all_invoices (cursor)", True, _sample_cursor()),
+    ):
+        filters, or_filters, order_by = _invoice_list_query({"company_id": company}, cursor_mode, cursor_key)
+        query = frappe.get_all(
+            "Sales Invoice", filters=filters, or_filters=or_filters, order_by=order_by, limit=20, run=0
+        )
+        queries.append((label, query, {}, {"tabSales Invoice": "company_creation_idx"}))
+
+    params = {"company": company, "order": "", "codigo": "", "ident": "", "product": ""}
+    queries += [
+        (
+            "order items",
+            "SELECT i.product FROM `tabItems` i WHERE i.parent = %(order)s AND i.product IS NOT NULL",
+            params,
+            {"i": "parent_product_idx"},
+        ),
+        (
+            "producto por codigo",
+            "SELECT p.name FROM `tabProducto` p WHERE p.company_id = %(company)s AND p.codigo = %(codigo)s",
+            params,
+            {"p": "company_codigo_idx"},
+        ),
+        (
+            "cliente por identificacion",
+            "SELECT c.name FROM `tabCliente` c WHERE c.company_id = %(company)s"
+            " AND c.num_identificacion = %(ident)s",
+            params,
+            {"c": "company_identificacion_idx"},
+        ),
+        (
+            "get_inventory_movements",
+            "SELECT m.name FROM `tabMovimiento de Inventario` m WHERE m.company_id = %(company)s"
+            " ORDER BY m.posting_datetime DESC, m.name DESC LIMIT 20",
+            params,
+            {"m": "company_posting_idx"},
+        ),
+        (
+            "get_inventory_movements (producto)",
+            "SELECT d.parent FROM `tabDetalle Movimiento Inventario` d WHERE d.company_id = %(company)s"
+            " AND d.product = %(product)s ORDER BY d.posting_datetime DESC LIMIT 20",
+            params,
+            {"d": "company_product_posting_idx"},
+        ),
+    ]
+    return queries
+
+
+def explain_hot_queries(company: str | None = None) -> list[dict]:
+    """
+    Corre EXPLAIN sobre las consultas principales de listado y reporta el indice elegido.
+    Uso: bench --site <site> execute restaurante_app.restaurante_bmarc.api.db_indexes.explain_hot_queries
+    """
+    company = company or frappe.db.get_value("Company", {}, "name")
+    report = []
+    for label, query, params, expected_by_table in _hot_queries(company):
+        plan = {row.get("table"): row for row in frappe.db.sql(f"EXPLAIN {query}", params or (), as_dict=True)}
+        for table, expected in expected_by_table.items():
+            row = plan.get(table) or {}
+            possible = (row.get("possible_keys") or "").split(",")
+            report.append({
+                "query": f"{label} [{table}]",
+                "expected_index": expected,
+                "key": row.get("key"),
+                "possible_keys": row.get("possible_keys"),
+                "rows": row.get("rows"),
+                "ok": row.get("key") == expected,
+                # Con tablas casi vacias el optimizador puede preferir un scan; `usable` solo
+                # verifica que la forma de la consulta permite usar el indice.
+                "usable": expected in possible,
+            })
+    return report
+
+
+def check_hot_path_indexes(company: str | None = None):
+    """Igual que explain_hot_queries pero falla si alguna consulta no usa su indice."""
+    report = explain_hot_queries(company)
+    missing = [r for r in report if not r["ok"]]
+    if missing:
+        frappe.throw(
+            "Consultas sin el indice esperado: "
+            + ", ".join(f"{r['query']} (usa {r['key'] or 'ninguno'}, esperado {r['expected_index']})" for r in missing)
+        )
+    return report
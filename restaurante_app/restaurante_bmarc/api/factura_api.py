@@ -4,6 +4,7 @@ import frappe
 from frappe import _
 from frappe.utils.file_manager import save_file
 from frappe.utils import get_url as _abs_url
+from restaurante_app.facturacion_bmarc.api.http_client import http_get, http_post
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
 from restaurante_app.facturacion_bmarc.einvoice.utils import _parse_fecha_autorizacion
 # crypto para leer p12 (si está disponible)
@@ -68,7 +69,7 @@ def _read_file_bytes(file_url: str) -> bytes | None:
     # 2) Fallback HTTP si es público
     if file_url.startswith(("http://", "https://")) and "/private/" not in file_url:
         try:
-            r = requests.get(file_url, timeout=30)
+            r = http_get(file_url, timeout=30)
             if r.ok:
                 return r.content
         except Exception:
@@ -188,7 +189,7 @@ def firmar_xml(xml_string: str, company: str | None = None):
                 _err(errors, "P12_READ_FAIL", "No se pudo leer el .p12 para base64",
                      details=frappe.get_traceback(), log_title="Firma XML - base64 no disponible")
 
-        resp = requests.post(f"{API_URL}/api/Sri/firmarXml", headers=_headers(), json=payload, timeout=60)
+        resp = http_post(f"{API_URL}/api/Sri/firmarXml", headers=_headers(), json=payload, timeout=60)
         if resp.status_code != 200:
             _err(errors, "SIGN_SERVICE_ERROR",
                  f"Error {resp.status_code} al firmar: {resp.text}",
@@ -214,7 +215,7 @@ def enviar_a_sri(xml_firmado: str, ambiente: str | None = None, company: str | N
         ambiente_final = (ambiente or ctx["ambiente"]).strip()
 
         payload = {"xmlFirmado": xml_firmado, "ambiente": ambiente_final}
-        resp = requests.post(f"{API_URL}/api/Sri/enviar-sri", headers=_headers(), json=payload, timeout=60)
+        resp = http_post(f"{API_URL}/api/Sri/enviar-sri", headers=_headers(), json=payload, timeout=60)
         resp.raise_for_status()
 
         data = resp.json()
@@ -246,7 +247,7 @@ def consultar_autorizacion(clave_acceso: str, docname: str, ambiente: str | None
         ambiente_final = (ambiente or ctx["ambiente"]).strip()
 
         payload = {"claveAcceso": clave_acceso, "ambiente": ambiente_final}
-        resp = requests.post(f"{API_URL}/api/Sri/autorizacion", headers=_headers(), json=payload, timeout=60)
+        resp = http_post(f"{API_URL}/api/Sri/autorizacion", headers=_headers(), json=payload, timeout=60)
         resp.raise_for_status()
 
         respuesta_xml = resp.text
@@ -7,6 +7,9 @@ from datetime import datetime
 import random
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
+from restaurante_app.facturacion_bmarc.api.utils import reserve_sequence
+from restaurante_app.restaurante_bmarc.api.tax_catalog import get_tax_rate
+
 # =========================
 # Helpers de conversión/formatos
 # =========================
@@ -65,8 +68,7 @@ def obtener_tax_value(item) -> Decimal:
     tax_name = item.get("tax")
     if not tax_name:
         return Decimal("0")
-    val = frappe.get_value("taxes", tax_name, "value")
-    return to_decimal(val, Decimal("0"))
+    return to_decimal(get_tax_rate(tax_name), Decimal("0"))
 
 # =========================
 # Generación de XML
@@ -273,18 +275,8 @@ def generar_clave_acceso(fechaEmision, tipo_comprobante, ruc_emisor, tipo_ambien
     return clave_base_48 + digito_verificador
 
 def obtener_y_actualizar_secuencial(company_name):
-    company = frappe.get_doc("Company", company_name)
-
-    if company.ambiente == "PRODUCCION":
-        secuencial_actual = company.invoiceseq_prod or 1
-        company.invoiceseq_prod = secuencial_actual + 1
-    else:
-        secuencial_actual = company.invoiceseq_pruebas or 1
-        company.invoiceseq_pruebas = secuencial_actual + 1
-
-    secuencial_formateado = str(secuencial_actual).zfill(9)
-    company.save(ignore_permissions=True)
-    return secuencial_formateado
+    # Misma secuencia por punto de emision que el flujo del microservicio
+    return str(reserve_sequence(company_name, "invoice")).zfill(9)
 
 def obtener_ambiente(company):
     """Devuelve '1' (pruebas) o '2' (producción)."""
@@ -7,6 +7,9 @@ from datetime import datetime
 import random
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
+from restaurante_app.facturacion_bmarc.api.utils import reserve_sequence
+from restaurante_app.restaurante_bmarc.api.tax_catalog import get_tax_rate
+
 # =========================
 # Helpers compartidos
 # (si ya los tienes en el módulo, no los dupliques)
@@ -51,8 +54,7 @@ def obtener_tax_value(item) -> Decimal:
     tax_name = item.get("tax")
     if not tax_name:
         return Decimal("0")
-    val = frappe.get_value("taxes", tax_name, "value")
-    return to_decimal(val, Decimal("0"))
+    return to_decimal(get_tax_rate(tax_name), Decimal("0"))
 
 def formatear_ddmmyyyy(fecha_iso_yyyy_mm_dd: str) -> str:
     """'2025-08-06' -> '06/08/2025'"""
@@ -78,30 +80,10 @@ def normalizar_num_doc_modificado(num: str) -> str:
 
 # =========================
 # Secuencial (NC)
-# Crea en Company los campos:
-#   ncseq_prod, ncseq_pruebas  (o ajusta nombres aquí)
 # =========================
 def obtener_y_actualizar_secuencial_nc(company_name):
-    company = frappe.get_doc("Company", company_name)
-    try:
-        if company.ambiente == "PRODUCCION":
-            sec = getattr(company, "ncseq_prod", None) or 1
-            company.ncseq_prod = sec + 1
-        else:
-            sec = getattr(company, "ncseq_pruebas", None) or 1
-            company.ncseq_pruebas = sec + 1
-        company.save(ignore_permissions=True)
-        return str(sec).zfill(9)
-    except Exception:
-        # fallback: usa el mismo de factura si aún no creas campos específicos
-        if company.ambiente == "PRODUCCION":
-            sec = company.invoiceseq_prod or 1
-            company.invoiceseq_prod = sec + 1
-        else:
-            sec = company.invoiceseq_pruebas or 1
-            company.invoiceseq_pruebas = sec + 1
-        company.save(ignore_permissions=True)
-        return str(sec).zfill(9)
+    # Misma secuencia por punto de emision que el flujo del microservicio
+    return str(reserve_sequence(company_name, "nc")).zfill(9)
 
 # =========================
 # Clave de acceso / ambiente (reutiliza los tuyos si ya existen)
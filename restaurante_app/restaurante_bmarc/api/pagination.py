@@ -0,0 +1,80 @@
+import base64
+import hashlib
+import json
+
+import frappe
+from frappe import _
+from frappe.utils import cint, get_datetime
+
+# Segundos que se reutiliza un conteo total en modo cursor.
+COUNT_CACHE_TTL = 60
+
+
+def encode_cursor(creation, name: str) -> str:
+    """Cursor opaco para paginacion keyset sobre (creation, name)."""
+    raw = json.dumps([str(creation), name], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str | None):
+    """Devuelve (creation, name) o None si no hay cursor."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        creation, name = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        return get_datetime(creation), name
+    except Exception:
+        frappe.throw(_("Cursor de paginacion invalido"))
+
+
+def is_cursor_mode(use_cursor=None, cursor=None) -> bool:
+    return bool(cint(use_cursor) or cursor)
+
+
+def keyset_sql_condition(
+    cursor_key, ascending: bool = False, alias: str = "", column: str = "creation"
+) -> tuple[str, dict]:
+    """Condicion SQL (creation, name) > / < cursor, apta para el indice (company_id, creation).
+    `column` cambia la primera columna del keyset (p.ej. un `changed_at` calculado)."""
+    if not cursor_key:
+        return "", {}
+    prefix = f"{alias}." if alias else ""
+    op = ">" if ascending else "<"
+    creation, name = cursor_key
+    condition = (
+        f"({prefix}{column} {op} %(cursor_creation)s"
+        f" OR ({prefix}{column} = %(cursor_creation)s AND {prefix}name {op} %(cursor_name)s))"
+    )
+    return condition, {"cursor_creation": creation, "cursor_name": name}
+
+
+def keyset_filters(doctype: str, cursor_key, ascending: bool = False) -> tuple[list, list]:
+    """Misma condicion que keyset_sql_condition expresada como (filters, or_filters) de frappe.get_all."""
+    if not cursor_key:
+        return [], []
+    creation, name = cursor_key
+    op = ">" if ascending else "<"
+    bound = ">=" if ascending else "<="
+    filters = [[doctype, "creation", bound, creation]]
+    or_filters = [[doctype, "creation", op, creation], [doctype, "name", op, name]]
+    return filters, or_filters
+
+
+def next_cursor_from_rows(rows, limit: int, creation_key: str = "creation", name_key: str = "name"):
+    if not rows or len(rows) < cint(limit):
+        return None
+    last = rows[-1]
+    return encode_cursor(last.get(creation_key), last.get(name_key))
+
+
+def cached_count(doctype: str, cache_scope, count_fn) -> int:
+    """Conteo total reutilizado durante COUNT_CACHE_TTL para no recontar en cada pagina."""
+    digest = hashlib.sha1(json.dumps(cache_scope, sort_keys=True, default=str).encode()).hexdigest()
+    key = f"restaurante_app:list_count:{doctype}:{digest}"
+    cache = frappe.cache()
+    value = cache.get_value(key)
+    if value is None:
+        value = cint(count_fn())
+        cache.set_value(key, value, expires_in_sec=COUNT_CACHE_TTL)
+    return cint(value)
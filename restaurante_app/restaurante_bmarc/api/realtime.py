@@ -0,0 +1,55 @@
+import frappe
+from frappe.realtime import get_doc_room
+
+COMPANY_USERS_CACHE_KEY = "restaurante_app:company_users"
+
+
+def company_room(company: str) -> str:
+    """
+    Sala socket.io de la compania. El cliente se une con
+    frappe.realtime.doc_subscribe("Company", company); frappe valida el permiso
+    de lectura sobre la Company, asi que cada tenant solo recibe sus eventos.
+    """
+    return get_doc_room("Company", company)
+
+
+def company_event(company: str) -> str:
+    return f"brando_conect:company:{company}"
+
+
+def users_for_company(company: str) -> list[str]:
+    def _load():
+        rows = frappe.get_all(
+            "User Permission",
+            filters={"allow": "Company", "for_value": company},
+            fields=["user"]
+        )
+        return [r.user for r in rows]
+
+    return frappe.cache().hget(COMPANY_USERS_CACHE_KEY, company, generator=_load) or []
+
+
+def clear_company_users_cache(doc=None, method=None):
+    """doc_events de User Permission: invalida la membresia cacheada de la compania."""
+    if doc is None:
+        frappe.cache().delete_value(COMPANY_USERS_CACHE_KEY)
+        return
+    if getattr(doc, "allow", None) != "Company":
+        return
+    companies = {doc.for_value}
+    previous = doc.get_doc_before_save()
+    if previous and previous.get("for_value"):
+        companies.add(previous.for_value)
+    for company in companies:
+        if company:
+            frappe.cache().hdel(COMPANY_USERS_CACHE_KEY, company)
+
+
+def publish_to_company(company: str, message: dict, after_commit: bool = True):
+    """Un solo publish por evento hacia la sala de la compania."""
+    frappe.publish_realtime(
+        event=company_event(company),
+        message=message,
+        room=company_room(company),
+        after_commit=after_commit,
+    )
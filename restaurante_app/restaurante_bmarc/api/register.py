@@ -5,6 +5,7 @@ import frappe
 from frappe import _
 from frappe.utils.password import update_password
 from frappe.utils.file_manager import save_file
+from restaurante_app.facturacion_bmarc.api.cert_profile import clear_cert_profile
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
 from frappe.utils import cint
 
@@ -347,6 +348,9 @@ def company_set_signature(company: str, firma_json: str = None, clave: str = Non
         comp_doc.set("clave", str(clave))
         comp_doc.save(ignore_permissions=True)
 
+    # db_set de urlfirma no pasa por on_update: invalidar el perfil de firma aqui.
+    clear_cert_profile(comp_doc.name)
+
     return {"ok": True, "firma_url": firma_url}
 
 def _get_company_by_id_or_ruc(company: str | None, company_ruc: str | None):
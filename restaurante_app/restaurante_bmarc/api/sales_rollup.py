@@ -0,0 +1,303 @@
+import hashlib
+
+import frappe
+from frappe.utils import add_days, flt, getdate, now_datetime
+
+from restaurante_app.restaurante_bmarc.api.tax_catalog import resolve_row_tax_rate
+from restaurante_app.restaurante_bmarc.api.utils import meta_has_field
+
+DAILY_SALES_DOCTYPE = "Resumen Venta Diaria"
+DAILY_PRODUCT_SALES_DOCTYPE = "Resumen Venta Diaria Producto"
+
+
+def order_user_field() -> str:
+    """Campo de orders que identifica al usuario dueño de la venta (mismo criterio que los listados)."""
+    if meta_has_field("orders", "created_by"):
+        return "created_by"
+    if meta_has_field("orders", "usuario"):
+        return "usuario"
+    return "owner"
+
+
+def _rollup_name(*parts) -> str:
+    # Nombre determinista: permite INSERT ... ON DUPLICATE KEY UPDATE sobre la PK.
+    return hashlib.sha1("|".join(str(p or "") for p in parts).encode()).hexdigest()
+
+
+def _product_facts(order_doc) -> dict[str, list]:
+    """{product: [qty, net_amount, tax_amount]} de las filas de la orden."""
+    facts: dict[str, list] = {}
+    for row in getattr(order_doc, "items", None) or []:
+        product = row.get("product")
+        if not product:
+            continue
+        qty = flt(row.get("qty"))
+        net = qty * flt(row.get("rate"))
+        tax = net * resolve_row_tax_rate(row, order_doc.company_id) / 100.0
+        acc = facts.setdefault(product, [0.0, 0.0, 0.0])
+        acc[0] += qty
+        acc[1] += net
+        acc[2] += tax
+    return facts
+
+
+def _order_contribution(order_doc, user_field: str):
+    if not order_doc or not getattr(order_doc, "company_id", None):
+        return None
+    creation = getattr(order_doc, "creation", None) or now_datetime()
+    return {
+        "company_id": order_doc.company_id,
+        "fecha": getdate(creation),
+        "usuario": getattr(order_doc, user_field, None) or getattr(order_doc, "owner", None),
+        "total": flt(getattr(order_doc, "total", 0)),
+        "products": _product_facts(order_doc),
+    }
+
+
+def _collect_deltas(previous_doc, current_doc):
+    user_field = order_user_field()
+    header: dict[tuple, list] = {}
+    products: dict[tuple, list] = {}
+
+    for sign, doc in ((-1, previous_doc), (1, current_doc)):
+        contribution = _order_contribution(doc, user_field)
+        if not contribution:
+            continue
+        key = (contribution["company_id"], contribution["fecha"], contribution["usuario"])
+        acc = header.setdefault(key, [0, 0.0])
+        acc[0] += sign
+        acc[1] += sign * contribution["total"]
+        for product, (qty, net, tax) in contribution["products"].items():
+            acc = products.setdefault(key + (product,), [0.0, 0.0, 0.0, 0])
+            acc[0] += sign * qty
+            acc[1] += sign * net
+            acc[2] += sign * tax
+            acc[3] += sign
+
+    header = {key: acc for key, acc in header.items() if acc[0] or flt(acc[1])}
+    products = {key: acc for key, acc in products.items() if acc[3] or any(flt(v) for v in acc[:3])}
+    return header, products
+
+
+def apply_order_rollup(previous_doc=None, current_doc=None):
+    """
+    Ajusta el resumen diario con la diferencia entre la versión anterior y la actual de una orden.
+    - insert: (None, doc) | update: (doc_before_save, doc) | delete: (doc, None)
+    """
+    header, products = _collect_deltas(previous_doc, current_doc)
+    now_value = now_datetime()
+    user = frappe.session.user
+
+    if header:
+        values, params = [], []
+        for (company_id, fecha, usuario), (count, total) in header.items():
+            values.append("(%s, %s, %s, %s, %s, 0, 0, %s, %s, %s, %s, %s)")
+            params += [
+                _rollup_name(company_id, fecha, usuario), now_value, now_value, user, user,
+                company_id, fecha, usuario, count, flt(total),
+            ]
+        frappe.db.sql(
+            f"""
+            INSERT INTO `tab{DAILY_SALES_DOCTYPE}`
+                (name, creation, modified, owner, modified_by, docstatus, idx,
+                 company_id, fecha, usuario, total_orders, total_sales)
+            VALUES {", ".join(values)}
+            ON DUPLICATE KEY UPDATE
+                total_orders = total_orders + VALUES(total_orders),
+                total_sales = total_sales + VALUES(total_sales),
+                modified = VALUES(modified)
+            """,
+            params,
+        )
+
+    if products:
+        values, params = [], []
+        for (company_id, fecha, usuario, product), (qty, net, tax, count) in products.items():
+            values.append("(%s, %s, %s, %s, %s, 0, 0, %s, %s, %s, %s, %s, %s, %s, %s)")
+            params += [
+                _rollup_name(company_id, fecha, usuario, product), now_value, now_value, user, user,
+                company_id, fecha, usuario, product, flt(qty), flt(net), flt(tax), count,
+            ]
+        frappe.db.sql(
+            f"""
+            INSERT INTO `tab{DAILY_PRODUCT_SALES_DOCTYPE}`
+                (name, creation, modified, owner, modified_by, docstatus, idx,
+                 company_id, fecha, usuario, product, qty, net_amount, tax_amount, order_count)
+            VALUES {", ".join(values)}
+            ON DUPLICATE KEY UPDATE
+                qty = qty + VALUES(qty),
+                net_amount = net_amount + VALUES(net_amount),
+                tax_amount = tax_amount + VALUES(tax_amount),
+                order_count = order_count + VALUES(order_count),
+                modified = VALUES(modified)
+            """,
+            params,
+        )
+
+
+def get_daily_sales(company: str, fecha, usuario: str | None = None, top: int = 5) -> dict:
+    conditions = ["r.company_id = %(company)s", "r.fecha = %(fecha)s"]
+    params = {"company": company, "fecha": getdate(fecha)}
+    if usuario:
+        conditions.append("r.usuario = %(usuario)s")
+        params["usuario"] = usuario
+    where_clause = " AND ".join(conditions)
+
+    totals = frappe.db.sql(
+        f"""
+        SELECT COALESCE(SUM(r.total_orders), 0), COALESCE(SUM(r.total_sales), 0)
+        FROM `tab{DAILY_SALES_DOCTYPE}` r
+        WHERE {where_clause}
+        """,
+        params,
+    )[0]
+
+    top_products = frappe.db.sql(
+        f"""
+        SELECT
+            r.product,
+            COALESCE(p.nombre, r.product) AS nombre,
+            SUM(r.qty) AS qty
+        FROM `tab{DAILY_PRODUCT_SALES_DOCTYPE}` r
+        LEFT JOIN `tabProducto` p ON p.name = r.product
+        WHERE {where_clause}
+        GROUP BY r.product, p.nombre
+        HAVING SUM(r.qty) > 0
+        ORDER BY qty DESC
+        LIMIT {int(top)}
+        """,
+        params,
+        as_dict=True,
+    )
+
+    return {
+        "total_orders": int(totals[0] or 0),
+        "total_sales": flt(totals[1]),
+        "top_products": [{"name": row.nombre, "count": flt(row.qty)} for row in top_products],
+    }
+
+
+def get_product_sales_facts(company: str, from_date=None, to_date=None, limit: int = 50, offset: int = 0) -> dict:
+    """
+    Ranking de productos vendidos en el rango [from_date, to_date] leido del resumen diario,
+    sin recorrer taborders/tabItems.
+    """
+    conditions = ["r.company_id = %(company)s"]
+    params = {"company": company}
+    if from_date:
+        conditions.append("r.fecha >= %(from_date)s")
+        params["from_date"] = getdate(from_date)
+    if to_date:
+        conditions.append("r.fecha <= %(to_date)s")
+        params["to_date"] = getdate(to_date)
+    where_clause = " AND ".join(conditions)
+
+    data = frappe.db.sql(
+        f"""
+        SELECT
+            r.product AS producto,
+            COALESCE(p.nombre, '') AS nombre_producto,
+            COALESCE(p.descripcion, '') AS descripcion_producto,
+            SUM(r.qty) AS cantidad,
+            SUM(r.net_amount) AS monto_neto,
+            SUM(r.tax_amount) AS monto_iva,
+            SUM(r.order_count) AS ordenes
+        FROM `tab{DAILY_PRODUCT_SALES_DOCTYPE}` r
+        LEFT JOIN `tabProducto` p ON p.name = r.product
+        WHERE {where_clause}
+        GROUP BY r.product, p.nombre, p.descripcion
+        HAVING SUM(r.qty) != 0
+        ORDER BY cantidad DESC
+        LIMIT {int(limit)} OFFSET {int(offset)}
+        """,
+        params,
+        as_dict=True,
+    )
+
+    total = frappe.db.sql(
+        f"""
+        SELECT COUNT(*) FROM (
+            SELECT r.product
+            FROM `tab{DAILY_PRODUCT_SALES_DOCTYPE}` r
+            WHERE {where_clause}
+            GROUP BY r.product
+            HAVING SUM(r.qty) != 0
+        ) t
+        """,
+        params,
+    )[0][0]
+
+    return {"result": data, "total": total}
+
+
+def rebuild_sales_rollup(company: str | None = None, from_date=None, to_date=None):
+    """
+    Recalcula el resumen diario desde taborders/tabItems (backfill o corrección).
+    Uso: bench execute restaurante_app.restaurante_bmarc.api.sales_rollup.rebuild_sales_rollup
+    """
+    user_field = order_user_field()
+    conditions = ["o.docstatus < 2"]
+    target_conditions = ["1=1"]
+    params = {}
+    if company:
+        conditions.append("o.company_id = %(company)s")
+        target_conditions.append("company_id = %(company)s")
+        params["company"] = company
+    if from_date:
+        conditions.append("o.creation >= %(from_dt)s")
+        target_conditions.append("fecha >= %(from_date)s")
+        params["from_dt"] = getdate(from_date)
+        params["from_date"] = getdate(from_date)
+    if to_date:
+        conditions.append("o.creation < %(to_dt)s")
+        target_conditions.append("fecha <= %(to_date)s")
+        params["to_dt"] = add_days(getdate(to_date), 1)
+        params["to_date"] = getdate(to_date)
+
+    where_clause = " AND ".join(conditions)
+    target_where = " AND ".join(target_conditions)
+    usuario_expr = f"COALESCE(o.`{user_field}`, o.owner)"
+    params["now"] = now_datetime()
+    params["user"] = frappe.session.user
+
+    frappe.db.sql(f"DELETE FROM `tab{DAILY_SALES_DOCTYPE}` WHERE {target_where}", params)
+    frappe.db.sql(f"DELETE FROM `tab{DAILY_PRODUCT_SALES_DOCTYPE}` WHERE {target_where}", params)
+
+    frappe.db.sql(
+        f"""
+        INSERT INTO `tab{DAILY_SALES_DOCTYPE}`
+            (name, creation, modified, owner, modified_by, docstatus, idx,
+             company_id, fecha, usuario, total_orders, total_sales)
+        SELECT
+            SHA1(CONCAT(o.company_id, '|', DATE(o.creation), '|', COALESCE({usuario_expr}, ''))),
+            %(now)s, %(now)s, %(user)s, %(user)s, 0, 0,
+            o.company_id, DATE(o.creation), {usuario_expr},
+            COUNT(*), COALESCE(SUM(o.total), 0)
+        FROM `taborders` o
+        WHERE {where_clause} AND o.company_id IS NOT NULL
+        GROUP BY o.company_id, DATE(o.creation), {usuario_expr}
+        """,
+        params,
+    )
+
+    frappe.db.sql(
+        f"""
+        INSERT INTO `tab{DAILY_PRODUCT_SALES_DOCTYPE}`
+            (name, creation, modified, owner, modified_by, docstatus, idx,
+             company_id, fecha, usuario, product, qty, net_amount, tax_amount, order_count)
+        SELECT
+            SHA1(CONCAT(o.company_id, '|', DATE(o.creation), '|', COALESCE({usuario_expr}, ''), '|', i.product)),
+            %(now)s, %(now)s, %(user)s, %(user)s, 0, 0,
+            o.company_id, DATE(o.creation), {usuario_expr}, i.product,
+            SUM(i.qty),
+            SUM(i.qty * i.rate),
+            SUM(i.qty * i.rate * COALESCE(i.tax_rate, t.value, 0) / 100),
+            COUNT(DISTINCT o.name)
+        FROM `taborders` o
+        JOIN `tabItems` i ON i.parent = o.name AND i.parenttype = 'orders'
+        LEFT JOIN `tabtaxes` t ON t.name = i.tax
+        WHERE {where_clause} AND o.company_id IS NOT NULL AND i.product IS NOT NULL
+        GROUP BY o.company_id, DATE(o.creation), {usuario_expr}, i.product
+        """,
+        params,
+    )
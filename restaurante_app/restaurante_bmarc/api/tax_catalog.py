@@ -0,0 +1,69 @@
+import frappe
+from frappe.utils import flt
+
+TAX_CATALOG_CACHE_KEY = "restaurante_app:tax_catalog"
+TAX_COMPANY_CACHE_KEY = "restaurante_app:tax_company"
+
+
+def get_tax_catalog(company: str) -> dict[str, float]:
+    """
+    {name: value} de los impuestos de la compania.
+    Se guarda en redis (compartido entre workers) y se memoriza por request,
+    asi que calcular totales no consulta la base por cada linea.
+    """
+    if not company:
+        return {}
+
+    def _load():
+        rows = frappe.get_all(
+            "taxes",
+            filters={"company_id": company},
+            fields=["name", "value"],
+        )
+        return {r.name: flt(r.value) for r in rows}
+
+    return frappe.cache().hget(TAX_CATALOG_CACHE_KEY, company, generator=_load) or {}
+
+
+def _tax_company(tax_name: str):
+    # Solo para llamadas que no conocen la compania (filas sueltas de factura).
+    return frappe.cache().hget(
+        TAX_COMPANY_CACHE_KEY,
+        tax_name,
+        generator=lambda: frappe.db.get_value("taxes", tax_name, "company_id"),
+    )
+
+
+def get_tax_rate(tax_name: str | None, company: str | None = None) -> float:
+    if not tax_name:
+        return 0.0
+    company = company or _tax_company(tax_name)
+    catalog = get_tax_catalog(company)
+    if tax_name in catalog:
+        return flt(catalog[tax_name])
+    # Impuesto creado por otro proceso despues de cargar el catalogo
+    value = frappe.db.get_value("taxes", tax_name, "value")
+    if value is not None and company:
+        clear_tax_catalog(company)
+    return flt(value)
+
+
+def resolve_row_tax_rate(item_row, company: str | None = None) -> float:
+    """tax_rate de la fila si viene; si no, la tarifa del impuesto enlazado (row o dict)."""
+    if isinstance(item_row, dict):
+        tax_rate, tax_name = item_row.get("tax_rate"), item_row.get("tax")
+    else:
+        tax_rate, tax_name = getattr(item_row, "tax_rate", None), getattr(item_row, "tax", None)
+    if tax_rate is not None:
+        return flt(tax_rate)
+    return get_tax_rate(tax_name, company)
+
+
+def clear_tax_catalog(company: str | None = None, tax_name: str | None = None):
+    cache = frappe.cache()
+    if company:
+        cache.hdel(TAX_CATALOG_CACHE_KEY, company)
+    else:
+        cache.delete_value(TAX_CATALOG_CACHE_KEY)
+    if tax_name:
+        cache.hdel(TAX_COMPANY_CACHE_KEY, tax_name)
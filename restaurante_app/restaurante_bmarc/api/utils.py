@@ -1,4 +1,5 @@
 import frappe
+from frappe.utils import add_days, getdate
 
 @frappe.whitelist()
 def get_usuarios_con_roles(usuario=None, rol=None):
@@ -70,4 +71,20 @@ def normalize_datetime_param(value: str | None, *, end: bool = False) -> str | N
     v = str(value).strip()
     if " " not in v:
         v += " 23:59:59" if end else " 00:00:00"
-    return v
\ No newline at end of file
+    return v
+
+
+def date_range_conditions(column: str, from_date=None, to_date=None) -> tuple[list[str], dict]:
+    """
+    Rango semiabierto [from_date 00:00, to_date + 1 dia 00:00) sobre una columna datetime.
+    Equivale a DATE(column) BETWEEN from_date AND to_date, pero sin envolver la columna,
+    asi que la consulta puede usar el indice (company_id, creation).
+    """
+    conditions, params = [], {}
+    if from_date:
+        conditions.append(f"{column} >= %(from_dt)s")
+        params["from_dt"] = getdate(from_date)
+    if to_date:
+        conditions.append(f"{column} < %(to_dt)s")
+        params["to_dt"] = add_days(getdate(to_date), 1)
+    return conditions, params
@@ -1,9 +1,15 @@
 # Copyright (c) 2025, none and contributors
 # For license information, please see license.txt
 
-# import frappe
 from frappe.model.document import Document
 
+from restaurante_app.facturacion_bmarc.api.cert_profile import clear_cert_profile
+from restaurante_app.facturacion_bmarc.api.utils import sync_sequences_from_company
+
 
 class Company(Document):
-	pass
+	def on_update(self):
+		# urlfirma / clave / cert_not_after pueden haber cambiado
+		clear_cert_profile(self.name)
+		# invoiceseq_* / ncseq_* editados reinician la Secuencia SRI
+		sync_sequences_from_company(self)
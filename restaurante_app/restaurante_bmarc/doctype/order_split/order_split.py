@@ -8,14 +8,11 @@ from frappe import _
 from frappe.model.document import Document
 from frappe.utils import flt
 
+from restaurante_app.restaurante_bmarc.api.tax_catalog import resolve_row_tax_rate
 
-def _resolve_tax_rate(item_row) -> float:
-    if getattr(item_row, "tax_rate", None) is not None:
-        return flt(item_row.tax_rate)
-    tax_name = getattr(item_row, "tax", None)
-    if not tax_name:
-        return 0.0
-    return flt(frappe.get_value("taxes", tax_name, "value") or 0)
+
+def _resolve_tax_rate(item_row, company: str | None = None) -> float:
+    return resolve_row_tax_rate(item_row, company)
 
 
 def _money_2(value) -> Decimal:
@@ -50,7 +47,7 @@ class OrderSplit(Document):
         for row in self.items or []:
             qty = flt(row.qty)
             rate = flt(row.rate)
-            tax_rate = _resolve_tax_rate(row)
+            tax_rate = _resolve_tax_rate(row, self.company_id)
 
             line_subtotal = flt(qty * rate)
             line_iva = flt(line_subtotal * (tax_rate / 100.0))
@@ -1,22 +1,43 @@
 # restaurante_app/restaurante_bmarc/doctype/orders/orders.py
 import frappe
 from enum import Enum
+from functools import partial
 from typing import Optional
 from frappe.model.document import Document
 from frappe import _
 from frappe.utils import cint, flt, getdate, today as _today
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
+from restaurante_app.restaurante_bmarc.api.tax_catalog import resolve_row_tax_rate
+from restaurante_app.restaurante_bmarc.api.realtime import publish_to_company, users_for_company
+from restaurante_app.restaurante_bmarc.api.sales_rollup import (
+    apply_order_rollup,
+    get_daily_sales,
+    get_product_sales_facts,
+    order_user_field,
+)
+from restaurante_app.restaurante_bmarc.api.pagination import (
+    cached_count,
+    decode_cursor,
+    encode_cursor,
+    is_cursor_mode,
+    keyset_sql_condition,
+    next_cursor_from_rows,
+)
 from restaurante_app.facturacion_bmarc.api.utils import persist_after_emit,_parse_dt_or_date
 
 from restaurante_app.facturacion_bmarc.api.open_factura_client import (
     emitir_factura_por_invoice,
 )
 from restaurante_app.facturacion_bmarc.einvoice.edocs import sri_estado_and_update_data
+from restaurante_app.facturacion_bmarc.einvoice.status_sweeper import schedule_status_check
 from restaurante_app.facturacion_bmarc.einvoice.utils import puede_facturar
 from restaurante_app.inventarios_bmarc.api.stock import (
+    build_recorded_stock_delta,
     build_stock_delta,
+    check_stock_delta,
     create_inventory_movement_entry,
-    validate_stock_delta,
+    inventory_async_enabled,
+    reserve_stock_and_queue_movement,
 )
 
 def meta_has_field(doctype: str, fieldname: str) -> bool:
@@ -26,15 +47,6 @@ def meta_has_field(doctype: str, fieldname: str) -> bool:
     except Exception:
         return False
 
-def users_for_company(company: str) -> list[str]:
-    rows = frappe.get_all(
-        "User Permission",
-        filters={"allow": "Company", "for_value": company},
-        fields=["user"]
-    )
-    return [r.user for r in rows]
-
-
 class EInvoiceStatus(str, Enum):
     AUTHORIZED = "AUTHORIZED"
     ERROR = "ERROR"
@@ -44,6 +56,8 @@ class EInvoiceStatus(str, Enum):
     NOT_AUTHORIZED = "NOT_AUTHORIZED"
 
 
+CUSTOMER_INFO_FIELDS = ["nombre", "num_identificacion", "correo", "telefono", "direccion"]
+
 RECOVERABLE_ERROR_KEYWORDS = [
     "CLAVE ACCESO REGISTRADA",
     "CLAVE DE ACCESO EN PROCESAMIENTO",
@@ -114,10 +128,8 @@ def _sri_forma_pago(code: Optional[str]) -> str:
         return "01"
 
 
-def _resolve_tax_rate(item_row) -> float:
-    if getattr(item_row, "tax_rate", None) is not None:
-        return flt(item_row.tax_rate)
-    return flt(frappe.get_value("taxes", getattr(item_row, "tax", None), "value") or 0)
+def _resolve_tax_rate(item_row, company: Optional[str] = None) -> float:
+    return resolve_row_tax_rate(item_row, company)
 
 
 def _append_sales_invoice_payments_from_order(inv, order_doc):
@@ -167,11 +179,11 @@ def _sync_status_or_enqueue(invoice_name: str, api_result: dict) -> dict:
             frappe.get_traceback(),
             f"Error consultando estado SRI para factura {invoice_name}",
         )
-        enqueue_status_update(invoice_name, "factura")
+        schedule_status_check(invoice_name, "factura")
         return api_result
 
     if str(sri_result.get("status") or "").upper() != EInvoiceStatus.AUTHORIZED.value:
-        enqueue_status_update(invoice_name, "factura")
+        schedule_status_check(invoice_name, "factura")
     return sri_result
 
 # orders.py
@@ -183,55 +195,28 @@ class orders(Document):
         """
 
         # ---------- CUSTOMER ----------
-        customer_info = _safe_customer_info(self.customer)
+        # before_save ya leyó el cliente; solo se consulta si no pasó por save (p.ej. on_trash)
+        customer_row = getattr(self.flags, "customer_row", None)
+        if customer_row is not None:
+            customer_info = _customer_info_from_row(self.customer, customer_row)
+        else:
+            customer_info = _safe_customer_info(self.customer)
 
         # ---------- ITEMS ----------
-        items = []
-
-        for it in self.items or []:
-            qty = flt(it.qty)
-            rate = flt(it.rate)
-
-            tax_rate = _resolve_tax_rate(it)
-
-            subtotal = qty * rate
-            iva = subtotal * (tax_rate / 100.0)
-            total = subtotal + iva
-
-            items.append({
-                "productId": it.product,
-                "productName": _safe_product_name(it.product),
-                "quantity": qty,
-                "price": rate,
-                "tax_rate": tax_rate,
-                "subtotal": subtotal,
-                "iva": iva,
-                "total": total,
-            })
+        product_names = _product_name_map([it.product for it in self.items or []])
+        items = [
+            _build_line_payload(
+                it.product,
+                product_names.get(it.product),
+                it.qty,
+                it.rate,
+                _resolve_tax_rate(it, self.company_id),
+            )
+            for it in self.items or []
+        ]
 
         # ---------- SRI ----------
-        sri = {"status": "Sin factura"}
-
-        inv = frappe.get_all(
-            "Sales Invoice",
-            filters={"order": self.name, "docstatus": ["!=", 2]},
-            fields=["name", "einvoice_status", "authorization_datetime", "access_key", "estab", "ptoemi", "secuencial", "grand_total"],
-            limit=1
-        )
-
-        if inv:
-            inv = inv[0]
-            parts = [inv.get("estab") or "", inv.get("ptoemi") or "", inv.get("secuencial") or ""]
-            number = "-".join([p for p in parts if p]).strip("-") or None
-
-            sri = {
-                "status": inv.get("einvoice_status") or "Draft",
-                "authorization_datetime": inv.get("authorization_datetime"),
-                "access_key": inv.get("access_key"),
-                "invoice": inv.get("name"),
-                "number": number,
-                "grand_total": inv.get("grand_total"),
-            }
+        sri = _sri_from_invoice_row(self._current_invoice_row())
 
         # ---------- PAYLOAD FINAL ----------
         return {
@@ -252,10 +237,60 @@ class orders(Document):
             "payments": self.payments or [],
         }
 
+    def _current_invoice_row(self):
+        # Una orden recién creada todavía no puede tener factura.
+        if getattr(self.flags, "is_new_order", False):
+            return None
+        fields = ["name", "einvoice_status", "authorization_datetime", "access_key", "estab", "ptoemi", "secuencial", "grand_total"]
+        if getattr(self, "sales_invoice", None):
+            return frappe.db.get_value("Sales Invoice", self.sales_invoice, fields, as_dict=True)
+        inv = frappe.get_all(
+            "Sales Invoice",
+            filters={"order": self.name, "docstatus": ["!=", 2]},
+            fields=fields,
+            limit=1,
+        )
+        return inv[0] if inv else None
+
+    def update_child_table(self, fieldname: str, df=None):
+        """
+        Escribe solo las filas hijas que cambiaron respecto a la versión guardada.
+        Frappe, por defecto, ejecuta un UPDATE por cada fila aunque no haya cambiado.
+        """
+        previous_doc = self.get_doc_before_save()
+        if not previous_doc or fieldname not in DIFF_CHILD_TABLES:
+            return super().update_child_table(fieldname, df)
+
+        df = df or self.meta.get_field(fieldname)
+        removed, changed = _child_rows_diff(previous_doc, self, fieldname)
+        if removed:
+            frappe.db.delete(df.options, {
+                "parent": self.name,
+                "parenttype": self.doctype,
+                "parentfield": fieldname,
+                "name": ["in", removed],
+            })
+
+        for row in changed:
+            row.db_update()
+
     def _build_inventory_delta(self):
-        previous_doc = None if self.is_new() else self.get_doc_before_save()
-        previous_rows = previous_doc.items if previous_doc else []
-        return build_stock_delta(previous_rows, self.items or [])
+        if self.is_new():
+            return build_stock_delta([], self.items or [], self.company_id)
+        # Sin cambios en items (notas, mesa, pagos...) no se toca el stock ni se consulta el kardex.
+        previous_doc = self.get_doc_before_save()
+        if previous_doc:
+            removed, changed = _child_rows_diff(previous_doc, self, "items")
+            if not removed and not changed:
+                return {}
+        # Contra lo ya descontado por la orden: un cambio posterior de receta no descuadra el stock.
+        return build_recorded_stock_delta(
+            "orders",
+            self.name,
+            self.items or [],
+            self.company_id,
+            previous_rows=previous_doc.items if previous_doc else [],
+        )
 
     def _apply_inventory_delta(self, delta_map, default_movement_type: str, notes: str):
         if not delta_map:
@@ -269,6 +304,17 @@ class orders(Document):
             elif all(delta > 0 for delta in deltas):
                 movement_type = "Reversa Venta"
 
+        if inventory_async_enabled(self.company_id):
+            # Reserva el stock ahora; el kardex detallado se escribe desde la cola
+            return reserve_stock_and_queue_movement(
+                company_id=self.company_id,
+                qty_map=delta_map,
+                movement_type=movement_type,
+                reference_doctype="orders",
+                reference_name=self.name,
+                notes=notes,
+            )
+
         return create_inventory_movement_entry(
             company_id=self.company_id,
             qty_map=delta_map,
@@ -280,18 +326,24 @@ class orders(Document):
         )
 
     def before_save(self):
-        if self.customer and not frappe.db.exists("Cliente", self.customer):
-            frappe.throw(_("El Cliente '{0}' no existe.").format(self.customer))
+        self.flags.is_new_order = self.is_new()
+        # Se guarda la fila del cliente para reutilizarla en el payload realtime
+        self.flags.customer_row = None
+        if self.customer:
+            self.flags.customer_row = frappe.db.get_value("Cliente", self.customer, CUSTOMER_INFO_FIELDS, as_dict=True)
+            if not self.flags.customer_row:
+                frappe.throw(_("El Cliente '{0}' no existe.").format(self.customer))
         self.calculate_totals()
 
         inventory_delta = self._build_inventory_delta()
         self.flags.inventory_stock_delta = inventory_delta
-        if inventory_delta:
-            validate_stock_delta(self.company_id, inventory_delta)
+        # Sin locks: el descuento real (UPDATE condicional) es el último paso de on_update.
+        # create_orders_bulk ya hizo esta validación para el bloque completo.
+        if inventory_delta and not getattr(self.flags, "stock_prevalidated", False):
+            check_stock_delta(self.company_id, inventory_delta)
 
     def _publish_to_company_users(self, action: str):
         company = getattr(self, "company_id", None) or getattr(self, "empresa", None) or "DEFAULT"
-        company_users = users_for_company(company)
 
         payload = self._build_realtime_payload()
 
@@ -301,43 +353,43 @@ class orders(Document):
             "data": payload,
             "_action": action,
             "company": company,
-            "user": company_users
+            "user": users_for_company(company),
         }
 
-        ev = f"brando_conect:company:{company}"
-
-        for user in company_users:
-            frappe.publish_realtime(
-                event=ev,
-                message=msg,
-                user=user,
-                after_commit=True
-            )
+        # Un solo mensaje a la sala de la compania (ver realtime.company_room)
+        publish_to_company(company, msg)
 
+    # Los UPDATE que bloquean filas compartidas (stock de Producto, resumen diario por usuario)
+    # son lo último del insert/save: on_update corre después de after_insert, así que kardex y
+    # payload realtime ya están hechos cuando se toman los locks, y se sueltan en el commit.
     def after_insert(self):
-        self._apply_inventory_delta(
-            getattr(self.flags, "inventory_stock_delta", {}) or build_stock_delta([], self.items or []),
-            "Venta",
-            f"Salida automatica por creacion de orden {self.name}",
-        )
         self._publish_to_company_users("insert")
 
     def on_update(self):
-        if not getattr(self.flags, "in_insert", False):
+        self._publish_to_company_users("update")
+        if getattr(self.flags, "in_insert", False):
+            self._apply_inventory_delta(
+                getattr(self.flags, "inventory_stock_delta", {}) or build_stock_delta([], self.items or [], self.company_id),
+                "Venta",
+                f"Salida automatica por creacion de orden {self.name}",
+            )
+            apply_order_rollup(None, self)
+        else:
             self._apply_inventory_delta(
                 getattr(self.flags, "inventory_stock_delta", {}),
                 "Ajuste",
                 f"Ajuste automatico por actualizacion de orden {self.name}",
             )
-        self._publish_to_company_users("update")
+            apply_order_rollup(self.get_doc_before_save(), self)
 
     def on_trash(self):
+        self._publish_to_company_users("delete")
         self._apply_inventory_delta(
-            build_stock_delta(self.items or [], []),
+            build_recorded_stock_delta("orders", self.name, [], self.company_id, previous_rows=self.items or []),
             "Reversa Venta",
             f"Reversa automatica por eliminacion de orden {self.name}",
         )
-        self._publish_to_company_users("delete")
+        apply_order_rollup(self, None)
 
     def calculate_totals(self):
         subtotal = 0.0
@@ -345,7 +397,7 @@ class orders(Document):
         for it in self.items or []:
             qty  = flt(it.qty)
             rate = flt(it.rate)
-            tax_val = _resolve_tax_rate(it)
+            tax_val = _resolve_tax_rate(it, self.company_id)
             line_subtotal = qty * rate
             line_iva = line_subtotal * (tax_val / 100.0)
             subtotal += line_subtotal
@@ -370,29 +422,76 @@ class orders(Document):
     
 
 # ========== HELPERS ==========
+# Tablas hijas que update_order concilia fila a fila (ver orders.update_child_table).
+DIFF_CHILD_TABLES = ("items", "payments")
+_CHILD_AUDIT_FIELDS = {"creation", "modified", "modified_by", "owner"}
+
+
+def _child_row_values(row) -> dict:
+    values = row.get_valid_dict(convert_dates_to_str=True, ignore_nulls=False)
+    return {k: v for k, v in values.items() if k not in _CHILD_AUDIT_FIELDS}
+
+
+def _child_rows_diff(previous_doc, doc, fieldname: str) -> tuple[list[str], list]:
+    """(names de filas eliminadas, filas nuevas o modificadas) de la tabla hija frente a previous_doc."""
+    before = {row.name: _child_row_values(row) for row in previous_doc.get(fieldname) or []}
+    rows = doc.get(fieldname) or []
+    kept = {row.name for row in rows if row.name and not row.is_new()}
+    removed = [name for name in before if name not in kept]
+    changed = [
+        row for row in rows
+        if row.is_new() or row.name not in before or _child_row_values(row) != before[row.name]
+    ]
+    return removed, changed
+
+
+def _sync_child_rows(doc, fieldname: str, incoming: list[dict], key_field: str):
+    """
+    Concilia la tabla hija con las filas recibidas sin reconstruirla:
+    empareja por name de la fila y, si no viene, por key_field (producto / forma de pago).
+    Solo se modifican, agregan o eliminan las filas que cambiaron.
+    """
+    existing = list(doc.get(fieldname) or [])
+    by_name = {row.name: row for row in existing if row.name}
+    by_key: dict[str, list] = {}
+    for row in existing:
+        by_key.setdefault(row.get(key_field), []).append(row)
+
+    matched = set()
+    new_rows = []
+    for values in incoming:
+        row = by_name.get(values.get("name"))
+        if row is None or id(row) in matched:
+            row = next((r for r in by_key.get(values.get(key_field), []) if id(r) not in matched), None)
+
+        if row is None:
+            new_rows.append(values)
+            continue
+
+        matched.add(id(row))
+        for field, value in values.items():
+            if field != "name" and row.get(field) != value:
+                row.set(field, value)
+
+    for row in existing:
+        if id(row) not in matched:
+            doc.remove(row)
+
+    for values in new_rows:
+        doc.append(fieldname, {k: v for k, v in values.items() if k != "name"})
+
 def _safe_customer_info(customer: str) -> dict:
     """Devuelve info básica del cliente.
     customer puede ser el name del DocType (p.ej. CLT-0001) o el nombre.
     """
     try:
-        row = frappe.db.get_value(
-            "Cliente",
-            customer,
-            ["nombre", "num_identificacion", "correo","telefono","direccion"],  # ajusta los nombres de campo si en tu doctype son distintos
-            as_dict=True
-        )
+        row = frappe.db.get_value("Cliente", customer, CUSTOMER_INFO_FIELDS, as_dict=True)
         if row:
-            return {
-                "nombre": row.get("nombre") or customer,
-                "num_identificacion": row.get("num_identificacion") or "",
-                "correo": row.get("correo") or "",
-                "telefono": row.get("telefono") or "",
-                "direccion": row.get("direccion") or "",
-            }
+            return _customer_info_from_row(customer, row)
     except Exception:
         pass
     # fallback si no encuentra nada
-    return {"nombre": customer, "num_identificacion": "", "correo": "", "telefono": "", "direccion": ""}
+    return _customer_info_from_row(customer, None)
 
 # Si quieres mantener compatibilidad con el helper viejo:
 def _safe_customer_name(customer: str) -> str:
@@ -405,6 +504,15 @@ def _safe_product_name(product):
     except Exception:
         return product
 
+
+def _product_name_map(product_ids) -> dict[str, str]:
+    """Nombres legibles de varios productos en una sola consulta."""
+    product_ids = sorted({p for p in product_ids or [] if p})
+    if not product_ids:
+        return {}
+    rows = frappe.get_all("Producto", filters={"name": ["in", product_ids]}, fields=["name", "nombre"])
+    return {r["name"]: r.get("nombre") or r["name"] for r in rows}
+
 @frappe.whitelist()
 def update_order():
     user = frappe.session.user
@@ -449,10 +557,9 @@ def update_order():
         if not items:
             frappe.throw(_("La orden debe tener al menos un item"))
 
-        order.set("items", [])
-
         subtotal_calc = 0
         iva_calc = 0
+        item_rows = []
 
         for r in items:
             qty = flt(r.get("qty"))
@@ -465,7 +572,8 @@ def update_order():
             subtotal_calc += line_subtotal
             iva_calc += line_tax
 
-            order.append("items", {
+            item_rows.append({
+                "name": r.get("name"),
                 "product": r.get("product"),
                 "qty": qty,
                 "rate": rate,
@@ -474,6 +582,9 @@ def update_order():
                 "tax": r.get("tax")
             })
 
+        # Solo se escriben las filas agregadas, modificadas o eliminadas
+        _sync_child_rows(order, "items", item_rows, "product")
+
         order.subtotal = subtotal_calc
         order.iva = iva_calc
         order.total = subtotal_calc + iva_calc
@@ -487,9 +598,8 @@ def update_order():
         if not payments:
             frappe.throw(_("Debe existir al menos un método de pago"))
 
-        order.set("payments", [])
-
         total_paid = 0
+        payment_rows = []
 
         for p in payments:
             forma_pago = p.get("formas_de_pago") or p.get("method") or p.get("code")
@@ -500,11 +610,14 @@ def update_order():
                 frappe.throw(_("El monto de cada pago debe ser mayor a 0"))
             total_paid += amount
 
-            order.append("payments", {
+            payment_rows.append({
+                "name": p.get("name"),
                 "formas_de_pago": forma_pago,
                 "monto": amount,
             })
 
+        _sync_child_rows(order, "payments", payment_rows, "formas_de_pago")
+
         # ?? Validar que pagos cuadren
         if round(total_paid, 2) != round(order.total, 2):
             frappe.throw(_("El total pagado no coincide con el total de la orden"))
@@ -547,10 +660,11 @@ def get_order_with_details(order_name):
             pass
 
     items = []
+    product_names = _product_name_map([it.product for it in order.items or []])
     for it in order.items or []:
         items.append({
             "productId": it.product,
-            "productName": _safe_product_name(it.product),
+            "productName": product_names.get(it.product, it.product),
             "quantity": it.qty,
             "price": it.rate,
             "total": it.total
@@ -596,8 +710,225 @@ def _get_invoice_status_for_order(order_name: str):
         "invoice": it.get("name")
     }
 
+# ---------- Proyeccion de listados de ordenes ----------
+# Una sola consulta trae cabecera de la orden, datos del cliente y la factura
+# vigente; los items se resuelven en lote. El numero de consultas por request
+# no depende del tamano de la pagina.
+_ORDER_LIST_SELECT = """
+    SELECT
+        o.name,
+        o.status,
+        o.estado,
+        o.creation,
+        o.modified,
+        o.subtotal,
+        o.iva,
+        o.total,
+        o.owner,
+        o.alias,
+        o.email,
+        o.customer,
+        c.name AS customer_exists,
+        c.nombre AS customer_nombre,
+        c.num_identificacion AS customer_num_identificacion,
+        c.correo AS customer_correo,
+        c.telefono AS customer_telefono,
+        c.direccion AS customer_direccion,
+        si.name AS invoice_name,
+        si.einvoice_status AS invoice_einvoice_status,
+        si.authorization_datetime AS invoice_authorization_datetime,
+        si.access_key AS invoice_access_key,
+        si.estab AS invoice_estab,
+        si.ptoemi AS invoice_ptoemi,
+        si.secuencial AS invoice_secuencial,
+        si.grand_total AS invoice_grand_total
+    FROM `taborders` o
+    LEFT JOIN `tabCliente` c ON c.name = o.customer
+    LEFT JOIN `tabSales Invoice` si ON si.name = (
+        SELECT MAX(x.name)
+        FROM `tabSales Invoice` x
+        WHERE x.`order` = o.name AND x.docstatus != 2
+    )
+"""
+
+
+def _order_list_conditions(company: str, scope_user: Optional[str] = None, status=None, dt_from=None, dt_to=None):
+    """Filtros base de get_all_orders (también los usa db_indexes para el EXPLAIN)."""
+    conditions = ["o.company_id = %(company)s", "o.docstatus != 2"]
+    params = {"company": company}
+
+    if scope_user:
+        conditions.append(f"o.`{order_user_field()}` = %(user)s")
+        params["user"] = scope_user
+
+    # opcional: filtrar por estado si viene en querystring
+    if status:
+        conditions.append("o.status = %(status)s")
+        params["status"] = status
+
+    if dt_from:
+        conditions.append("o.creation >= %(dt_from)s")
+        params["dt_from"] = dt_from
+    if dt_to:
+        conditions.append("o.creation <= %(dt_to)s")
+        params["dt_to"] = dt_to
+    return conditions, params
+
+
+def _order_list_sql(conditions: list[str], order_by: str, limit: int = 0, offset: int = 0) -> str:
+    where_clause = " AND ".join(conditions) or "1=1"
+    limit_clause = f"LIMIT {cint(limit)} OFFSET {cint(offset)}" if cint(limit) else ""
+    return f"""
+        {_ORDER_LIST_SELECT}
+        WHERE {where_clause}
+        ORDER BY {order_by}
+        {limit_clause}
+        """
+
+
+def _fetch_order_list_rows(conditions: list[str], params: dict, order_by: str, limit: int = 0, offset: int = 0):
+    return frappe.db.sql(_order_list_sql(conditions, order_by, limit, offset), params, as_dict=True)
+
+
+def _build_line_payload(product_id, product_name, qty, rate, tax_rate) -> dict:
+    qty = flt(qty)
+    rate = flt(rate)
+    tax_rate = flt(tax_rate)
+    subtotal = flt(qty * rate)
+    iva = flt(subtotal * (tax_rate / 100.0))
+    return {
+        "productId": product_id,
+        "productName": product_name or product_id,
+        "quantity": qty,
+        "price": rate,
+        "tax_rate": tax_rate,       # % (0, 5, 12, 13, 14, 15)
+        "subtotal": subtotal,       # sin IVA
+        "iva": iva,
+        "total": flt(subtotal + iva),  # con IVA
+    }
+
+
+def _order_items_by_parent(order_names: list[str]) -> dict[str, list[dict]]:
+    if not order_names:
+        return {}
+
+    placeholders = ", ".join(["%s"] * len(order_names))
+    rows = frappe.db.sql(
+        f"""
+        SELECT
+            i.parent,
+            i.product,
+            p.nombre AS product_name,
+            i.qty,
+            i.rate,
+            COALESCE(i.tax_rate, t.value, 0) AS tax_rate
+        FROM `tabItems` i
+        LEFT JOIN `tabProducto` p ON p.name = i.product
+        LEFT JOIN `tabtaxes` t ON t.name = i.tax
+        WHERE i.parenttype = 'orders'
+          AND i.parent IN ({placeholders})
+        ORDER BY i.parent, i.idx
+        """,
+        order_names,
+        as_dict=True,
+    )
+
+    out: dict[str, list[dict]] = {}
+    for r in rows:
+        out.setdefault(r.parent, []).append(
+            _build_line_payload(r.product, r.product_name, r.qty, r.rate, r.tax_rate)
+        )
+    return out
+
+
+def _invoice_items_by_parent(invoice_names: list[str]) -> dict[str, list[dict]]:
+    if not invoice_names:
+        return {}
+
+    rows = frappe.get_all(
+        "Sales Invoice Item",
+        filters={"parent": ["in", invoice_names], "docstatus": ["!=", 2]},
+        fields=["parent", "item_code", "item_name", "qty", "rate", "tax_rate"],
+        order_by="idx asc",
+    )
+
+    out: dict[str, list[dict]] = {}
+    for r in rows:
+        out.setdefault(r["parent"], []).append(
+            _build_line_payload(r.get("item_code"), r.get("item_name"), r.get("qty"), r.get("rate"), r.get("tax_rate"))
+        )
+    return out
+
+
+def _customer_info_from_row(customer: str, row) -> dict:
+    if not row:
+        return {"nombre": customer, "num_identificacion": "", "correo": "", "telefono": "", "direccion": ""}
+    return {
+        "nombre": row.get("nombre") or customer,
+        "num_identificacion": row.get("num_identificacion") or "",
+        "correo": row.get("correo") or "",
+        "telefono": row.get("telefono") or "",
+        "direccion": row.get("direccion") or "",
+    }
+
+
+def _sri_from_invoice_row(inv) -> dict:
+    if not inv or not inv.get("name"):
+        return {"status": "Sin factura"}
+    parts = [inv.get("estab") or "", inv.get("ptoemi") or "", inv.get("secuencial") or ""]
+    number = "-".join([p for p in parts if p]).strip("-") or None
+    return {
+        "status": inv.get("einvoice_status") or "Draft",
+        "authorization_datetime": inv.get("authorization_datetime"),
+        "access_key": inv.get("access_key"),
+        "invoice": inv.get("name"),
+        "number": number,
+        "grand_total": inv.get("grand_total"),
+    }
+
+
+def _prefixed(row, prefix: str) -> dict:
+    return {key[len(prefix):]: value for key, value in row.items() if key.startswith(prefix)}
+
+
+def _order_rows_to_payload(rows) -> list[dict]:
+    """Convierte filas de _fetch_order_list_rows al formato de get_all_orders."""
+    inv_names = [r.invoice_name for r in rows if r.invoice_name]
+    no_inv_orders = [r.name for r in rows if not r.invoice_name]
+
+    inv_items_by_inv = _invoice_items_by_parent(inv_names)
+    items_by_order = _order_items_by_parent(no_inv_orders)
+
+    data = []
+    for r in rows:
+        sri = _sri_from_invoice_row(_prefixed(r, "invoice_"))
+        if r.invoice_name:
+            items = inv_items_by_inv.get(r.invoice_name, [])
+        else:
+            items = items_by_order.get(r.name, [])
+
+        customer_row = _prefixed(r, "customer_") if r.customer_exists else None
+        data.append({
+            "name": r.name,
+            "status": r.status,
+            "type": r.estado,
+            "createdAt": r.creation,
+            "createdAtISO": str(r.creation).replace(" ", "T"),  # ISO-like para el front
+            "subtotal": r.subtotal,
+            "iva": r.iva,
+            "total": r.total,
+            "customer": _customer_info_from_row(r.customer, customer_row),
+            "sri": sri,
+            "usuario": r.owner,
+            "items": items,
+            "alias": r.alias,
+        })
+    return data
+
+
 @frappe.whitelist()
-def get_all_orders(limit=10, offset=0, created_from=None, created_to=None, order="desc", status=None):
+def get_all_orders(limit=10, offset=0, created_from=None, created_to=None, order="desc", status=None,
+                   cursor=None, use_cursor=0):
     """
     Trae órdenes con filtros por empresa, alcance (manager/cajero) y rango de creación opcional.
     Parámetros:
@@ -606,6 +937,8 @@ def get_all_orders(limit=10, offset=0, created_from=None, created_to=None, order
       - created_from: 'YYYY-MM-DD' o 'YYYY-MM-DD HH:mm:ss' o ISO-like
       - created_to:   'YYYY-MM-DD' o 'YYYY-MM-DD HH:mm:ss' o ISO-like
       - order: 'asc' | 'desc' (por creation)
+      - use_cursor / cursor: paginación keyset por (creation, name); ignora offset,
+        devuelve next_cursor y un total cacheado.
     """
 
     if not frappe.has_permission("orders", "read"):
@@ -619,209 +952,224 @@ def get_all_orders(limit=10, offset=0, created_from=None, created_to=None, order
     is_cashier = ("Cajero" in roles) and not is_manager
     is_mesero = ("Mesero" in roles) and not (is_manager or is_cashier)
 
-    # -------- Filtros base --------
-    # Usamos lista de filtros para poder añadir BETWEEN en 'creation'
-    filters = [
-        ["orders", "company_id", "=", company],
-        ["orders", "docstatus", "!=", 2],
-    ]
+    # -------- Filtros base y rango de creación (opcional) --------
+    conditions, params = _order_list_conditions(
+        company,
+        scope_user=frappe.session.user if (is_cashier or is_mesero) else None,
+        status=status,
+        dt_from=_parse_dt_or_date(created_from, is_start=True),
+        dt_to=_parse_dt_or_date(created_to, is_start=False),
+    )
 
-    if is_cashier or is_mesero:
-        if meta_has_field("orders", "created_by"):
-            filters.append(["orders", "created_by", "=", frappe.session.user])
-        elif meta_has_field("orders", "usuario"):
-            filters.append(["orders", "usuario", "=", frappe.session.user])
-        else:
-            filters.append(["orders", "owner", "=", frappe.session.user])
+    # -------- Orden --------
+    order = (order or "desc").lower()
+    direction = "asc" if order == "asc" else "desc"
+
+    def _count():
+        return frappe.db.sql(
+            f"SELECT COUNT(*) FROM `taborders` o WHERE {' AND '.join(conditions)}",
+            params,
+        )[0][0]
+
+    response = {}
+    if is_cursor_mode(use_cursor, cursor):
+        # -------- Conteo total (cacheado, sin la condición del cursor) --------
+        total_orders = cached_count("orders", [conditions, params], _count)
+
+        keyset, keyset_params = keyset_sql_condition(decode_cursor(cursor), direction == "asc", alias="o")
+        if keyset:
+            conditions.append(keyset)
+            params.update(keyset_params)
+
+        offset = 0
+        order_by = f"o.creation {direction}, o.name {direction}"
+        rows = _fetch_order_list_rows(conditions, params, order_by, limit=limit)
+        response["next_cursor"] = next_cursor_from_rows(rows, limit)
+    else:
+        # -------- Conteo total --------
+        total_orders = _count()
+        rows = _fetch_order_list_rows(conditions, params, f"o.creation {direction}", limit=limit, offset=offset)
 
-    # -------- Filtro por rango de creación (opcional) --------
-    dt_from = _parse_dt_or_date(created_from, is_start=True)
-    dt_to = _parse_dt_or_date(created_to, is_start=False)
-    
-    # opcional: filtrar por estado si viene en querystring
-    if status:
-        filters.append(["orders", "status", "=", status])
+    return {
+        **response,
+        "data": _order_rows_to_payload(rows),
+        "total": total_orders,
+        "limit": limit,
+        "offset": offset,
+        "filters": {
+            "company_id": company,
+            "scope": "all" if is_manager else "mine",
+            "created_from": created_from,
+            "created_to": created_to,
+            "order": order,
+        },
+    }
 
+# El cliente aplica los cambios como upsert, así que repetir filas por el margen es inocuo.
+SYNC_OVERLAP_SECONDS = 5
+SYNC_MAX_LIMIT = 500
 
-    if dt_from and dt_to:
-        filters.append(["orders", "creation", "between", [dt_from, dt_to]])
-    elif dt_from:
-        filters.append(["orders", "creation", ">=", dt_from])
-    elif dt_to:
-        filters.append(["orders", "creation", "<=", dt_to])
 
-    # -------- Orden --------
-    order = (order or "desc").lower()
-    order_by = "creation asc" if order == "asc" else "creation desc"
-
-    # -------- Conteo total --------
-    total_orders = frappe.db.count("orders", filters=filters)
-
-    # -------- Paginación: nombres --------
-    order_names = frappe.get_all(
-        "orders",
-        filters=filters,
-        limit=limit,
-        start=offset,
-        order_by=order_by,
-        pluck="name",
+def _order_payments_by_parent(order_names: list[str]) -> dict[str, list[dict]]:
+    if not order_names:
+        return {}
+    fields = ["name", "idx", "parent", "formas_de_pago"]
+    if meta_has_field("method_of_payment", "monto"):
+        fields.append("monto")
+    rows = frappe.get_all(
+        "method_of_payment",
+        filters={"parent": ["in", order_names], "parenttype": "orders"},
+        fields=fields,
+        order_by="idx asc",
     )
+    out: dict[str, list[dict]] = {}
+    for r in rows:
+        out.setdefault(r.parent, []).append(r)
+    return out
 
-    data = []
-    if not order_names:
-        return {
-            "data": data,
-            "total": total_orders,
-            "limit": limit,
-            "offset": offset,
-            "filters": {
-                "company_id": company,
-                "scope": "all" if is_manager else "mine",
-                "created_from": created_from,
-                "created_to": created_to,
-                "order": order,
-            },
-        }
 
-    # ---------- Prefetch: Facturas por orden ----------
-    inv_rows = frappe.get_all(
-        "Sales Invoice",
-        filters={"order": ["in", order_names], "docstatus": ["!=", 2]},
-        fields=[
-            "name",
-            "order",
-            "einvoice_status",
-            "authorization_datetime",
-            "access_key",
-            "estab",
-            "ptoemi",
-            "secuencial",
-            "grand_total",
-        ],
+def _order_deletions_since(company: str, since, scope_user: Optional[str], limit: int, cursor_key=None):
+    """
+    Órdenes eliminadas desde `since`, paginadas por (creation, name) de Deleted Document.
+    Devuelve (filas, has_more, cursor de la última fila).
+    """
+    # Filtra por doctype/fecha (índice) y luego por compañía dentro del JSON, sin traer `data`.
+    keyset, params = keyset_sql_condition(cursor_key, ascending=True, alias="dd")
+    params.update({"since": since, "company": company})
+    scope_condition = ""
+    if scope_user:
+        scope_condition = (
+            f"AND COALESCE(JSON_UNQUOTE(JSON_EXTRACT(dd.data, '$.{order_user_field()}')), "
+            "JSON_UNQUOTE(JSON_EXTRACT(dd.data, '$.owner'))) = %(user)s"
+        )
+        params["user"] = scope_user
+
+    rows = frappe.db.sql(
+        f"""
+        SELECT dd.name, dd.deleted_name, dd.creation
+        FROM `tabDeleted Document` dd
+        WHERE dd.deleted_doctype = 'orders'
+          AND dd.creation >= %(since)s
+          AND JSON_UNQUOTE(JSON_EXTRACT(dd.data, '$.company_id')) = %(company)s
+          {scope_condition}
+          {"AND " + keyset if keyset else ""}
+        ORDER BY dd.creation ASC, dd.name ASC
+        LIMIT {limit + 1}
+        """,
+        params,
+        as_dict=True,
     )
-    inv_by_order = {r["order"]: r for r in inv_rows}
-    inv_names = [r["name"] for r in inv_rows]
-
-    # ---------- Prefetch: Items de órdenes ----------
-    order_item_rows = frappe.get_all(
-        "Items",
-        filters={"parent": ["in", order_names], "parenttype": "orders", "docstatus": ["!=", 2]},
-        fields=["parent", "product", "qty", "rate", "tax", "tax_rate"],
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1].creation, rows[-1].name) if rows else None
+    return (
+        [{"name": r.deleted_name, "_action": "delete", "deletedAt": r.creation} for r in rows],
+        has_more,
+        next_cursor,
     )
 
-    # Catálogo de productos (para nombre legible)
-    product_ids = sorted({r["product"] for r in order_item_rows if r.get("product")})
-    product_map = {}
-    if product_ids:
-        for p in frappe.get_all("Producto", filters={"name": ["in", product_ids]}, fields=["name", "nombre"]):
-            product_map[p["name"]] = p.get("nombre") or p["name"]
-
-    # Catálogo de tasas de IVA
-    tax_ids = sorted({r["tax"] for r in order_item_rows if r.get("tax")})
-    taxes_map = {}
-    if tax_ids:
-        for t in frappe.get_all("taxes", filters={"name": ["in", tax_ids]}, fields=["name", "value"]):
-            taxes_map[t["name"]] = t.get("value") or 0
-
-    # Armar items por orden
-    items_by_order = {}
-    for r in order_item_rows:
-        order_name = r["parent"]
-        qty = flt(r.get("qty"))
-        rate = flt(r.get("rate"))
-        tax_rate = flt(r.get("tax_rate") if r.get("tax_rate") is not None else taxes_map.get(r.get("tax"), 0))
-        subtotal = flt(qty * rate)
-        iva = flt(subtotal * (tax_rate / 100.0))
-        total = flt(subtotal + iva)
-        items_by_order.setdefault(order_name, []).append({
-            "productId": r.get("product"),
-            "productName": product_map.get(r.get("product"), r.get("product")),
-            "quantity": qty,
-            "price": rate,
-            "tax_rate": tax_rate,       # % (0, 5, 12, 13, 14, 15)
-            "subtotal": subtotal,       # sin IVA
-            "iva": iva,
-            "total": total,             # con IVA
-        })
 
-    # ---------- Prefetch: Items de facturas ----------
-    inv_items_by_inv = {}
-    if inv_names:
-        inv_item_rows = frappe.get_all(
-            "Sales Invoice Item",
-            filters={"parent": ["in", inv_names], "docstatus": ["!=", 2]},
-            fields=["parent", "item_code", "item_name", "qty", "rate", "tax_rate"],
-        )
-        for r in inv_item_rows:
-            qty = flt(r.get("qty"))
-            rate = flt(r.get("rate"))
-            tax_rate = flt(r.get("tax_rate"))
-            subtotal = flt(qty * rate)
-            iva = flt(subtotal * (tax_rate / 100.0))
-            total = flt(subtotal + iva)
-            inv_items_by_inv.setdefault(r["parent"], []).append({
-                "productId": r.get("item_code"),
-                "productName": r.get("item_name") or r.get("item_code"),
-                "quantity": qty,
-                "price": rate,
-                "tax_rate": tax_rate,
-                "subtotal": subtotal,
-                "iva": iva,
-                "total": total,
-            })
+@frappe.whitelist()
+def get_order_changes(since=None, limit=200, cursor=None, deleted_cursor=None):
+    """
+    Sincronización incremental para el POS: órdenes creadas/actualizadas (o cuya
+    factura cambió) y eliminadas desde `since`.
+    - since: fecha-hora o el `next_since` devuelto por la llamada anterior.
+      Sin `since` solo devuelve `next_since` para arrancar.
+    - cursor / deleted_cursor: con has_more, repetir la llamada con el mismo `since` y los
+      `next_cursor` / `next_deleted_cursor` devueltos. Paginan por (changed_at, name) y
+      (creation, name), así un lote de filas con el mismo `modified` no se repite.
+    - Las filas usan el mismo formato que _build_realtime_payload.
+    """
+    if not frappe.has_permission("orders", "read"):
+        frappe.throw(_("No tienes permiso para ver órdenes"))
 
-    # ---------- Ensamblar respuesta ----------
-    for order_name in order_names:
-        doc = frappe.get_doc("orders", order_name)
-
-        inv = inv_by_order.get(order_name)
-        if inv:
-            parts = [inv.get("estab") or "", inv.get("ptoemi") or "", inv.get("secuencial") or ""]
-            number = "-".join([p for p in parts if p]).strip("-") or None
-            sri = {
-                "status": inv.get("einvoice_status") or "Draft",
-                "authorization_datetime": inv.get("authorization_datetime"),
-                "access_key": inv.get("access_key"),
-                "invoice": inv.get("name"),
-                "number": number,
-                "grand_total": inv.get("grand_total"),
-            }
-            items = inv_items_by_inv.get(inv["name"], [])
-        else:
-            sri = {"status": "Sin factura"}
-            items = items_by_order.get(order_name, [])
+    limit = min(cint(limit) or 200, SYNC_MAX_LIMIT)
+    company = get_user_company()
+    server_time = frappe.utils.now_datetime()
 
-        cust = _safe_customer_info(doc.customer)
-        data.append({
-            "name": doc.name,
-            "status": doc.status,
-            "type": getattr(doc, "estado", "venta"),
-            "createdAt": doc.creation,             # ?? ya lo devolvías
-            "createdAtISO": str(doc.creation).replace(" ", "T"),  # ?? agregado para el front (ISO-like)
-            "subtotal": doc.subtotal,
-            "iva": doc.iva,
-            "total": doc.total,
-            "customer": cust or {},
-            "sri": sri,
-            "usuario": doc.owner,
-            "items": items,
-            "alias": doc.alias
-        })
+    # next_since se entrega con margen: órdenes guardadas justo antes de un commit tardío
+    # vuelven a llegar en la siguiente llamada en lugar de perderse.
+    next_since = frappe.utils.add_to_date(server_time, seconds=-SYNC_OVERLAP_SECONDS)
+
+    since_dt = _parse_dt_or_date(since, is_start=True)
+    if not since_dt:
+        return {"changes": [], "deleted": [], "next_since": str(next_since), "has_more": False}
+
+    roles = set(frappe.get_roles(frappe.session.user))
+    is_manager = "Gerente" in roles
+    scope_user = None
+    if not is_manager and ({"Cajero", "Mesero"} & roles):
+        scope_user = frappe.session.user
+
+    keyset, params = keyset_sql_condition(decode_cursor(cursor), ascending=True, alias="c", column="changed_at")
+    params.update({"company": company, "since": since_dt})
+    scope_condition = ""
+    if scope_user:
+        scope_condition = f"AND o.`{order_user_field()}` = %(user)s"
+        params["user"] = scope_user
+
+    changed = frappe.db.sql(
+        f"""
+        SELECT c.name, c.changed_at
+        FROM (
+            SELECT t.name, MAX(t.changed_at) AS changed_at
+            FROM (
+                SELECT o.name, o.modified AS changed_at
+                FROM `taborders` o
+                WHERE o.company_id = %(company)s AND o.modified >= %(since)s {scope_condition}
+                UNION ALL
+                SELECT o.name, si.modified AS changed_at
+                FROM `tabSales Invoice` si
+                JOIN `taborders` o ON o.name = si.`order`
+                WHERE si.company_id = %(company)s AND si.modified >= %(since)s {scope_condition}
+            ) t
+            GROUP BY t.name
+        ) c
+        {"WHERE " + keyset if keyset else ""}
+        ORDER BY c.changed_at ASC, c.name ASC
+        LIMIT {limit + 1}
+        """,
+        params,
+        as_dict=True,
+    )
+
+    has_more = len(changed) > limit
+    changed = changed[:limit]
+    names = [r.name for r in changed]
+
+    rows = []
+    if names:
+        rows = _fetch_order_list_rows(["o.name IN %(names)s"], {"names": tuple(names)}, "o.modified asc")
+    payload = _order_rows_to_payload(rows)
+    extra_by_name = {r.name: r for r in rows}
+    payments = _order_payments_by_parent(names)
+    for entry in payload:
+        entry["email"] = extra_by_name[entry["name"]].email
+        entry["payments"] = payments.get(entry["name"], [])
+
+    deleted, deleted_has_more, next_deleted_cursor = _order_deletions_since(
+        company, since_dt, scope_user, limit, decode_cursor(deleted_cursor)
+    )
+
+    # Si se cortó por límite, el siguiente lote continúa tras la última fila entregada
+    # (con el mismo since); un flujo ya completo conserva su cursor y no repite filas.
+    next_cursor = None
+    if has_more or deleted_has_more:
+        next_since = since_dt
+        next_cursor = encode_cursor(changed[-1].changed_at, changed[-1].name) if changed else cursor
+        next_deleted_cursor = next_deleted_cursor or deleted_cursor
 
     return {
-        "data": data,
-        "total": total_orders,
-        "limit": limit,
-        "offset": offset,
-        "filters": {
-            "company_id": company,
-            "scope": "all" if is_manager else "mine",
-            "created_from": created_from,
-            "created_to": created_to,
-            "order": order,
-        },
+        "changes": [{"name": p["name"], "_action": "upsert", "data": p} for p in payload],
+        "deleted": deleted,
+        "next_since": str(next_since),
+        "next_cursor": next_cursor,
+        "next_deleted_cursor": next_deleted_cursor,
+        "has_more": has_more or deleted_has_more,
     }
 
+
 @frappe.whitelist()
 def get_dashboard_metrics():
     today = _today()
@@ -831,47 +1179,39 @@ def get_dashboard_metrics():
     is_manager = "Gerente" in roles
     is_cashier = ("Cajero" in roles) and not (is_manager or is_sysman)
 
-    filters = {"company_id": company, "creation": ["like", f"{today}%"]}
-    if is_cashier:
-        if meta_has_field("orders","created_by"): filters["created_by"] = frappe.session.user
-        elif meta_has_field("orders","usuario"): filters["usuario"] = frappe.session.user
-        else: filters["owner"] = frappe.session.user
-
-    orders_today = frappe.get_all("orders", filters=filters, fields=["name","total"], order_by="creation desc")
-    total_orders = len(orders_today)
-    total_sales  = sum(flt(o.get("total")) for o in orders_today)
-
-    product_counts = {}
-    for o in orders_today:
-        odoc = frappe.get_doc("orders", o.name)
-        for it in odoc.items or []:
-            pid = it.product
-            product_counts[pid] = product_counts.get(pid, 0.0) + flt(it.qty)
-
-    top_pairs = sorted(product_counts.items(), key=lambda kv: kv[1], reverse=True)[:5]
-    top_products = [{"name": _safe_product_name(pid), "count": qty} for pid, qty in top_pairs]
+    # Lectura del resumen diario (mantenido por los hooks de orders)
+    metrics = get_daily_sales(company, today, usuario=frappe.session.user if is_cashier else None)
 
     return {
         "company": company,
         "scope": "all" if (is_manager or is_sysman) else "mine",
-        "total_orders_today": total_orders,
-        "total_sales_today": total_sales,
-        "top_products": top_products,
+        "total_orders_today": metrics["total_orders"],
+        "total_sales_today": metrics["total_sales"],
+        "top_products": metrics["top_products"],
     }
 
 
-@frappe.whitelist()
-def create_order_v2():
-    user = frappe.session.user
-    data = frappe.request.get_json()
+def _consumidor_final(company_name: str) -> str:
+    cons_final = frappe.db.get_value(
+        "Cliente",
+        {
+            "company_id": company_name,
+            "num_identificacion": "9999999999999"
+        },
+        "name"
+    )
 
-    if not data:
-        frappe.throw(_("No se recibió información"))
+    if not cons_final:
+        frappe.throw(_("No se encontró el cliente consumidor final"))
+
+    return cons_final
+
+
+def _new_order_doc(data: dict, company_name: str, default_customer: Optional[str] = None):
+    """Arma (sin insertar) la orden de create_order_v2. Devuelve (doc, issue_invoice)."""
     if not isinstance(data, dict):
         frappe.throw(_("El payload debe ser un objeto JSON válido"))
 
-    company_name = get_user_company(user)
-
     items = data.get("items") or []
     payments = data.get("payments") or []
 
@@ -881,21 +1221,7 @@ def create_order_v2():
     # if not payments:
     #     frappe.throw(_("Debe existir al menos un método de pago"))
 
-    customer = data.get("customer")
-    if not customer:
-        cons_final = frappe.db.get_value(
-            "Cliente",
-            {
-                "company_id": company_name,
-                "num_identificacion": "9999999999999"
-            },
-            "name"
-        )
-
-        if not cons_final:
-            frappe.throw(_("No se encontró el cliente consumidor final"))
-
-        customer = cons_final
+    customer = data.get("customer") or default_customer or _consumidor_final(company_name)
 
     issue_invoice = (str(data.get("estado") or "").strip() == "Factura")
     if issue_invoice and not puede_facturar(company_name):
@@ -917,17 +1243,38 @@ def create_order_v2():
         "delivery_address": data.get("delivery_address"),
         "delivery_phone": data.get("delivery_phone"),
         "status": data.get("status"),
+        "client_request_id": data.get("client_request_id") or data.get("idempotency_key"),
     })
+    return doc, issue_invoice
+
+
+def _enqueue_invoice_for_order(order_name: str):
+    frappe.enqueue(
+        "restaurante_app.restaurante_bmarc.doctype.orders.orders.emit_invoice_for_order_job",
+        queue="short",
+        job_name=f"einvoice-for-{order_name}",
+        order_name=order_name,
+        enqueue_after_commit=True,
+    )
+
+
+@frappe.whitelist()
+def create_order_v2():
+    user = frappe.session.user
+    data = frappe.request.get_json()
+
+    if not data:
+        frappe.throw(_("No se recibió información"))
+    if not isinstance(data, dict):
+        frappe.throw(_("El payload debe ser un objeto JSON válido"))
+
+    company_name = get_user_company(user)
+
+    doc, issue_invoice = _new_order_doc(data, company_name)
     doc.insert()
 
     if issue_invoice:
-        frappe.enqueue(
-            "restaurante_app.restaurante_bmarc.doctype.orders.orders.emit_invoice_for_order_job",
-            queue="short",
-            job_name=f"einvoice-for-{doc.name}",
-            order_name=doc.name,
-            enqueue_after_commit=True,
-        )
+        _enqueue_invoice_for_order(doc.name)
 
     return {
         "message": _("Orden creada exitosamente"),
@@ -937,6 +1284,153 @@ def create_order_v2():
         }
     }
 
+
+BULK_ORDER_CHUNK_SIZE = 25
+BULK_ORDER_MAX = 500
+
+
+def _order_by_client_request_id(company_name: str, key: str) -> Optional[str]:
+    # Lectura con lock: ve la orden que otra transacción acaba de confirmar con la misma clave.
+    return frappe.db.get_value(
+        "orders", {"company_id": company_name, "client_request_id": key}, "name", for_update=True
+    )
+
+
+def _realtime_log_mark() -> int:
+    return len(getattr(frappe.local, "_realtime_log", None) or [])
+
+
+def _discard_realtime_since(mark: int):
+    # Los publish (after_commit) de una orden revertida al savepoint no deben salir en el commit.
+    log = getattr(frappe.local, "_realtime_log", None)
+    if log:
+        del log[mark:]
+
+
+def _insert_order_chunk(chunk: list[dict], company_name: str, default_customer: str) -> list[dict]:
+    """
+    Inserta un bloque de órdenes en una sola transacción.
+    El stock se valida una vez para el delta combinado; cada orden usa un savepoint
+    para que un error no descarte las demás del bloque.
+    """
+    keys = [o.get("client_request_id") or o.get("idempotency_key") for o in chunk if isinstance(o, dict)]
+    keys = [k for k in keys if k]
+    existing = {}
+    if keys:
+        for r in frappe.get_all(
+            "orders",
+            filters={"company_id": company_name, "client_request_id": ["in", keys]},
+            fields=["name", "client_request_id"],
+        ):
+            existing[r.client_request_id] = r.name
+
+    results: list[dict] = []
+    pending = []
+    seen = set()
+    for data in chunk:
+        key = (data.get("client_request_id") or data.get("idempotency_key")) if isinstance(data, dict) else None
+        if key and key in existing:
+            results.append({"client_request_id": key, "status": "duplicate", "name": existing[key]})
+            continue
+        if key and key in seen:
+            results.append({"client_request_id": key, "status": "duplicate", "name": None})
+            continue
+        try:
+            doc, issue_invoice = _new_order_doc(data, company_name, default_customer)
+        except Exception as e:
+            frappe.clear_messages()
+            results.append({"client_request_id": key, "status": "error", "message": str(e)})
+            continue
+        seen.add(key)
+        result = {"client_request_id": key, "status": "pending"}
+        results.append(result)
+        pending.append((doc, issue_invoice, result))
+
+    # Validación de stock única (sin locks) para todo el bloque
+    combined: dict[str, float] = {}
+    for doc, _issue, _result in pending:
+        for product, qty in build_stock_delta([], doc.items or [], company_name).items():
+            combined[product] = flt(combined.get(product, 0)) + qty
+    stock_prevalidated = False
+    if combined:
+        try:
+            check_stock_delta(company_name, combined)
+            stock_prevalidated = True
+        except frappe.ValidationError:
+            # Sin stock para el bloque completo: cada orden se valida por separado.
+            frappe.clear_messages()
+
+    for idx, (doc, issue_invoice, result) in enumerate(pending):
+        savepoint = f"bulk_order_{idx}"
+        frappe.db.savepoint(savepoint)
+        realtime_mark = _realtime_log_mark()
+        try:
+            doc.flags.stock_prevalidated = stock_prevalidated
+            doc.insert()
+            if issue_invoice:
+                _enqueue_invoice_for_order(doc.name)
+            result.update({
+                "status": "created",
+                "name": doc.name,
+                "sri": {"status": "Queued" if issue_invoice else "Sin factura"},
+            })
+        except (frappe.DuplicateEntryError, frappe.UniqueValidationError):
+            # Otra solicitud con la misma clave (p.ej. reintento tras un timeout) ganó la carrera.
+            frappe.db.rollback(save_point=savepoint)
+            _discard_realtime_since(realtime_mark)
+            frappe.clear_messages()
+            key = result["client_request_id"]
+            result.update({
+                "status": "duplicate" if key else "error",
+                "name": _order_by_client_request_id(company_name, key) if key else None,
+            })
+        except Exception as e:
+            frappe.db.rollback(save_point=savepoint)
+            _discard_realtime_since(realtime_mark)
+            frappe.clear_messages()
+            result.update({"status": "error", "message": str(e)})
+
+    return results
+
+
+@frappe.whitelist()
+def create_orders_bulk():
+    """
+    Ingreso masivo de órdenes (reconexión de POS offline).
+    Body: {"orders": [ {<payload de create_order_v2>, "client_request_id": "..."} ]}
+    Cada bloque de BULK_ORDER_CHUNK_SIZE órdenes se confirma en su propia transacción.
+    Una orden cuyo client_request_id ya existe se devuelve como "duplicate" sin volver a crearla.
+    """
+    user = frappe.session.user
+    data = frappe.request.get_json()
+
+    if not data:
+        frappe.throw(_("No se recibió información"))
+    orders_data = data.get("orders") if isinstance(data, dict) else data
+    if not isinstance(orders_data, list) or not orders_data:
+        frappe.throw(_("Debe enviar una lista de órdenes"))
+    if len(orders_data) > BULK_ORDER_MAX:
+        frappe.throw(_("No se pueden enviar más de {0} órdenes por solicitud").format(BULK_ORDER_MAX))
+    if not frappe.has_permission("orders", "create"):
+        frappe.throw(_("No tienes permiso para crear órdenes"))
+
+    company_name = get_user_company(user)
+    default_customer = None
+    if any(isinstance(o, dict) and not o.get("customer") for o in orders_data):
+        default_customer = _consumidor_final(company_name)
+
+    results: list[dict] = []
+    for start in range(0, len(orders_data), BULK_ORDER_CHUNK_SIZE):
+        chunk = orders_data[start:start + BULK_ORDER_CHUNK_SIZE]
+        results.extend(_insert_order_chunk(chunk, company_name, default_customer))
+        frappe.db.commit()
+
+    return {
+        "message": _("Órdenes procesadas"),
+        "created": sum(1 for r in results if r["status"] == "created"),
+        "results": results,
+    }
+
     
 def _emit_invoice_for_order(order_name: str):
     if not order_name:
@@ -980,22 +1474,27 @@ def _emit_invoice_for_order(order_name: str):
         "environment": _environment_label(company),
     })
 
+    product_names = _product_name_map([it.product for it in order_doc.items or []])
     for it in order_doc.items or []:
         inv.append("items", {
             "item_code": it.product,
-            "item_name": _safe_product_name(it.product),
+            "item_name": product_names.get(it.product, it.product),
             "qty": flt(it.qty),
             "rate": flt(it.rate),
-            "tax_rate": _resolve_tax_rate(it),
+            "tax_rate": _resolve_tax_rate(it, company_name),
         })
     _append_sales_invoice_payments_from_order(inv, order_doc)
 
     inv.insert(ignore_permissions=True)
 
+    # Se actualiza `modified` para que get_order_changes entregue la orden ya facturada.
+    order_values = {}
     if frappe.db.has_column("orders", "sales_invoice"):
-        frappe.db.set_value("orders", order_doc.name, "sales_invoice", inv.name, update_modified=False)
+        order_values["sales_invoice"] = inv.name
     if frappe.db.has_column("orders", "estado"):
-        frappe.db.set_value("orders", order_doc.name, "estado", "Factura", update_modified=False)
+        order_values["estado"] = "Factura"
+    if order_values:
+        frappe.db.set_value("orders", order_doc.name, order_values)
 
     api_result = emitir_factura_por_invoice(inv.name)
     persist_after_emit(inv, api_result, "factura")
@@ -1040,17 +1539,6 @@ def build_emit_response(invoice_name, result_dict):
     }
 
 
-def enqueue_status_update(invoice_name, type_document: str = "factura"):
-    frappe.enqueue(
-        "restaurante_app.facturacion_bmarc.einvoice.edocs.sri_estado_and_update_data",
-        queue="long",
-        job_name=f"einvoice-status-{type_document}-{invoice_name}",
-        enqueue_after_commit=True,
-        timeout=300,
-        invoice_name=invoice_name,
-        type=type_document,
-    )
-   
 @frappe.whitelist()
 def set_order_status(name: str, status: str):
     """
@@ -1096,73 +1584,85 @@ def set_order_status(name: str, status: str):
 
 @frappe.whitelist()
 def get_product_sales(company, from_date=None, to_date=None, limit=50, offset=0):
-    limit = int(limit or 50)
-    offset = int(offset or 0)
+    # Lee el resumen diario por producto (sales_rollup) en lugar de agrupar taborders/tabItems.
+    return get_product_sales_facts(company, from_date, to_date, int(limit or 50), int(offset or 0))
 
-    conditions = ["o.company_id = %(company)s", "o.docstatus < 2"]
-    params = {"company": company}
-
-    if from_date:
-        conditions.append("DATE(o.creation) >= %(from_date)s")
-        params["from_date"] = from_date
-    if to_date:
-        conditions.append("DATE(o.creation) <= %(to_date)s")
-        params["to_date"] = to_date
+SPLIT_INVOICE_FIELDS = ["name", "einvoice_status", "authorization_datetime", "access_key", "estab", "ptoemi", "secuencial", "grand_total"]
 
-    where_clause = " AND ".join(conditions)
 
-    data = frappe.db.sql(f"""
-        SELECT
-            i.product AS producto,
-            COALESCE(p.nombre, '') AS nombre_producto,
-            COALESCE(p.descripcion, '') AS descripcion_producto,
-            SUM(i.qty) AS cantidad
-        FROM `taborders` o
-        JOIN `tabItems` i ON o.name = i.parent
-        LEFT JOIN `tabProducto` p ON p.name = i.product
-        WHERE {where_clause}
-        GROUP BY i.product, p.nombre, p.descripcion
-        ORDER BY cantidad DESC
-        LIMIT {limit} OFFSET {offset}
-    """, params, as_dict=True)
-
-    total = frappe.db.sql(f"""
-        SELECT COUNT(DISTINCT i.product)
-        FROM `taborders` o
-        JOIN `tabItems` i ON o.name = i.parent
-        WHERE {where_clause}
-    """, params)[0][0]
-
-    return {
-        "result": data,
-        "total": total
-    }
-
-def _existing_split_qty_by_order_item(order_name: str) -> dict[str, float]:
-    split_names = frappe.get_all(
+def _load_order_splits(order_name: str, with_details: bool = True) -> list[dict]:
+    """
+    Subcuentas de la orden con sus items (y, si with_details, pagos y factura enlazada)
+    en un número fijo de consultas, sin frappe.get_doc por subcuenta.
+    """
+    splits = frappe.get_all(
         "Order Split",
-        filters={"order": order_name, "docstatus": ["!=", 2], "status": ["!=", "Cancelada"]},
-        pluck="name",
+        filters={"order": order_name, "docstatus": ["!=", 2]},
+        fields=[
+            "name", "status", "split_label", "customer", "subtotal", "iva", "total", "sales_invoice",
+            "emit_claimed_at",
+        ],
+        order_by="creation asc",
     )
-    if not split_names:
-        return {}
+    if not splits:
+        return []
 
-    rows = frappe.get_all(
+    split_names = [s.name for s in splits]
+    items_by_split: dict[str, list] = {}
+    for row in frappe.get_all(
         "Order Split Item",
         filters={"parent": ["in", split_names], "parenttype": "Order Split"},
-        fields=["order_item", "qty"],
-    )
+        fields=["parent", "order_item", "product", "qty", "rate", "tax_rate", "line_subtotal", "line_iva", "line_total"],
+        order_by="idx asc",
+    ):
+        items_by_split.setdefault(row.parent, []).append(row)
+
+    payments_by_split: dict[str, list] = {}
+    invoices: dict[str, dict] = {}
+    if with_details:
+        for row in frappe.get_all(
+            "Order Split Payment",
+            filters={"parent": ["in", split_names], "parenttype": "Order Split"},
+            fields=["parent", "formas_de_pago", "monto"],
+            order_by="idx asc",
+        ):
+            payments_by_split.setdefault(row.parent, []).append(row)
+
+        invoice_names = [s.sales_invoice for s in splits if s.sales_invoice]
+        if invoice_names:
+            invoices = {
+                inv.name: inv
+                for inv in frappe.get_all(
+                    "Sales Invoice",
+                    filters={"name": ["in", invoice_names]},
+                    fields=SPLIT_INVOICE_FIELDS,
+                )
+            }
+
+    for split in splits:
+        split["items"] = items_by_split.get(split.name, [])
+        split["payments"] = payments_by_split.get(split.name, [])
+        split["invoice"] = invoices.get(split.sales_invoice) if split.sales_invoice else None
+    return splits
+
+
+def _existing_split_qty_by_order_item(order_name: str, splits: list[dict] | None = None) -> dict[str, float]:
+    if splits is None:
+        splits = _load_order_splits(order_name, with_details=False)
 
     out: dict[str, float] = {}
-    for row in rows:
-        key = row.get("order_item")
-        if not key:
+    for split in splits:
+        if split.get("status") == "Cancelada":
             continue
-        out[key] = flt(out.get(key, 0)) + flt(row.get("qty"))
+        for row in split.get("items") or []:
+            key = row.get("order_item")
+            if not key:
+                continue
+            out[key] = flt(out.get(key, 0)) + flt(row.get("qty"))
     return out
 
 
-def _normalize_split_items(order_doc, raw_items: list[dict]) -> list[dict]:
+def _normalize_split_items(order_doc, raw_items: list[dict], allocated: dict[str, float] | None = None) -> list[dict]:
     if not raw_items:
         frappe.throw(_("Debe enviar al menos un item para dividir la cuenta."))
 
@@ -1170,7 +1670,8 @@ def _normalize_split_items(order_doc, raw_items: list[dict]) -> list[dict]:
     by_name = {}
     by_product = {}
 
-    allocated = _existing_split_qty_by_order_item(order_doc.name)
+    if allocated is None:
+        allocated = _existing_split_qty_by_order_item(order_doc.name)
 
     for idx, row in enumerate(order_doc.items or []):
         key = row.name
@@ -1183,7 +1684,7 @@ def _normalize_split_items(order_doc, raw_items: list[dict]) -> list[dict]:
             "qty": flt(row.qty),
             "rate": flt(row.rate),
             "tax": getattr(row, "tax", None),
-            "tax_rate": _resolve_tax_rate(row),
+            "tax_rate": _resolve_tax_rate(row, order_doc.company_id),
             "available": available,
         }
         source_rows.append(source)
@@ -1328,7 +1829,11 @@ def split_order(order_name=None, items=None, customer=None, split_label=None, pa
     if frappe.db.exists("Sales Invoice", {"order": order_doc.name, "docstatus": ["!=", 2]}):
         frappe.throw(_("No se puede dividir una orden que ya tiene factura generada."))
 
-    normalized_items = _normalize_split_items(order_doc, raw_items)
+    # Mismo cargador que get_order_splits: items de todas las subcuentas en una consulta
+    splits = _load_order_splits(order_doc.name, with_details=False)
+    normalized_items = _normalize_split_items(
+        order_doc, raw_items, _existing_split_qty_by_order_item(order_doc.name, splits)
+    )
 
     split_doc = frappe.get_doc(
         {
@@ -1396,24 +1901,21 @@ def get_order_splits(order_name: str):
     if order_doc.company_id != user_company:
         frappe.throw(_("No tienes permiso para ver esta orden."))
 
-    split_names = frappe.get_all(
-        "Order Split",
-        filters={"order": order_doc.name, "docstatus": ["!=", 2]},
-        order_by="creation asc",
-        pluck="name",
+    split_rows = _load_order_splits(order_doc.name)
+    product_names = _product_name_map(
+        [it.product for split in split_rows for it in split["items"]]
+        + [row.product for row in order_doc.items or []]
     )
 
     splits = []
-    for split_name in split_names:
-        split_doc = frappe.get_doc("Order Split", split_name)
-
+    for split in split_rows:
         items = []
-        for it in split_doc.items or []:
+        for it in split["items"]:
             items.append(
                 {
                     "order_item": it.order_item,
                     "productId": it.product,
-                    "productName": _safe_product_name(it.product),
+                    "productName": product_names.get(it.product, it.product),
                     "quantity": flt(it.qty),
                     "price": flt(it.rate),
                     "tax_rate": flt(it.tax_rate),
@@ -1424,7 +1926,7 @@ def get_order_splits(order_name: str):
             )
 
         split_payments = []
-        for p in split_doc.payments or []:
+        for p in split["payments"]:
             split_payments.append(
                 {
                     "method": p.formas_de_pago,
@@ -1432,43 +1934,23 @@ def get_order_splits(order_name: str):
                 }
             )
 
-        sri = {"status": "Sin factura"}
-        if split_doc.sales_invoice:
-            inv = frappe.db.get_value(
-                "Sales Invoice",
-                split_doc.sales_invoice,
-                ["name", "einvoice_status", "authorization_datetime", "access_key", "estab", "ptoemi", "secuencial", "grand_total"],
-                as_dict=True,
-            )
-            if inv:
-                parts = [inv.get("estab") or "", inv.get("ptoemi") or "", inv.get("secuencial") or ""]
-                number = "-".join([p for p in parts if p]).strip("-") or None
-                sri = {
-                    "status": inv.get("einvoice_status") or "Draft",
-                    "authorization_datetime": inv.get("authorization_datetime"),
-                    "access_key": inv.get("access_key"),
-                    "invoice": inv.get("name"),
-                    "number": number,
-                    "grand_total": inv.get("grand_total"),
-                }
-
         splits.append(
             {
-                "name": split_doc.name,
-                "status": split_doc.status,
-                "split_label": split_doc.split_label,
-                "customer": split_doc.customer,
-                "subtotal": flt(split_doc.subtotal),
-                "iva": flt(split_doc.iva),
-                "total": flt(split_doc.total),
-                "sales_invoice": split_doc.sales_invoice,
+                "name": split.name,
+                "status": split.status,
+                "split_label": split.split_label,
+                "customer": split.customer,
+                "subtotal": flt(split.subtotal),
+                "iva": flt(split.iva),
+                "total": flt(split.total),
+                "sales_invoice": split.sales_invoice,
                 "items": items,
                 "payments": split_payments,
-                "sri": sri,
+                "sri": _sri_from_invoice_row(split["invoice"]),
             }
         )
 
-    allocated = _existing_split_qty_by_order_item(order_doc.name)
+    allocated = _existing_split_qty_by_order_item(order_doc.name, split_rows)
     remaining = []
     for row in order_doc.items or []:
         allocated_qty = flt(allocated.get(row.name, 0))
@@ -1477,12 +1959,12 @@ def get_order_splits(order_name: str):
             {
                 "order_item": row.name,
                 "productId": row.product,
-                "productName": _safe_product_name(row.product),
+                "productName": product_names.get(row.product, row.product),
                 "original_qty": flt(row.qty),
                 "allocated_qty": allocated_qty,
                 "remaining_qty": remaining_qty,
                 "price": flt(row.rate),
-                "tax_rate": _resolve_tax_rate(row),
+                "tax_rate": _resolve_tax_rate(row, order_doc.company_id),
             }
         )
 
@@ -1519,6 +2001,80 @@ def create_and_emit_from_split(split_name: str):
     if not puede_facturar(company_name):
         frappe.throw(_("No puede facturar, no tiene registrada la firma electronica"))
 
+    claimed_at = _claim_split_for_emit(split_doc.name, split_doc.status)
+    if not claimed_at:
+        return {"status": "in_progress", "split": split_doc.name}
+
+    try:
+        return _emit_claimed_split(split_doc, order_doc, company_name, posting_date)
+    except Exception:
+        frappe.db.rollback()
+        raise
+    finally:
+        _release_split_claim(split_doc.name, claimed_at)
+
+
+# Una emisión tarda como máximo el POST al microservicio (120 s) más la consulta de estado;
+# un "Emitiendo" más antiguo que esto quedó de un worker caído y se puede retomar.
+SPLIT_EMIT_CLAIM_TIMEOUT = 600
+
+
+def _split_claim_is_stale(split) -> bool:
+    if split.get("status") != "Emitiendo" or split.get("sales_invoice"):
+        return False
+    claimed_at = split.get("emit_claimed_at")
+    return not claimed_at or frappe.utils.time_diff_in_seconds(
+        frappe.utils.now_datetime(), claimed_at
+    ) > SPLIT_EMIT_CLAIM_TIMEOUT
+
+
+def _claim_split_for_emit(split_name: str, previous_status: str):
+    """
+    Marca la subcuenta como "Emitiendo" solo si sigue en su estado anterior y sin factura,
+    o si el reclamo anterior venció (worker caído). Devuelve la marca del reclamo o None.
+    Se confirma de inmediato: otro carril (o un reintento) ve el cambio y no la emite dos veces.
+    """
+    now = frappe.utils.now_datetime()
+    frappe.db.sql(
+        """
+        UPDATE `tabOrder Split`
+        SET emit_previous_status = IF(status = 'Emitiendo', emit_previous_status, status),
+            status = 'Emitiendo', emit_claimed_at = %(now)s, modified = %(now)s
+        WHERE name = %(name)s
+          AND IFNULL(sales_invoice, '') = ''
+          AND (
+            (status = %(previous)s AND status != 'Emitiendo')
+            OR (status = 'Emitiendo' AND (emit_claimed_at IS NULL OR emit_claimed_at < %(stale_before)s))
+          )
+        """,
+        {
+            "name": split_name,
+            "previous": previous_status,
+            "now": now,
+            "stale_before": frappe.utils.add_to_date(now, seconds=-SPLIT_EMIT_CLAIM_TIMEOUT),
+        },
+    )
+    claimed = cint(frappe.db.sql("SELECT ROW_COUNT()")[0][0]) == 1
+    frappe.db.commit()
+    return now if claimed else None
+
+
+def _release_split_claim(split_name: str, claimed_at):
+    # Si no terminó como "Facturada", vuelve a su estado anterior; con factura ya no se reemite.
+    # Solo libera su propio reclamo: si otro worker lo retomó, la marca ya no coincide.
+    frappe.db.sql(
+        """
+        UPDATE `tabOrder Split`
+        SET status = IFNULL(NULLIF(emit_previous_status, ''), 'Draft'),
+            emit_claimed_at = NULL, modified = %(now)s
+        WHERE name = %(name)s AND status = 'Emitiendo' AND emit_claimed_at = %(claimed_at)s
+        """,
+        {"name": split_name, "claimed_at": claimed_at, "now": frappe.utils.now_datetime()},
+    )
+    frappe.db.commit()
+
+
+def _emit_claimed_split(split_doc, order_doc, company_name: str, posting_date):
     customer_name = split_doc.customer or order_doc.customer
     customer_info = _safe_customer_info(customer_name)
 
@@ -1558,14 +2114,14 @@ def create_and_emit_from_split(split_name: str):
 
     inv.insert(ignore_permissions=True)
 
-    split_doc.db_set("sales_invoice", inv.name, update_modified=False)
+    split_doc.db_set("sales_invoice", inv.name)
 
     api_result = emitir_factura_por_invoice(inv.name)
     persist_after_emit(inv, api_result, "factura")
 
     status = str(api_result.get("status") or "").upper()
     if status == EInvoiceStatus.AUTHORIZED.value:
-        split_doc.db_set("status", "Facturada", update_modified=False)
+        split_doc.db_set("status", "Facturada")
         return build_emit_response(inv.name, api_result)
 
     if status == EInvoiceStatus.ERROR.value and not _is_recoverable_error(api_result.get("messages")):
@@ -1574,10 +2130,143 @@ def create_and_emit_from_split(split_name: str):
     final_result = _sync_status_or_enqueue(inv.name, api_result)
     final_status = str(final_result.get("status") or "").upper()
     if final_status == EInvoiceStatus.AUTHORIZED.value:
-        split_doc.db_set("status", "Facturada", update_modified=False)
+        split_doc.db_set("status", "Facturada")
 
     return build_emit_response(inv.name, final_result)
 
+# ---------- Emisión en paralelo de subcuentas ----------
+# Máximo de emisiones simultáneas por compañía contra el microservicio.
+SPLIT_EMIT_CONCURRENCY = 3
+SPLIT_EMIT_LANE_TTL = 600
+SPLIT_EMIT_QUEUE_KEY = "restaurante_app:split_emit_queue:{company}"
+SPLIT_EMIT_LANE_KEY = "restaurante_app:split_emit_lane:{company}:{lane}"
+
+
+def _publish_split_status(company: str, order_name: str, split_name: str, status: str, **extra):
+    publish_to_company(
+        company,
+        {
+            "doctype": "Order Split",
+            "_action": "emit_status",
+            "order": order_name,
+            "name": split_name,
+            "status": status,
+            "company": company,
+            **extra,
+        },
+        after_commit=False,
+    )
+
+
+def _start_split_emit_lanes(company: str):
+    """
+    Arranca (sin exceder SPLIT_EMIT_CONCURRENCY) los workers que vacían la cola de la compañía.
+    Llamar fuera de una transacción pendiente: el carril queda tomado apenas se encola el job.
+    """
+    cache = frappe.cache()
+    for lane in range(SPLIT_EMIT_CONCURRENCY):
+        lane_key = cache.make_key(SPLIT_EMIT_LANE_KEY.format(company=company, lane=lane))
+        if not cache.set(lane_key, 1, nx=True, ex=SPLIT_EMIT_LANE_TTL):
+            continue
+        frappe.enqueue(
+            "restaurante_app.restaurante_bmarc.doctype.orders.orders.drain_split_emit_queue_job",
+            queue="short",
+            job_name=f"split-emit-{company}-{lane}",
+            company=company,
+            lane=lane,
+        )
+
+
+def _queue_splits_for_emit(company: str, order_name: str, split_names: list[str]):
+    # Corre después del commit: si la transacción se revierte no quedan ni cola ni carriles tomados.
+    cache = frappe.cache()
+    queue_key = SPLIT_EMIT_QUEUE_KEY.format(company=company)
+    for split_name in split_names:
+        cache.rpush(queue_key, split_name)
+        _publish_split_status(company, order_name, split_name, "queued")
+    _start_split_emit_lanes(company)
+
+
+def drain_split_emit_queue_job(company: str, lane: int):
+    cache = frappe.cache()
+    queue_key = SPLIT_EMIT_QUEUE_KEY.format(company=company)
+    lane_key = cache.make_key(SPLIT_EMIT_LANE_KEY.format(company=company, lane=lane))
+
+    try:
+        while True:
+            raw = cache.lpop(queue_key)
+            if not raw:
+                break
+            split_name = raw.decode() if isinstance(raw, bytes) else str(raw)
+            cache.expire(lane_key, SPLIT_EMIT_LANE_TTL)
+
+            order_name = frappe.db.get_value("Order Split", split_name, "order")
+            _publish_split_status(company, order_name, split_name, "processing")
+            try:
+                result = create_and_emit_from_split(split_name)
+                frappe.db.commit()
+                _publish_split_status(
+                    company, order_name, split_name,
+                    str(result.get("status") or ""),
+                    invoice=result.get("invoice"),
+                    access_key=result.get("access_key"),
+                    messages=result.get("messages"),
+                )
+            except Exception as e:
+                frappe.db.rollback()
+                frappe.log_error(frappe.get_traceback(), f"Error emitiendo subcuenta {split_name}")
+                frappe.clear_messages()
+                _publish_split_status(company, order_name, split_name, "error", message=str(e))
+    finally:
+        cache.delete(lane_key)
+
+    # Una subcuenta encolada justo al liberar el carril no debe quedar huérfana.
+    if cache.llen(queue_key):
+        _start_split_emit_lanes(company)
+
+
+@frappe.whitelist()
+def emit_pending_splits(order_name: str):
+    """
+    Encola la emisión de todas las subcuentas pendientes de la orden.
+    Cada subcuenta se emite en su propio job (máx. SPLIT_EMIT_CONCURRENCY por compañía)
+    y su avance se publica en la sala realtime de la compañía (_action = "emit_status").
+    """
+    if not order_name:
+        frappe.throw(_("Debe enviar el nombre de la orden."))
+
+    order_doc = frappe.get_doc("orders", order_name)
+    user_company = get_user_company()
+    if order_doc.company_id != user_company:
+        frappe.throw(_("No tienes permiso para facturar esta orden."))
+
+    _assert_can_emit_invoice_today(order_doc)
+    if not puede_facturar(user_company):
+        frappe.throw(_("No puede facturar, no tiene registrada la firma electronica"))
+
+    pending, skipped = [], []
+    for split in _load_order_splits(order_doc.name, with_details=False):
+        if (
+            split.status in ("Facturada", "Cancelada")
+            or split.sales_invoice
+            or (split.status == "Emitiendo" and not _split_claim_is_stale(split))
+        ):
+            skipped.append({"name": split.name, "status": split.status, "sales_invoice": split.sales_invoice})
+        else:
+            pending.append(split.name)
+
+    # Una subcuenta repetida en la cola es inocua: create_and_emit_from_split la reclama antes de emitir.
+    if pending:
+        frappe.db.after_commit.add(partial(_queue_splits_for_emit, user_company, order_doc.name, pending))
+
+    return {
+        "message": _("Subcuentas encoladas para facturación"),
+        "order": order_doc.name,
+        "queued": pending,
+        "skipped": skipped,
+    }
+
+
 @frappe.whitelist()
 def delete_order_split(split_name: str):
     if not split_name:
@@ -1592,6 +2281,9 @@ def delete_order_split(split_name: str):
     if split_doc.company_id != user_company:
         frappe.throw(_("No tienes permiso para eliminar esta subcuenta."))
 
+    if split_doc.status == "Emitiendo" and not _split_claim_is_stale(split_doc):
+        frappe.throw(_("No se puede eliminar la subcuenta mientras se está facturando."))
+
     invoice_name = split_doc.sales_invoice
     if invoice_name:
         inv = frappe.db.get_value("Sales Invoice", invoice_name, ["name", "docstatus"], as_dict=True)
@@ -1608,3 +2300,6 @@ def delete_order_split(split_name: str):
     }
 
 
+def on_doctype_update():
+    # Idempotencia de create_orders_bulk: dos reintentos concurrentes no pueden crear la misma orden.
+    frappe.db.add_unique("orders", ["company_id", "client_request_id"], "company_client_request_id")
@@ -1,9 +1,253 @@
 # Copyright (c) 2025, none and Contributors
 # See license.txt
 
-# import frappe
+import threading
+from types import SimpleNamespace
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import flt
+
+from restaurante_app.inventarios_bmarc.api.stock import apply_stock_delta
+from restaurante_app.restaurante_bmarc.api.db_indexes import explain_hot_queries
+from restaurante_app.restaurante_bmarc.doctype.orders.orders import (
+	SPLIT_EMIT_CLAIM_TIMEOUT,
+	_claim_split_for_emit,
+	_new_order_doc,
+	_release_split_claim,
+	create_order_v2,
+)
+
+CONCURRENT_ORDERS = 8
+INITIAL_STOCK = 5
+
+
+def _create_order_in_thread(site, user, payload, results):
+	# Cada hilo usa su propia conexión, como un request real.
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		frappe.set_user(user)
+		frappe.local.request = SimpleNamespace(get_json=lambda: payload)
+		response = create_order_v2()
+		frappe.db.commit()
+		results.append(("ok", response["name"]))
+	except frappe.ValidationError as e:
+		frappe.db.rollback()
+		results.append(("stock", str(e)))
+	except Exception as e:
+		frappe.db.rollback()
+		results.append(("error", repr(e)))
+	finally:
+		frappe.destroy()
 
 
 class Testorders(FrappeTestCase):
-	pass
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.company = frappe.get_doc(
+			{"doctype": "Company", "businessname": "_Test Concurrencia Stock", "ruc": "0999999999001"}
+		).insert(ignore_permissions=True, ignore_mandatory=True).name
+		frappe.get_doc(
+			{
+				"doctype": "Cliente",
+				"company_id": cls.company,
+				"nombre": "CONSUMIDOR FINAL",
+				"num_identificacion": "9999999999999",
+				"tipo_identificacion": "07 - Consumidor Final",
+			}
+		).insert(ignore_permissions=True)
+		cls.products = [
+			frappe.get_doc(
+				{
+					"doctype": "Producto",
+					"company_id": cls.company,
+					"nombre": f"_Test Producto Concurrencia {i}",
+					"precio": 1,
+					"controlar_inventario": 1,
+					"stock_actual": INITIAL_STOCK,
+				}
+			).insert(ignore_permissions=True).name
+			for i in range(2)
+		]
+		frappe.defaults.set_user_default("Company", cls.company, user="Administrator")
+		# Los hilos usan conexiones propias: los datos base deben estar confirmados.
+		frappe.db.commit()
+
+	@classmethod
+	def tearDownClass(cls):
+		frappe.db.delete("Order Split", {"company_id": cls.company})
+		orders = frappe.get_all("orders", filters={"company_id": cls.company}, pluck="name")
+		if orders:
+			frappe.db.delete("Items", {"parent": ["in", orders]})
+			frappe.db.delete("orders", {"name": ["in", orders]})
+		movements = frappe.get_all("Movimiento de Inventario", filters={"company_id": cls.company}, pluck="name")
+		if movements:
+			frappe.db.delete("Detalle Movimiento Inventario", {"parent": ["in", movements]})
+			frappe.db.delete("Movimiento de Inventario", {"name": ["in", movements]})
+		for doctype in ("Resumen Venta Diaria", "Resumen Venta Diaria Producto", "Producto", "Cliente"):
+			frappe.db.delete(doctype, {"company_id": cls.company})
+		frappe.db.delete("Company", {"name": cls.company})
+		frappe.defaults.clear_user_default("Company", user="Administrator")
+		frappe.db.commit()
+		super().tearDownClass()
+
+	def _new_stock_product(self, stock, allow_negative=0):
+		return frappe.get_doc(
+			{
+				"doctype": "Producto",
+				"company_id": self.company,
+				"nombre": f"_Test Producto Stock {frappe.generate_hash(length=6)}",
+				"precio": 1,
+				"controlar_inventario": 1,
+				"permitir_stock_negativo": allow_negative,
+				"stock_actual": stock,
+			}
+		).insert(ignore_permissions=True).name
+
+	def test_apply_stock_delta_conditional_update(self):
+		product = self._new_stock_product(2)
+
+		applied = apply_stock_delta(self.company, {product: -2})
+		self.assertEqual(len(applied), 1)
+		self.assertEqual(applied[0]["stock_before"], 2)
+		self.assertEqual(applied[0]["stock_after"], 0)
+		row = frappe.db.get_value("Producto", product, ["stock_actual", "is_out_of_stock"], as_dict=True)
+		self.assertEqual(flt(row.stock_actual), 0)
+		self.assertEqual(row.is_out_of_stock, 1)
+
+		# El UPDATE condicional no toca la fila si no alcanza el stock.
+		with self.assertRaises(frappe.ValidationError):
+			apply_stock_delta(self.company, {product: -1})
+		self.assertEqual(flt(frappe.db.get_value("Producto", product, "stock_actual")), 0)
+
+		applied = apply_stock_delta(self.company, {product: 3})
+		self.assertEqual(applied[0]["stock_after"], 3)
+		self.assertEqual(frappe.db.get_value("Producto", product, "is_out_of_stock"), 0)
+
+	def test_apply_stock_delta_allows_negative_when_enabled(self):
+		product = self._new_stock_product(1, allow_negative=1)
+		applied = apply_stock_delta(self.company, {product: -3})
+		self.assertEqual(applied[0]["stock_before"], 1)
+		self.assertEqual(applied[0]["stock_after"], -2)
+
+	def test_recipe_change_after_order_reverses_recorded_ingredients(self):
+		first, second = self._new_stock_product(10), self._new_stock_product(10)
+		dish = frappe.get_doc(
+			{
+				"doctype": "Producto",
+				"company_id": self.company,
+				"nombre": f"_Test Plato {frappe.generate_hash(length=6)}",
+				"precio": 1,
+			}
+		).insert(ignore_permissions=True).name
+		recipe = frappe.get_doc(
+			{
+				"doctype": "Receta",
+				"product": dish,
+				"company_id": self.company,
+				"is_active": 1,
+				"items": [{"ingredient": first, "qty": 2}],
+			}
+		).insert(ignore_permissions=True)
+
+		order, _issue = _new_order_doc(
+			{"estado": "Nota Venta", "items": [{"product": dish, "qty": 1, "rate": 1, "tax_rate": 0}]},
+			self.company,
+		)
+		order.insert(ignore_permissions=True)
+		self.assertEqual(flt(frappe.db.get_value("Producto", first, "stock_actual")), 8)
+
+		# La receta cambia después de la venta: la orden descontó `first`, no `second`.
+		recipe.items = []
+		recipe.append("items", {"ingredient": second, "qty": 1})
+		recipe.save(ignore_permissions=True)
+
+		# Editar solo la cabecera no recalcula el stock con la receta nueva.
+		order.reload()
+		order.alias = "_Test cambio de cabecera"
+		order.save(ignore_permissions=True)
+		self.assertEqual(flt(frappe.db.get_value("Producto", first, "stock_actual")), 8)
+		self.assertEqual(flt(frappe.db.get_value("Producto", second, "stock_actual")), 10)
+
+		order.reload()
+		order.items[0].qty = 2
+		order.save(ignore_permissions=True)
+		self.assertEqual(flt(frappe.db.get_value("Producto", first, "stock_actual")), 10)
+		self.assertEqual(flt(frappe.db.get_value("Producto", second, "stock_actual")), 8)
+
+		frappe.delete_doc("orders", order.name, ignore_permissions=True, force=True)
+		self.assertEqual(flt(frappe.db.get_value("Producto", first, "stock_actual")), 10)
+		self.assertEqual(flt(frappe.db.get_value("Producto", second, "stock_actual")), 10)
+		frappe.delete_doc("Receta", recipe.name, ignore_permissions=True, force=True)
+
+	def test_stale_split_claim_can_be_taken_over(self):
+		order, _issue = _new_order_doc(
+			{"estado": "Nota Venta", "items": [{"product": self.products[0], "qty": 1, "rate": 1, "tax_rate": 0}]},
+			self.company,
+		)
+		order.insert(ignore_permissions=True)
+		split = frappe.get_doc(
+			{"doctype": "Order Split", "order": order.name, "company_id": self.company, "status": "Pagada"}
+		).insert(ignore_permissions=True, ignore_mandatory=True)
+
+		claimed_at = _claim_split_for_emit(split.name, "Pagada")
+		self.assertTrue(claimed_at)
+		# Un reclamo vigente no se puede tomar, ni siquiera desde "Emitiendo".
+		self.assertIsNone(_claim_split_for_emit(split.name, "Emitiendo"))
+
+		# El worker murió: el reclamo venció y otro lo retoma conservando el estado anterior.
+		stale = frappe.utils.add_to_date(claimed_at, seconds=-(SPLIT_EMIT_CLAIM_TIMEOUT + 1))
+		frappe.db.set_value("Order Split", split.name, "emit_claimed_at", stale, update_modified=False)
+		taken_at = _claim_split_for_emit(split.name, "Emitiendo")
+		self.assertTrue(taken_at)
+
+		# El worker original ya no puede liberar un reclamo que no es suyo.
+		_release_split_claim(split.name, stale)
+		self.assertEqual(frappe.db.get_value("Order Split", split.name, "status"), "Emitiendo")
+
+		_release_split_claim(split.name, taken_at)
+		self.assertEqual(frappe.db.get_value("Order Split", split.name, "status"), "Pagada")
+
+	def test_concurrent_orders_on_overlapping_products(self):
+		first, second = self.products
+		results = []
+		threads = []
+		for i in range(CONCURRENT_ORDERS):
+			# La mitad de las órdenes lista los productos en orden inverso para forzar locks cruzados.
+			products = [first, second] if i % 2 == 0 else [second, first]
+			payload = {
+				"estado": "Nota Venta",
+				"items": [{"product": p, "qty": 1, "rate": 1, "tax_rate": 0} for p in products],
+			}
+			threads.append(
+				threading.Thread(
+					target=_create_order_in_thread,
+					args=(frappe.local.site, "Administrator", payload, results),
+				)
+			)
+
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		errors = [r for r in results if r[0] == "error"]
+		self.assertFalse(errors, f"Errores inesperados (deadlock / lock wait): {errors}")
+
+		created = [r for r in results if r[0] == "ok"]
+		self.assertEqual(len(results), CONCURRENT_ORDERS)
+		self.assertEqual(len(created), min(CONCURRENT_ORDERS, INITIAL_STOCK))
+
+		for product in self.products:
+			stock = flt(frappe.db.get_value("Producto", product, "stock_actual"))
+			self.assertEqual(stock, INITIAL_STOCK - len(created))
+			self.assertGreaterEqual(stock, 0)
+
+	def test_hot_path_queries_can_use_indexes(self):
+		# EXPLAIN sobre las consultas reales de los listados (filtros, joins y keyset incluidos).
+		report = explain_hot_queries(self.company)
+		self.assertTrue(report)
+		unusable = [r for r in report if not r["usable"]]
+		self.assertFalse(unusable, f"Consultas que no pueden usar su indice: {unusable}")
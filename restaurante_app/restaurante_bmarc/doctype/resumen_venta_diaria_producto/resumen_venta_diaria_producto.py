@@ -0,0 +1,13 @@
+# Copyright (c) 2026, none and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class ResumenVentaDiariaProducto(Document):
+    pass
+
+
+def on_doctype_update():
+    frappe.db.add_index("Resumen Venta Diaria Producto", ["company_id", "fecha", "usuario"])
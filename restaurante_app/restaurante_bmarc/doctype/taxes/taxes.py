@@ -7,9 +7,22 @@ from frappe import _
 from frappe.model.document import Document
 import json
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
+from restaurante_app.restaurante_bmarc.api.tax_catalog import clear_tax_catalog
 
 class taxes(Document):
-	pass
+	def on_update(self):
+		self._clear_tax_catalog()
+
+	def on_trash(self):
+		self._clear_tax_catalog()
+
+	def _clear_tax_catalog(self):
+		companies = {self.company_id}
+		previous = self.get_doc_before_save()
+		if previous and previous.get("company_id"):
+			companies.add(previous.company_id)
+		for company in companies:
+			clear_tax_catalog(company, self.name)
 
 
 @frappe.whitelist()
@@ -59,6 +72,8 @@ def create_tax():
 
     impuesto.insert()
     frappe.db.commit()
+    # Otro request pudo recargar el catálogo antes del commit
+    clear_tax_catalog(company, impuesto.name)
 
     return {"message": _("Impuesto creado exitosamente"), "name": impuesto.name}
 
@@ -95,6 +110,7 @@ def update_tax():
 
     impuesto.save()
     frappe.db.commit()
+    clear_tax_catalog(company, impuesto.name)
 
     return {"message": _("Impuesto actualizado exitosamente"), "name": impuesto.name}
 
@@ -108,5 +124,6 @@ def delete_tax(name):
 
     impuesto.delete()
     frappe.db.commit()
+    clear_tax_catalog(company, impuesto.name)
 
     return {"message": _("Impuesto eliminado exitosamente")}
\ No newline at end of file
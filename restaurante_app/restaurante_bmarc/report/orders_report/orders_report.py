@@ -1,6 +1,7 @@
 import frappe
 from frappe import _
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
+from restaurante_app.restaurante_bmarc.api.utils import date_range_conditions
 
 DEFAULT_LIMIT = 50
 MAX_LIMIT = 1000
@@ -58,13 +59,11 @@ def _build_conditions(filters, company):
     ]
     params = {"company": company}
 
-    if filters.get("from_date"):
-        conditions.append("DATE(o.creation) >= %(from_date)s")
-        params["from_date"] = filters.get("from_date")
-
-    if filters.get("to_date"):
-        conditions.append("DATE(o.creation) <= %(to_date)s")
-        params["to_date"] = filters.get("to_date")
+    date_conditions, date_params = date_range_conditions(
+        "o.creation", filters.get("from_date"), filters.get("to_date")
+    )
+    conditions += date_conditions
+    params.update(date_params)
 
     if filters.get("estado"):
         conditions.append("o.estado = %(estado)s")
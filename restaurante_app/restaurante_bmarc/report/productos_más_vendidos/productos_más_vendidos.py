@@ -1,6 +1,7 @@
 import frappe
 from frappe import _
 from restaurante_app.restaurante_bmarc.api.user import get_user_company
+from restaurante_app.restaurante_bmarc.api.sales_rollup import get_product_sales_facts
 
 
 def execute(filters=None):
@@ -19,6 +20,9 @@ def get_columns():
         {"label": "Nombre del Producto", "fieldname": "nombre_producto", "fieldtype": "Data", "width": 250},
         {"label": "Descripción", "fieldname": "descripcion_producto", "fieldtype": "Data", "width": 300},
         {"label": "Cantidad Vendida", "fieldname": "cantidad", "fieldtype": "Float", "width": 150},
+        {"label": "Monto Neto", "fieldname": "monto_neto", "fieldtype": "Currency", "width": 130},
+        {"label": "IVA", "fieldname": "monto_iva", "fieldtype": "Currency", "width": 110},
+        {"label": "Órdenes", "fieldname": "ordenes", "fieldtype": "Int", "width": 100},
     ]
 
 
@@ -48,37 +52,5 @@ def get_data(filters):
     limit = int(filters.get("limit", 50))
     offset = int(filters.get("offset", 0))
 
-    # Condiciones dinámicas
-    conditions = [
-        "o.company_id = %(company)s",
-        "o.docstatus < 2"
-    ]
-    params = {"company": company}
-
-    if from_date:
-        conditions.append("DATE(o.creation) >= %(from_date)s")
-        params["from_date"] = from_date
-
-    if to_date:
-        conditions.append("DATE(o.creation) <= %(to_date)s")
-        params["to_date"] = to_date
-
-    where_clause = " AND ".join(conditions)
-
-    # Consulta final con LEFT JOIN
-    query = f"""
-        SELECT
-            i.product AS producto,
-            COALESCE(p.nombre, '') AS nombre_producto,
-            COALESCE(p.descripcion, '') AS descripcion_producto,
-            SUM(i.qty) AS cantidad
-        FROM `taborders` o
-        JOIN `tabItems` i ON o.name = i.parent
-        LEFT JOIN `tabProducto` p ON p.name = i.product
-        WHERE {where_clause}
-        GROUP BY i.product, p.nombre, p.descripcion
-        ORDER BY cantidad DESC
-        LIMIT {limit} OFFSET {offset}
-    """
-
-    return frappe.db.sql(query, params, as_dict=True)
+    # Ranking desde el resumen diario por producto (ver api/sales_rollup.py)
+    return get_product_sales_facts(company, from_date, to_date, limit, offset)["result"]